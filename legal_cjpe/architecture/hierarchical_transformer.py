@@ -1,4 +1,5 @@
 import math
+import warnings
 from typing import Tuple
 
 import torch
@@ -21,18 +22,24 @@ class h_transformer(nn.Module):
         self.pos_encoder = PositionalEncoding(d_model, dropout)
 
         # TransformerEncoderLayer is a transformer layer made up of self attention + feed forward network
-        encoder_layers = TransformerEncoderLayer(d_model, nhead, d_hid, dropout)
+        # batch first, the attention runs over the sentences of every document
+        encoder_layers = TransformerEncoderLayer(d_model, nhead, d_hid, dropout, batch_first=True)
 
-        # TransformerEncoder is a stack of N layers
-        self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers)
+        # TransformerEncoder is a stack of N layers, in eval it skips the padding with nested tensors
+        self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers, enable_nested_tensor=True)
 
         self.d_model = d_model
 
 
     def forward(self, src: Tensor, mask: Tensor) -> Tensor:
+        """
+        Args:
+            src: Tensor, shape [batch_size, seq_len, embedding_dim]
+            mask: Tensor, shape [batch_size, seq_len], 1 for the sentences and 0 for the padding
+        """
         src = src * math.sqrt(self.d_model)
         src = self.pos_encoder(src)
-        output = self.transformer_encoder(src, src_key_padding_mask = mask)
+        output = self.transformer_encoder(src, src_key_padding_mask = mask == 0)
         return output
 
 
@@ -44,15 +51,24 @@ class PositionalEncoding(nn.Module):
 
         position = torch.arange(max_len).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
-        pe = torch.zeros(max_len, 1, d_model)
-        pe[:, 0, 0::2] = torch.sin(position * div_term)
-        pe[:, 0, 1::2] = torch.cos(position * div_term)
+        pe = torch.zeros(1, max_len, d_model)
+        pe[0, :, 0::2] = torch.sin(position * div_term)
+        pe[0, :, 1::2] = torch.cos(position * div_term)
         self.register_buffer('pe', pe)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of the sequence first encoder have pe of shape [max_len, 1, d_model]
+        key = prefix + 'pe'
+        if key in state_dict and state_dict[key].dim() == 3 and state_dict[key].size(1) == 1 and self.pe.size(1) != 1:
+            warnings.warn("Converting a sequence first checkpoint: its model attended over the documents of a "
+                          "batch instead of their sentences, its predictions change with the batch first encoder")
+            state_dict[key] = state_dict[key].transpose(0, 1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x: Tensor) -> Tensor:
         """
         Args:
-            x: Tensor, shape [seq_len, batch_size, embedding_dim]
+            x: Tensor, shape [batch_size, seq_len, embedding_dim]
         """
-        x = x + self.pe[:x.size(0)]
+        x = x + self.pe[:, :x.size(1)]
         return self.dropout(x)
\ No newline at end of file
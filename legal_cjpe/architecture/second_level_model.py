@@ -21,8 +21,9 @@ class SecondLevelModel(nn.Module):
         # compute hierarchical encoding
         hierarchical_encoding = self.h_transformer(embeddings, attention_masks)
 
-        # average pooling
-        output = hierarchical_encoding.mean(dim=1)
+        # average pooling over the sentences, the padding left out
+        mask = attention_masks.unsqueeze(-1).to(hierarchical_encoding.dtype)
+        output = (hierarchical_encoding * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
 
         # compute output
         for _ in range(self.mlp_layers-1):
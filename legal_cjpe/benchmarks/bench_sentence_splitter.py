@@ -0,0 +1,75 @@
+"""Speed of the regex fast path of the sentence splitter against the ply lexer.
+
+Both paths are timed on the same documents of an ILDC CSV (the first --max_docs, median over --repeat runs):
+
+    python3 benchmarks/bench_sentence_splitter.py --ds_path trainData/ILDC_multi_train_dev.csv --output split.json
+
+Their parity is checked without any dataset by benchmarks/check_sentence_splitter.py.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+LEGAL_CJPE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LEGAL_CJPE_DIR)
+
+from code.sentence_splitter import fast_ssplit, split_document
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Speed of the regex and ply sentence splitters")
+    parser.add_argument("--ds_path", help="ILDC CSV with a text column", default="trainData/ILDC_multi_train_dev.csv", type=str)
+    parser.add_argument("--max_docs", help="Documents of the CSV used", type=int, default=200)
+    parser.add_argument("--repeat", help="Timed runs of each path", type=int, default=3)
+    parser.add_argument("--output", help="JSON file where the results are saved", default=None, type=str)
+    return parser.parse_args()
+
+
+def time_path(split, texts, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            split(text)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=LEGAL_CJPE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    bench_args = parse_args()
+    documents = pd.read_csv(bench_args.ds_path, nrows=bench_args.max_docs)['text'].tolist()
+
+    n_chars = sum(len(text) for text in documents)
+    results = {}
+    for name, split in (('ply', split_document), ('regex', fast_ssplit)):
+        elapsed = time_path(split, documents, bench_args.repeat)
+        results[name] = {'time_s': elapsed, 'docs_per_s': len(documents) / elapsed, 'mb_per_s': n_chars / elapsed / 1e6}
+        print("{:<6} {:>8.3f} s {:>10.1f} docs/s {:>8.2f} MB/s".format(
+            name, elapsed, results[name]['docs_per_s'], results[name]['mb_per_s']))
+    speedup = results['ply']['time_s'] / results['regex']['time_s']
+    print("Speedup of the regex path: {:.2f}x".format(speedup))
+
+    if bench_args.output is not None:
+        with open(bench_args.output, 'w') as f:
+            json.dump({'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                'python': sys.version.split()[0], 'ds_path': bench_args.ds_path,
+                                'documents': len(documents), 'characters': n_chars},
+                       'results': results, 'speedup': speedup}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
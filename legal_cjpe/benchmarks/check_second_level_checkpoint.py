@@ -0,0 +1,123 @@
+"""Conversion of the checkpoints of the sequence first SecondLevelModel to the batch first one.
+
+The sequence first model of the previous versions is rebuilt here with the same parameters, and its
+state_dict, from --checkpoint or initialized at random, is loaded into the batch first SecondLevelModel. On
+documents without padding, run sequence first by the old encoder and batch first with an attention mask by
+the new one, the two models must give the same outputs; the script exits with 1 otherwise:
+
+    python3 benchmarks/check_second_level_checkpoint.py
+    python3 benchmarks/check_second_level_checkpoint.py --checkpoint second_level_results/<model>/model.pt
+"""
+import argparse
+import math
+import os
+import sys
+import warnings
+
+import torch
+from torch import nn
+
+LEGAL_CJPE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LEGAL_CJPE_DIR)
+
+from architecture.second_level_model import SecondLevelModel
+
+
+class SequenceFirstPositionalEncoding(nn.Module):
+    """PositionalEncoding of the sequence first model, pe of shape [max_len, 1, d_model]."""
+
+    def __init__(self, d_model, max_len=5000):
+        super().__init__()
+        position = torch.arange(max_len).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
+        pe = torch.zeros(max_len, 1, d_model)
+        pe[:, 0, 0::2] = torch.sin(position * div_term)
+        pe[:, 0, 1::2] = torch.cos(position * div_term)
+        self.register_buffer('pe', pe)
+
+
+class SequenceFirstHTransformer(nn.Module):
+
+    def __init__(self, d_model, nhead, d_hid, nlayers):
+        super().__init__()
+        self.pos_encoder = SequenceFirstPositionalEncoding(d_model)
+        self.transformer_encoder = nn.TransformerEncoder(nn.TransformerEncoderLayer(d_model, nhead, d_hid, 0.0),
+                                                         nlayers, enable_nested_tensor=False)
+        self.d_model = d_model
+
+    def forward(self, src):
+        """src: Tensor, shape [seq_len, batch_size, embedding_dim], without padding."""
+        src = src * math.sqrt(self.d_model) + self.pos_encoder.pe[:src.size(0)]
+        return self.transformer_encoder(src)
+
+
+class SequenceFirstSecondLevelModel(nn.Module):
+    """SecondLevelModel before the batch first encoder, run on its sequence axis as intended."""
+
+    def __init__(self, d_model, nhead, d_hid, nlayers, mlp_layers):
+        super().__init__()
+        self.h_transformer = SequenceFirstHTransformer(d_model, nhead, d_hid, nlayers)
+        self.fc = nn.Linear(d_model, d_model)
+        self.fc_out = nn.Linear(d_model, 1)
+        self.mlp_layers = mlp_layers
+
+    def forward(self, embeddings):
+        output = self.h_transformer(embeddings).mean(dim=0)
+        for _ in range(self.mlp_layers - 1):
+            output = torch.relu(self.fc(output))
+        return torch.sigmoid(self.fc_out(output))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Conversion of sequence first SecondLevelModel checkpoints")
+    parser.add_argument("--checkpoint", help="model.pt of a sequence first model, a random one if not given",
+                        default=None, type=str)
+    parser.add_argument("--d_model", help="Embedding size of the random model", type=int, default=64)
+    parser.add_argument("--nlayers", help="Attention layers of the random model", type=int, default=2)
+    parser.add_argument("--nhead", help="Attention heads, not saved in the checkpoints", type=int, default=4)
+    parser.add_argument("--mlp_layers", help="MLP layers, not saved in the checkpoints", type=int, default=3)
+    parser.add_argument("--documents", help="Documents compared", type=int, default=8)
+    parser.add_argument("--sentences", help="Sentences of every document", type=int, default=40)
+    parser.add_argument("--atol", help="Largest difference allowed between the outputs", type=float, default=1e-5)
+    return parser.parse_args()
+
+
+def main():
+    check_args = parse_args()
+    torch.manual_seed(0)
+    if check_args.checkpoint is not None:
+        state_dict = torch.load(check_args.checkpoint, map_location='cpu')
+        d_model = state_dict['h_transformer.pos_encoder.pe'].size(-1)
+        d_hid = state_dict['h_transformer.transformer_encoder.layers.0.linear1.weight'].size(0)
+        nlayers = len({key.split('.')[3] for key in state_dict if key.startswith('h_transformer.transformer_encoder.layers.')})
+    else:
+        d_model, d_hid, nlayers = check_args.d_model, check_args.d_model, check_args.nlayers
+        state_dict = None
+
+    old = SequenceFirstSecondLevelModel(d_model, check_args.nhead, d_hid, nlayers, check_args.mlp_layers)
+    if state_dict is None:
+        state_dict = old.state_dict()
+    old.load_state_dict(state_dict)
+    old.eval()
+
+    new = SecondLevelModel(d_model=d_model, nhead=check_args.nhead, d_hid=d_hid, nlayers=nlayers,
+                           mlp_layers=check_args.mlp_layers)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        # strict, a key of the state_dict missing or left over fails here
+        new.load_state_dict({key: value.clone() for key, value in state_dict.items()})
+    new.eval()
+
+    embeddings = torch.randn(check_args.documents, check_args.sentences, d_model)
+    attention_masks = torch.ones(check_args.documents, check_args.sentences)
+    with torch.no_grad():
+        expected = old(embeddings.transpose(0, 1))
+        got = new(embeddings, attention_masks)
+    difference = (expected - got).abs().max().item()
+    print("{} documents of {} sentences, d_model {}, {} layers: largest difference {:.2e}".format(
+        check_args.documents, check_args.sentences, d_model, nlayers, difference))
+    sys.exit(0 if difference <= check_args.atol else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Parity of the regex fast path of the sentence splitter with the ply lexer, on built-in texts.
+
+The texts hold the tokens on which the two paths could disagree (abbreviations, numbers, URLs, dates,
+repeated punctuation, non-ASCII symbols, long documents). Both paths must give the same sentences and the
+same spans: every difference is reported and the script exits with 1. No dataset is needed:
+
+    python3 benchmarks/check_sentence_splitter.py
+"""
+import os
+import sys
+
+LEGAL_CJPE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LEGAL_CJPE_DIR)
+
+from code.sentence_splitter import fast_ssplit, split_document
+
+# texts with the tokens on which the two paths could disagree
+EDGE_CASES = [
+    "",
+    "   \t \n\n  ",
+    "No end of sentence",
+    "The appeal is dismissed. No order as to costs.",
+    "Heard Mr. K.K. Venugopal, Sr. Adv. for the appellant... The Court held; see para 12 – 14 ― and 15.",
+    "Dated 12/03/1998 at 10:30pm, Rs. 5,000.50 and -3.5 or .75 per cent, A1B2 and 2B3 items.",
+    "See http://indiankanoon.org/doc/1234/?a=b&c=d and mailto:registry@sci.nic.in or km/h, n° 5, 30°C.",
+    "Is it so?? Yes!! \"Quoted\" ‘text’ (i) [ii] {iii} «iv» a_b ¦ | ^ ` ´ ′ ˈ \\ §§ 50% ½ ²   \r\n done",
+    "Emoji \U0001F600 and ✅ and dingbat ✂ \U0001FA71.",
+    "Section 302 I.P.C.. The U.S.A. and U.K.. e.g. i.e. etc.. End.",
+    "First line\nsecond line\n\n\nThird paragraph. Fourth.\n",
+    "Numbers 1. 2. 3.. and 1.2.3 and 1,2,3 and 1/2/3 and 1-2-3.",
+    " ".join(["word"] * 2500),
+]
+
+
+def check_parity(texts):
+    """Indexes of the texts on which the two paths give different sentences or spans, with the first difference."""
+    mismatches = []
+    for i, text in enumerate(texts):
+        expected = split_document(text)
+        got = fast_ssplit(text)
+        if got != expected:
+            for kind, e, g in zip(('sentences', 'spans'), expected, got):
+                if e != g:
+                    first = next((j for j, (a, b) in enumerate(zip(e, g)) if a != b), min(len(e), len(g)))
+                    mismatches.append({'doc': i, 'kind': kind, 'index': first,
+                                       'ply': e[first] if first < len(e) else None,
+                                       'regex': g[first] if first < len(g) else None})
+                    break
+    return mismatches
+
+
+def main():
+    mismatches = check_parity(EDGE_CASES)
+    for mismatch in mismatches:
+        print("edge case {}: first different {} at {}: ply {!r}, regex {!r}".format(
+            mismatch['doc'], mismatch['kind'], mismatch['index'], mismatch['ply'], mismatch['regex']))
+    print("Parity: {} edge cases, {} different".format(len(EDGE_CASES), len(mismatches)))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
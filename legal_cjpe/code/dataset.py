@@ -1,48 +1,153 @@
 from transformers import AutoTokenizer
 from torch.utils.data import Dataset
 import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
 import torch
 
+# version of the windows saved by pretokenize, changed whenever encode_windows gives different ids
+CACHE_VERSION = 2
+# characters per token of the first suffix tokenized by encode_tail, more than most English texts need
+CHARS_PER_TOKEN = 6
+
+
+def encode_tail(tokenizer, text, max_len):
+    """Last tokens of text in a window of max_len tokens with its special tokens, without tokenizing all of it.
+
+    A suffix of the text is tokenized, twice as long every time until it has more tokens than the window
+    holds, so the cost depends on max_len and not on the length of the document. The suffix starts at a
+    whitespace, so its first word is tokenized as in the whole text; the tokens that do not fit are dropped
+    from the start and the special tokens and the padding are added by the tokenizer as for any sequence.
+    """
+    n_tokens = max_len - tokenizer.num_special_tokens_to_add(pair=False)
+    n_chars = n_tokens * CHARS_PER_TOKEN
+    while True:
+        start = max(len(text) - n_chars, 0)
+        if start > 0:
+            # from the first whitespace of the suffix, the first token is never a fragment of a word
+            space = next((i for i in range(start, len(text)) if text[i].isspace()), None)
+            # without any whitespace the first token can be a fragment, it is dropped with the tokens that do not fit
+            start = space if space is not None else start
+        ids = tokenizer(text[start:], add_special_tokens=False, verbose=False)['input_ids']
+        if start == 0 or len(ids) > n_tokens:
+            break
+        n_chars *= 2
+    return tokenizer.prepare_for_model(ids[len(ids) - n_tokens:] if len(ids) > n_tokens else ids,
+                                       add_special_tokens=True,
+                                       padding='max_length',
+                                       truncation=False,
+                                       max_length=max_len,
+                                       verbose=False)
+
+
+def encode_windows(tokenizer, texts, strategy, max_len):
+    """Windows of max_len tokens of texts, the first ones or the last ones, as numpy arrays [len(texts), max_len]."""
+    if strategy == "first":
+        inputs = tokenizer(texts,
+                           truncation=True,
+                           padding='max_length',
+                           verbose=False)
+    elif strategy == "last":
+        windows = [encode_tail(tokenizer, text, max_len) for text in texts]
+        inputs = {key: [window[key] for window in windows] for key in windows[0].keys()}
+    else:
+        raise ValueError("Strategy not supported")
+    return {key: np.asarray(inputs[key], dtype=np.int64) for key in ('input_ids', 'attention_mask', 'token_type_ids')
+            if key in inputs}
+
+
+def cache_key(dataset_path, tokenizer, split, strategy):
+    """Hash of everything the windows of a split depend on: the CSV, the tokenizer and the strategy."""
+    stat = os.stat(dataset_path)
+    digest = hashlib.sha256(json.dumps({
+        'version': CACHE_VERSION,
+        'dataset': [os.path.abspath(dataset_path), stat.st_size, stat.st_mtime_ns],
+        'tokenizer': [type(tokenizer).__name__, tokenizer.name_or_path, tokenizer.model_max_length,
+                      tokenizer.padding_side],
+        'split': split,
+        'strategy': strategy,
+    }, sort_keys=True).encode())
+    # the vocabulary, so that two tokenizers saved under the same name are told apart
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    return digest.hexdigest()[:16]
+
+
+def pretokenize(dataset_path, tokenizer, split, strategy, cache_dir, batch_size=64):
+    """Tokenize the documents of a split once and save their windows in cache_dir, return the directory.
+
+    The input ids are saved as int32, the attention mask and the token type ids as int8, every one as a .npy
+    of shape [documents, max_len] that the dataset memory maps. The directory is named after the CSV, the
+    strategy and cache_key, so the windows are computed again only when one of them changes.
+    """
+    name = os.path.splitext(os.path.basename(dataset_path))[0]
+    path = os.path.join(cache_dir, f"{name}_{split}_{strategy}_{cache_key(dataset_path, tokenizer, split, strategy)}")
+    if os.path.exists(os.path.join(path, 'labels.npy')):
+        return path
+
+    data = pd.read_csv(dataset_path)[['text', 'label', 'split']]
+    data = data[data['split'] == split]
+    texts = data['text'].tolist()
+    max_len = tokenizer.model_max_length
+
+    # written in a temporary directory, so that an interrupted run never leaves a partial cache
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    dtypes = {'input_ids': np.int32, 'attention_mask': np.int8, 'token_type_ids': np.int8}
+    arrays = {}
+    for start in range(0, len(texts), batch_size):
+        windows = encode_windows(tokenizer, texts[start:start + batch_size], strategy, max_len)
+        for key, values in windows.items():
+            if key not in arrays:
+                arrays[key] = np.lib.format.open_memmap(os.path.join(tmp_path, f'{key}.npy'), mode='w+',
+                                                        dtype=dtypes[key], shape=(len(texts), max_len))
+            arrays[key][start:start + len(values)] = values
+    for values in arrays.values():
+        values.flush()
+    # the labels last, their presence marks a complete cache
+    np.save(os.path.join(tmp_path, 'labels.npy'), data['label'].to_numpy(dtype=np.int64))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
 class LJPEClassificationDataset(Dataset):
-    def __init__(self, dataset_path, model_path='roberta-base', split="train", strategy="first"):
+    def __init__(self, dataset_path, model_path='roberta-base', split="train", strategy="first", cache_dir=None):
         self.split = split
 
-        self.data = pd.read_csv(dataset_path)[['text', 'label', 'split']]
-        self.data = self.data[self.data['split'] == self.split]
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
         self.max_len = self.tokenizer.model_max_length
         self.strategy = strategy
+        self.cached = None
+        if cache_dir is not None:
+            # windows tokenized once by pretokenize, no tokenizer work while iterating
+            path = pretokenize(dataset_path, self.tokenizer, split, strategy, cache_dir)
+            self.cached = {f[:-len('.npy')]: np.load(os.path.join(path, f), mmap_mode='r')
+                           for f in os.listdir(path) if f.endswith('.npy')}
+            self.data = None
+        else:
+            self.data = pd.read_csv(dataset_path)[['text', 'label', 'split']]
+            self.data = self.data[self.data['split'] == self.split]
 
     def __len__(self):
+        if self.cached is not None:
+            return len(self.cached['labels'])
         return len(self.data)
 
     def __getitem__(self, idx):
+        if self.cached is not None:
+            inputs = {key: torch.from_numpy(values[idx].astype(np.int64)) for key, values in self.cached.items()
+                      if key != 'labels'}
+            inputs['labels'] = torch.tensor(self.cached['labels'][idx])
+            return inputs
+
         item = self.data.iloc[idx]
         text = item['text']
         label = item['label']
-        if self.strategy == "first":            
-            inputs = self.tokenizer(text,
-                                return_tensors='pt',
-                                truncation=True,
-                                padding='max_length',
-                                verbose=False)
-        elif self.strategy == "last":
-            inputs = self.tokenizer(text,
-                                return_tensors='pt',
-                                truncation=False,
-                                padding='max_length',
-                                verbose=False)
-            new_inputs = {}
-            new_inputs['input_ids'] = inputs['input_ids'][:, -self.max_len:]
-            new_inputs['input_ids'][:, 0] = self.tokenizer.cls_token_id
-            new_inputs['attention_mask'] = inputs['attention_mask'][:, -self.max_len:]
-            if "token_type_ids" in inputs:
-                new_inputs['token_type_ids'] = inputs['token_type_ids'][:, -self.max_len:]
-            inputs = new_inputs
-        
-        inputs['input_ids'] = inputs['input_ids'].squeeze(0).long()  
-        inputs['attention_mask'] = inputs['attention_mask'].squeeze(0).long() 
-        if "token_type_ids" in inputs:
-            inputs['token_type_ids'] = inputs['token_type_ids'].squeeze(0).long()
+        inputs = {key: torch.from_numpy(values[0]) for key, values in
+                  encode_windows(self.tokenizer, [text], self.strategy, self.max_len).items()}
         inputs['labels'] = torch.tensor(label)
-        return inputs
\ No newline at end of file
+        return inputs
@@ -0,0 +1,77 @@
+"""Ragged store of the sentence embeddings of the documents.
+
+The embeddings of all the sentences are one contiguous matrix [sentences, hidden size] (embeddings.npy) and the
+sentences of document i are the rows offsets[i]:offsets[i + 1] (offsets.npy, int64), both in a directory.
+Loaded as memory maps, the embeddings of a document are views of the matrix: nothing is unpickled or copied
+until a batch is built. The object .npy files of the previous extractions are converted with:
+
+    python3 code/embedding_store.py --legacy trainData/single_embeddings_train.npy --output trainData/single_embeddings_train
+"""
+import argparse
+import os
+import numpy as np
+
+
+class RaggedEmbeddings(object):
+    """Embeddings of the documents, embeddings[i] is the [sentences, hidden size] array of document i."""
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    @property
+    def embedding_size(self):
+        return self.values.shape[1]
+
+    def lengths(self):
+        """Number of sentences of every document."""
+        return np.diff(self.offsets)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(np.load(os.path.join(path, 'embeddings.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, 'offsets.npy')))
+
+    @staticmethod
+    def save(path, embeddings, dtype=np.float16):
+        """Save the [sentences, hidden size] arrays of embeddings in the directory path, as dtype."""
+        offsets = np.zeros(len(embeddings) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in embeddings], out=offsets[1:])
+        hidden_size = next((e.shape[1] for e in embeddings if e.ndim == 2), 0)
+        os.makedirs(path, exist_ok=True)
+        # written under temporary names, so that an interrupted save never leaves a store that loads
+        tmp_path = os.path.join(path, 'embeddings.npy.tmp')
+        values = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(int(offsets[-1]), hidden_size))
+        for i, e in enumerate(embeddings):
+            values[offsets[i]:offsets[i + 1]] = e
+        values.flush()
+        del values
+        with open(os.path.join(path, 'offsets.npy.tmp'), 'wb') as f:
+            np.save(f, offsets)
+        os.replace(tmp_path, os.path.join(path, 'embeddings.npy'))
+        os.replace(os.path.join(path, 'offsets.npy.tmp'), os.path.join(path, 'offsets.npy'))
+
+
+def convert_legacy(legacy_path, path, dtype=np.float16):
+    """Convert the pickled object array of legacy_path, one array per document, to a ragged store in path."""
+    embeddings = np.load(legacy_path, allow_pickle=True)
+    RaggedEmbeddings.save(path, [np.asarray(e) for e in embeddings], dtype=dtype)
+    return RaggedEmbeddings.load(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Conversion of object .npy sentence embeddings to a ragged store")
+    parser.add_argument("--legacy", help=".npy file of the embeddings of the documents", required=True, type=str)
+    parser.add_argument("--output", help="Directory of the ragged store", required=True, type=str)
+    parser.add_argument("--dtype", help="Type of the saved embeddings", default="float16",
+                        choices=["float16", "float32"], type=str)
+    convert_args = parser.parse_args()
+    store = convert_legacy(convert_args.legacy, convert_args.output, dtype=np.dtype(convert_args.dtype))
+    print(f"{len(store)} documents, {len(store.values)} sentences of {store.embedding_size} dimensions "
+          f"saved in {convert_args.output}")
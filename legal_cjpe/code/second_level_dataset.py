@@ -1,42 +1,95 @@
 from transformers import AutoTokenizer
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, default_collate
 import pandas as pd
 import numpy as np
 import torch
 
 class LJPESecondLevelClassificationDataset(Dataset):
-    def __init__(self, embeddings, labels, strategy="last", max_sentences=256):
+    def __init__(self, embeddings, labels, strategy="last", max_sentences=256, pad=True):
 
         print("Start Loading..")
         self.embeddings = embeddings
         self.labels = labels
-        self.embedding_size = torch.from_numpy(self.embeddings[0]).shape[1]
+        self.embedding_size = self.embeddings[0].shape[1]
         self.strategy = strategy
         self.max_sentences = max_sentences
+        # without padding the documents are padded by collate_documents to the longest one of their batch
+        self.pad = pad
         
 
     def __len__(self):
         return len(self.embeddings)
 
+    def lengths(self):
+        """Number of sentences of every document once truncated to max_sentences."""
+        if hasattr(self.embeddings, 'lengths'):
+            lengths = self.embeddings.lengths()
+        else:
+            lengths = np.array([len(e) for e in self.embeddings])
+        return np.minimum(lengths, self.max_sentences)
+
 
     def __getitem__(self, idx):
+        # a view of the document for a ragged store, only the sentences kept are copied
         embedding = self.embeddings[idx]
-        embedding = torch.from_numpy(embedding)
-        attention_mask = torch.ones(embedding.shape[0], dtype=torch.float)
 
         if embedding.shape[0] > self.max_sentences:
             if self.strategy == "first":
                 embedding = embedding[:self.max_sentences]
-                attention_mask = attention_mask[:self.max_sentences]
             elif self.strategy == "last":
                 embedding = embedding[-self.max_sentences:]
-                attention_mask = attention_mask[-self.max_sentences:]
             else:
                 raise ValueError("Strategy not supported")
-        elif embedding.shape[0] < self.max_sentences:
+        embedding = torch.from_numpy(np.array(embedding, dtype=np.float32))
+        attention_mask = torch.ones(embedding.shape[0], dtype=torch.float)
+        if self.pad and embedding.shape[0] < self.max_sentences:
             pad_amount = self.max_sentences - len(embedding)
             embedding = torch.cat([embedding, torch.zeros(pad_amount, self.embedding_size, dtype=torch.float)], dim=0)
             attention_mask = torch.cat([attention_mask, torch.zeros(pad_amount, dtype=torch.float)], dim=0)
 
         label = self.labels[idx]
-        return embedding, attention_mask, label
\ No newline at end of file
+        return embedding, attention_mask, label
+
+
+def collate_documents(batch):
+    """Batch of documents of different lengths, padded with zeros to the longest one."""
+    embeddings, attention_masks, labels = zip(*batch)
+    max_len = max(len(e) for e in embeddings)
+    padded = torch.zeros(len(batch), max_len, embeddings[0].shape[1], dtype=torch.float)
+    padded_masks = torch.zeros(len(batch), max_len, dtype=torch.float)
+    for i, (embedding, attention_mask) in enumerate(zip(embeddings, attention_masks)):
+        padded[i, :len(embedding)] = embedding
+        padded_masks[i, :len(attention_mask)] = attention_mask
+    return padded, padded_masks, default_collate(labels)
+
+
+class LengthBucketSampler(Sampler):
+    """Batches of documents of similar lengths, so that collate_documents pads them little.
+
+    Every epoch the documents are shuffled and cut in buckets of bucket_batches batches, the documents of a
+    bucket are sorted by length and grouped in batches, and the order of all the batches is shuffled.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_batches=50, shuffle=True, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
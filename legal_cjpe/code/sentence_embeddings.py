@@ -0,0 +1,171 @@
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from torch.utils.data import Dataset
+from tqdm import tqdm
+import pandas as pd
+import numpy as np
+import json
+import os
+
+from code.sentence_encoder import SentenceEncoder
+from code.sentence_index import SentenceIndex
+
+
+class SentenceDataset(Dataset):
+    """Sentences of the documents of a sentences CSV or of a sentence index (.npz) of sentence_splitter.py.
+
+    Every item is (sentences, key, label) for a document of split, or of the whole file if split is None:
+    the key is its doc_ids if the file has them, its doc_index otherwise, and the label is None when the
+    file has no labels. The documents with more than max_sentences sentences keep the first or the last ones.
+    """
+
+    def __init__(self, dataset_path, split=None, strategy="last", max_sentences=256):
+        self.split = split
+        if dataset_path.endswith('.npz'):
+            # the sentences are slices of the texts of the dataset
+            self.index = SentenceIndex.load(dataset_path)
+            docs = np.arange(len(self.index))
+            if split is not None:
+                docs = np.flatnonzero(self.index.splits == split)
+            self.group_indexes = docs.tolist()
+        else:
+            self.index = None
+            self.data = pd.read_csv(dataset_path)
+            if split is not None:
+                self.data = self.data[self.data['split'] == split]
+            self.data = self.data.reset_index(drop=True)
+            self.key = 'doc_ids' if 'doc_ids' in self.data.columns else 'doc_index'
+            self.data = self.data.groupby(self.key)
+            self.group_indexes = list(self.data.groups.keys())
+        self.strategy = strategy
+        self.max_sentences = max_sentences
+
+    def __len__(self):
+        return len(self.group_indexes)
+
+    def __getitem__(self, idx):
+        doc = self.group_indexes[idx]
+        if self.index is not None:
+            sents = self.index.sentences(doc)
+            key = self.index.doc_ids[doc] if self.index.doc_ids is not None else doc
+            label = self.index.labels[doc].item() if self.index.labels is not None else None
+        else:
+            group = self.data.get_group(doc)
+            sents = group["sentence"].tolist()
+            key = doc
+            label = group["label"].iloc[0].item() if "label" in group.columns else None
+        if len(sents) > self.max_sentences:
+            if self.strategy == "first":
+                sents = sents[:self.max_sentences]
+            elif self.strategy == "last":
+                sents = sents[-self.max_sentences:]
+            else:
+                raise ValueError("Strategy not supported")
+        return sents, key, label
+
+
+def _without(meta, *keys):
+    return {key: value for key, value in meta.items() if key not in keys}
+
+
+class ShardedEmbeddingStore(object):
+    """Sentence embeddings of the documents of a dataset, saved in store_dir by shards of docs_per_shard documents.
+
+    A shard holds the embeddings of its sentences as one float32 matrix, the offsets of its documents, their
+    keys and their labels. It is written under a temporary name and renamed when complete, so an interrupted
+    extraction starts again from the first missing shard. store.json records what the embeddings depend on:
+    reusing the directory for another dataset, split or encoder raises a ValueError. The size and modification
+    time of the source file, the sentences of the documents, are recorded too: when it is written again at
+    the same path, the shards are stale and are all computed again.
+    """
+
+    def __init__(self, store_dir, n_docs, docs_per_shard, meta, source=None):
+        self.store_dir = store_dir
+        self.n_docs = n_docs
+        self.docs_per_shard = docs_per_shard
+        self.meta = dict(meta, documents=n_docs, docs_per_shard=docs_per_shard)
+        if source is not None:
+            stat = os.stat(source)
+            self.meta['source'] = [stat.st_size, stat.st_mtime_ns]
+        os.makedirs(store_dir, exist_ok=True)
+        meta_path = os.path.join(store_dir, 'store.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                saved = json.load(f)
+            if saved == self.meta:
+                return
+            # the number of documents changes with the source file
+            if source is None or _without(saved, 'source', 'documents') != _without(self.meta, 'source', 'documents'):
+                raise ValueError(f"{store_dir} holds the embeddings of {saved}, not of {self.meta}: "
+                                 f"remove it or choose another directory")
+            print(f"{source} changed since the embeddings in {store_dir} were computed, they are computed again")
+            self.clear()
+        with open(meta_path, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+    def __len__(self):
+        return (self.n_docs + self.docs_per_shard - 1) // self.docs_per_shard
+
+    def shard_path(self, shard):
+        return os.path.join(self.store_dir, f'shard_{shard:05d}.npz')
+
+    def shard_range(self, shard):
+        start = shard * self.docs_per_shard
+        return start, min(start + self.docs_per_shard, self.n_docs)
+
+    def clear(self):
+        """Remove the shards, complete or not."""
+        for name in os.listdir(self.store_dir):
+            if name.startswith('shard_'):
+                os.remove(os.path.join(self.store_dir, name))
+
+    def missing_shards(self):
+        return [shard for shard in range(len(self)) if not os.path.exists(self.shard_path(shard))]
+
+    def write(self, shard, embeddings, keys, labels):
+        arrays = {'embeddings': np.concatenate(embeddings, axis=0),
+                  'offsets': np.cumsum([0] + [len(e) for e in embeddings]).astype(np.int64),
+                  'keys': np.asarray(keys)}
+        if all(label is not None for label in labels):
+            arrays['labels'] = np.asarray(labels)
+        tmp_path = self.shard_path(shard) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.shard_path(shard))
+
+    def read(self):
+        """Embeddings of the documents, one array [sentences, hidden size] each, their keys and their labels."""
+        embeddings, keys, labels = [], [], []
+        for shard in range(len(self)):
+            with np.load(self.shard_path(shard), allow_pickle=False) as arrays:
+                offsets = arrays['offsets']
+                flat = arrays['embeddings']
+                embeddings.extend(flat[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1))
+                keys.extend(arrays['keys'].tolist())
+                labels.extend(arrays['labels'].tolist() if 'labels' in arrays else [None] * (len(offsets) - 1))
+        return embeddings, keys, labels
+
+
+def extract_embeddings(dataset, sentence_encoder, store_dir, meta, docs_per_shard=1024, docs_per_batch=64, source=None):
+    """Embeddings, keys and labels of the documents of dataset, every document encoded once.
+
+    The shards of the store already in store_dir are kept, only the missing ones are computed, unless the
+    source file of the dataset changed since they were.
+    """
+    store = ShardedEmbeddingStore(store_dir, len(dataset), docs_per_shard, meta, source=source)
+    for shard in tqdm(store.missing_shards()):
+        start, stop = store.shard_range(shard)
+        items = [dataset[i] for i in range(start, stop)]
+        embeddings = []
+        for batch in range(0, len(items), docs_per_batch):
+            embeddings.extend(sentence_encoder.encode([sents for sents, _, _ in items[batch:batch + docs_per_batch]]))
+        store.write(shard, embeddings, [key for _, key, _ in items], [label for _, _, label in items])
+    return store.read()
+
+
+def load_sentence_encoder(tokenizer_path, sentence_encoder_path, device, max_tokens=16384):
+    """SentenceEncoder of the sentence classifier at sentence_encoder_path, from the local files only."""
+    model = AutoModelForSequenceClassification.from_pretrained(sentence_encoder_path, local_files_only=True)
+    model.eval()
+    model.to(device)
+    return SentenceEncoder(model, AutoTokenizer.from_pretrained(tokenizer_path), device, max_tokens=max_tokens)
+
@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+
+
+class SentenceEncoder(object):
+    """CLS embeddings of the sentences of many documents, computed in batches of a bounded number of tokens.
+
+    The sentences of all the documents given to encode are tokenized without padding, sorted by length and
+    packed in batches whose padded size (sentences x longest sentence) is at most max_tokens, each one padded
+    only to its longest sentence. So the cost follows the real tokens and not max_len per sentence, short
+    documents do not make small batches, and the CLS vectors are put back in the order of their documents.
+    """
+
+    def __init__(self, model, tokenizer, device, max_tokens=16384, max_len=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_len = max_len if max_len is not None else tokenizer.model_max_length
+        # at least one sentence of max_len tokens fits in a batch
+        self.max_tokens = max(max_tokens, self.max_len)
+
+    def batches(self, lengths):
+        """Lists of indexes of the sentences, longest first, of at most max_tokens padded tokens each."""
+        order = np.argsort(-np.asarray(lengths), kind='stable')
+        batch = []
+        for i in order:
+            # the first sentence of a batch is its longest one
+            if batch and (len(batch) + 1) * lengths[batch[0]] > self.max_tokens:
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    @torch.no_grad()
+    def encode(self, documents):
+        """Embeddings of documents, lists of sentences, as float32 arrays [sentences, hidden size] in order."""
+        sentences = [sentence for document in documents for sentence in document]
+        embeddings = [None] * len(documents)
+        if not sentences:
+            hidden_size = self.model.config.hidden_size
+            return [np.zeros((0, hidden_size), dtype=np.float32) for _ in documents]
+
+        input_ids = self.tokenizer(sentences, truncation=True, max_length=self.max_len, verbose=False)['input_ids']
+        lengths = [len(ids) for ids in input_ids]
+        flat = None
+        for batch in self.batches(lengths):
+            inputs = self.tokenizer.pad({'input_ids': [input_ids[i] for i in batch]}, return_tensors='pt')
+            output = self.model(inputs['input_ids'].to(self.device), inputs['attention_mask'].to(self.device),
+                                output_hidden_states=True)
+            cls = output.hidden_states[-1][:, 0, :].float().cpu().numpy()
+            if flat is None:
+                flat = np.empty((len(sentences), cls.shape[1]), dtype=np.float32)
+            flat[batch] = cls
+
+        # the sentences of a document are contiguous in flat
+        offsets = np.cumsum([0] + [len(document) for document in documents])
+        for d in range(len(documents)):
+            embeddings[d] = flat[offsets[d]:offsets[d + 1]].copy()
+        return embeddings
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+class SentenceIndex(object):
+    """Sentences of the documents of a dataset CSV, stored as character spans of the original texts.
+
+    For every sentence the index keeps its document (row of the CSV), its position in the document and its span
+    [begin, end) in the text as int32 arrays sorted by document, and doc_ptr, the position of the first sentence
+    of every document, so the sentences of a document are slices of its text found in O(1). The labels, splits
+    and ids of the documents are kept when the CSV has them. Saved as a compressed .npz next to the CSV, see sentence_splitter.py.
+    """
+
+    def __init__(self, texts, doc_index, sent_index, begin, end, labels=None, splits=None, doc_ids=None, texts_path=None):
+        self.texts = texts
+        self.doc_index = np.asarray(doc_index, dtype=np.int32)
+        self.sent_index = np.asarray(sent_index, dtype=np.int32)
+        self.begin = np.asarray(begin, dtype=np.int32)
+        self.end = np.asarray(end, dtype=np.int32)
+        self.labels = labels
+        self.splits = splits
+        self.doc_ids = doc_ids
+        self.texts_path = texts_path
+        n_docs = len(texts) if texts is not None else int(self.doc_index.max(initial=-1)) + 1
+        self.doc_ptr = np.zeros(n_docs + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.doc_index, minlength=n_docs), out=self.doc_ptr[1:])
+        self.id_to_doc = None if doc_ids is None else {doc_id: i for i, doc_id in enumerate(doc_ids)}
+
+    def __len__(self):
+        return len(self.doc_ptr) - 1
+
+    def spans(self, doc):
+        """Begins and ends of the sentences of the document at row doc, views of the index."""
+        start, stop = self.doc_ptr[doc], self.doc_ptr[doc + 1]
+        return self.begin[start:stop], self.end[start:stop]
+
+    def sentences(self, doc):
+        """Sentences of the document at row doc, slices of its text."""
+        text = self.texts[doc]
+        return [text[b:e] for b, e in zip(*self.spans(doc))]
+
+    def sentences_of(self, doc_id):
+        """Sentences of the document with id doc_id, the index must have the ids of the documents."""
+        return self.sentences(self.id_to_doc[doc_id])
+
+    def save(self, path):
+        arrays = {'doc_index': self.doc_index, 'sent_index': self.sent_index, 'begin': self.begin, 'end': self.end}
+        for name, values in (('label', self.labels), ('split', self.splits), ('doc_id', self.doc_ids)):
+            if values is not None:
+                arrays[name] = np.asarray(values)
+        if self.texts_path is not None:
+            # relative to the index, so that the index and the CSV can be moved together
+            arrays['texts_path'] = np.array(os.path.relpath(self.texts_path, os.path.dirname(os.path.abspath(path))))
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path, texts=None):
+        """Load the index saved at path, with the texts of the CSV it was built from if texts is None."""
+        arrays = np.load(path, allow_pickle=False)
+        texts_path = None
+        if 'texts_path' in arrays:
+            texts_path = os.path.join(os.path.dirname(os.path.abspath(path)), str(arrays['texts_path']))
+        if texts is None:
+            if texts_path is None:
+                raise ValueError(f"The index {path} has no path of its texts, pass them to load")
+            texts = pd.read_csv(texts_path, usecols=['text'])['text'].tolist()
+        optional = {name: arrays[key] if key in arrays else None
+                    for name, key in (('labels', 'label'), ('splits', 'split'), ('doc_ids', 'doc_id'))}
+        if optional['doc_ids'] is not None:
+            optional['doc_ids'] = optional['doc_ids'].tolist()
+        return cls(texts, arrays['doc_index'], arrays['sent_index'], arrays['begin'], arrays['end'],
+                   texts_path=texts_path, **optional)
@@ -1,9 +1,20 @@
 import ply.lex as lex
+import os
+import re
+import sys
+from collections import deque
 from itertools import count
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
 from argparse import ArgumentParser
 from tqdm import tqdm
 
+if __name__ == '__main__':
+    # run as a script (python3 code/sentence_splitter.py): the package code is in the parent directory
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from code.sentence_index import SentenceIndex
+
 # List of token names.   This is always required
 tokens = (
     'EMAIL',
@@ -125,18 +136,189 @@ def ssplit(tokens):
         sentence.append(tok.value)
 
         if tok.type == 'PUNCTUATION_EOS' or len(sentence) >= 1000:
-            spans.append({'begin':begin, 'end':tok.lexpos})
+            spans.append({'begin':begin, 'end':tok.lexpos + len(tok.value)})
             sentences.append(sentence)
             sentence = []
             begin = -1
 
     if len(sentence) > 0:
         sentences.append(sentence)
-        spans.append({'begin':begin, 'end':tokens[-1].lexpos})
+        spans.append({'begin':begin, 'end':tokens[-1].lexpos + len(tokens[-1].value)})
 
     return sentences, spans
 
 
+# Fast path of the lexer: its master regex (the same rules in the same order) run with re.finditer, the sentences
+# are made of the matched strings without a LexToken for every token. The ignored characters and the newlines
+# are matched too and dropped, the characters that match no rule are skipped without the message of t_error.
+# The master regex is preceded by shortcuts for the most common tokens: a whole run of letters, of digits or of
+# dots followed by a character with which none of the rules before WORD, NUMBER and PUNCTUATION_EOS can match
+# (e.g. URL, EMAIL or ABBREVIATION_ACRONYM), and the punctuation that only PUNCTUATION matches, so they give the
+# same tokens without trying those rules first.
+FAST_RULES = (
+    r'(?P<ignore>[%s]+)' % re.escape(lexer.lexignore),
+    r'(?P<fast_WORD>[^\W\d_]+(?![\w@:."\-]))',
+    r'(?P<fast_NUMBER>\d+(?![\w@:.,/\\\-]))',
+    r'(?P<fast_PUNCTUATION_EOS>\.+(?![\w.@\-]))',
+    r'(?P<fast_PUNCTUATION>[,:()\[\]{}/\'])',
+)
+fast_re = re.compile('|'.join(FAST_RULES + tuple(r.pattern for r, _ in lexer.lexre)), lexer.lexreflags)
+DISCARDED = ('ignore', 't_newline')
+EOS = ('t_PUNCTUATION_EOS', 'fast_PUNCTUATION_EOS')
+
+SPLITTERS = ('regex', 'ply')
+
+
+def fast_ssplit(text):
+    """Same sentences and spans as ssplit on the tokens of text, from the matches of fast_re."""
+    sentences = []
+    sentence = []
+    spans = []
+
+    begin = -1
+    lexend = -1
+
+    for m in fast_re.finditer(text):
+        kind = m.lastgroup
+        if kind in DISCARDED:
+            continue
+        if begin == -1:
+            begin = m.start()
+        sentence.append(m.group())
+        lexend = m.end()
+
+        if kind in EOS or len(sentence) >= 1000:
+            spans.append({'begin':begin, 'end':lexend})
+            sentences.append(sentence)
+            sentence = []
+            begin = -1
+
+    if len(sentence) > 0:
+        sentences.append(sentence)
+        spans.append({'begin':begin, 'end':lexend})
+
+    return sentences, spans
+
+
+def split_document(text, doc_lexer=None):
+    """Sentences (lists of token values) and spans of text, tokenized by doc_lexer (the global lexer by default)."""
+    doc_lexer = lexer if doc_lexer is None else doc_lexer
+    doc_lexer.input(text)
+    tokens = []
+    while True:
+        tok = doc_lexer.token()
+        if not tok:
+            break
+        tokens.append(tok)
+    return ssplit(tokens)
+
+
+# lexer of a worker of the pool, set by init_worker, None with the regex splitter
+worker_lexer = None
+
+
+def init_worker(splitter='regex'):
+    global worker_lexer
+    worker_lexer = lexer.clone() if splitter == 'ply' else None
+
+
+def split_rows(rows, joined=True):
+    """Sentences of the documents rows, a list of (doc_index, text), in their order.
+
+    Returns the lists doc_index, sent_index, begin and end (the span [begin, end) of the sentence in the text)
+    and, with joined, sentence, the tokens of the sentence separated by spaces.
+    """
+    columns = {'doc_index': [], 'sent_index': [], 'begin': [], 'end': [], 'sentence': []}
+    for doc_index, text in rows:
+        sentencez, spanz = fast_ssplit(text) if worker_lexer is None else split_document(text, worker_lexer)
+        for j, (words, span) in enumerate(zip(sentencez, spanz)):
+            columns['doc_index'].append(doc_index)
+            columns['sent_index'].append(j)
+            columns['begin'].append(span['begin'])
+            columns['end'].append(span['end'])
+            if joined:
+                columns['sentence'].append(" ".join(words))
+    return columns
+
+
+def iter_shards(ds_path, chunk_size, shard_size):
+    """Shards (DataFrames) of shard_size documents of the CSV ds_path, read chunk_size documents at a time."""
+    for chunk in pd.read_csv(ds_path, chunksize=chunk_size):
+        # the index of the chunks goes on from the previous one, it is the index of the document in the file
+        for start in range(0, len(chunk), shard_size):
+            yield chunk.iloc[start:start + shard_size]
+
+
+OUTPUT_FORMATS = ('index', 'csv')
+
+
+def split_csv(ds_path, output_path, num_workers=None, chunk_size=1000, shard_size=16, splitter='regex',
+              output_format='index', id_column=None):
+    """Split the documents of ds_path into sentences and save them at output_path, in the order of the documents.
+
+    With the index format the spans of the sentences are saved as a SentenceIndex (see sentence_index.py), with
+    the labels, the splits and the ids (the column id_column) of the documents; the texts stay in ds_path. With
+    the csv format every sentence is a row with its tokens separated by spaces, its label and its split.
+    The shards of documents are split by a pool of num_workers processes, each with its own lexer, and collected
+    as soon as all the previous ones are done: at most 2 shards per worker are in flight, so the memory does
+    not grow with the size of the dataset (beyond the int arrays of the index). splitter is regex (fast_ssplit)
+    or ply (the lexer tokens and ssplit), they give the same sentences.
+    """
+    if splitter not in SPLITTERS:
+        raise ValueError(f"Unknown splitter {splitter}, expected one of {SPLITTERS}")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}")
+    num_workers = num_workers or os.cpu_count()
+    joined = output_format == 'csv'
+    header = True
+    index_columns = {'doc_index': [], 'sent_index': [], 'begin': [], 'end': []}
+    doc_columns = {'label': [], 'split': []}
+    if id_column is not None:
+        doc_columns[id_column] = []
+    with Pool(num_workers, initializer=init_worker, initargs=(splitter,)) as pool, tqdm(unit='doc') as progress:
+        pending = deque()
+
+        def collect_next():
+            nonlocal header
+            result, shard = pending.popleft()
+            columns = result.get()
+            if joined:
+                sentences_df = pd.DataFrame({'doc_index': columns['doc_index'], 'sent_index': columns['sent_index'],
+                                             'sentence': columns['sentence'],
+                                             'label': shard.loc[columns['doc_index'], 'label'].to_numpy(),
+                                             'split': shard.loc[columns['doc_index'], 'split'].to_numpy()})
+                sentences_df.to_csv(output_path, mode='w' if header else 'a', header=header, index=False)
+                header = False
+            else:
+                for name, values in index_columns.items():
+                    values.append(np.asarray(columns[name], dtype=np.int32))
+                for name, values in doc_columns.items():
+                    if name in shard:
+                        values.extend(shard[name].tolist())
+            progress.update(len(shard))
+
+        for shard in iter_shards(ds_path, chunk_size, shard_size):
+            rows = list(zip(shard.index, shard['text']))
+            pending.append((pool.apply_async(split_rows, (rows, joined)), shard))
+            if len(pending) >= 2 * num_workers:
+                collect_next()
+        while pending:
+            collect_next()
+
+    if joined:
+        if header:
+            # no sentences at all, the file still gets its header
+            pd.DataFrame(columns=['doc_index', 'sent_index', 'sentence', 'label', 'split']).to_csv(output_path, index=False)
+        return
+
+    texts = pd.read_csv(ds_path, usecols=['text'])['text'].tolist()
+    index = SentenceIndex(texts, *[np.concatenate(index_columns[name] or [np.zeros(0, np.int32)])
+                                   for name in ('doc_index', 'sent_index', 'begin', 'end')],
+                          labels=doc_columns['label'] or None, splits=doc_columns['split'] or None,
+                          doc_ids=doc_columns.get(id_column) or None, texts_path=ds_path)
+    index.save(output_path)
+
+
 if __name__ == '__main__':
 
     parser = ArgumentParser(description='Compute dataset statistics')
@@ -146,38 +328,41 @@ if __name__ == '__main__':
         default="trainData/ILDC_multi_train_dev.csv", 
         required=False,
         type=str)
+    parser.add_argument('--num_workers',
+        help='Processes splitting the documents, all the cores by default',
+        default=None,
+        required=False,
+        type=int)
+    parser.add_argument('--chunk_size',
+        help='Documents read from the CSV at a time',
+        default=1000,
+        required=False,
+        type=int)
+    parser.add_argument('--shard_size',
+        help='Documents split by a worker in one task',
+        default=16,
+        required=False,
+        type=int)
+    parser.add_argument('--output_format',
+        help='index (spans of the sentences in the texts, .npz) or csv (one row per sentence)',
+        default='index',
+        required=False,
+        type=str)
+    parser.add_argument('--id_column',
+        help='Column of the ids of the documents, kept by the index',
+        default=None,
+        required=False,
+        type=str)
+    parser.add_argument('--splitter',
+        help='regex (fast path) or ply, they give the same sentences',
+        default='regex',
+        required=False,
+        type=str)
     args = parser.parse_args()
 
     ds_train_path = args.ds_train_path  # e.g., 'ILDC_single_train_dev.csv'
 
-    # read the dataset
-    train_df = pd.read_csv(ds_train_path)
-    
-    doc_indexes = []
-    sent_indexes = []
-    senetnces = []
-    labels = []
-    splits = []
-    for i, row in tqdm(train_df.iterrows(), total=len(train_df)):
-        
-        lexer.input(row['text'])
-        tokens = []
-        while True:
-            tok = lexer.token()
-            if not tok:
-                break
-            tokens.append(tok)
-        sentencez, spanz = ssplit(tokens)
-        sents = [" ".join(words) for words in sentencez]
-        for j, sent in enumerate(sents):
-            doc_indexes.append(i)
-            sent_indexes.append(j)
-            senetnces.append(sent)
-            labels.append(row['label'])
-            splits.append(row['split'])
-
-    new_df = pd.DataFrame({'doc_index': doc_indexes, 'sent_index': sent_indexes, 'sentence': senetnces, 'label': labels, 'split': splits})
-    new_df.to_csv(ds_train_path.split(".")[0]+'_sentences.csv', index=False)
-
-
-    
\ No newline at end of file
+    extension = '.npz' if args.output_format == 'index' else '.csv'
+    split_csv(ds_train_path, ds_train_path.split(".")[0]+'_sentences'+extension, num_workers=args.num_workers,
+              chunk_size=args.chunk_size, shard_size=args.shard_size, splitter=args.splitter,
+              output_format=args.output_format, id_column=args.id_column)
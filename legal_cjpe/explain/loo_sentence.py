@@ -9,7 +9,6 @@ import numpy as np
 def classify_instance(model, embeddings, attention_masks, device):
     embeddings = embeddings.to(device).unsqueeze(0)
     attention_masks = attention_masks.to(device).unsqueeze(0)
-    attention_masks = attention_masks.transpose(1, 0)
     output = model(embeddings, attention_masks)
     return output
 
@@ -53,7 +52,6 @@ class LeaveOneOutSentenceExplainer(BaseExplainer):
 
         masked_embeddings = masked_embeddings.to(device)
         attention_masks_masking = attention_masks_masking.to(device)
-        attention_masks_masking = attention_masks_masking.transpose(1, 0)
         masked_output = self.model(masked_embeddings, attention_masks_masking)
 
         # TODO - Normalize for sentence size?
@@ -1,6 +1,5 @@
 from ferret.explainers import BaseExplainer
 from ferret.explainers.explanation import Explanation
-from explain.utils_batching import *
 
 import torch
 
@@ -8,11 +7,9 @@ import numpy as np
 
 
 def classify_instance(model, embeddings, attention_masks, device):
-    embeddings = embeddings.to(device)
-    attention_masks = attention_masks.to(device)
-    e = embeddings.unsqueeze(0).repeat(256, 1, 1)
-    a = attention_masks.unsqueeze(0).repeat(256, 1)
-    output = model(e, a)
+    embeddings = embeddings.to(device).unsqueeze(0)
+    attention_masks = attention_masks.to(device).unsqueeze(0)
+    output = model(embeddings, attention_masks)
     output = output[0]
     return output
 
@@ -56,16 +53,8 @@ class LeaveOneOutSentenceExplainer(BaseExplainer):
 
         masked_embeddings = masked_embeddings.to(device)
         attention_masks_masking = attention_masks_masking.to(device)
-        attention_masks_masking = attention_masks_masking
 
-        masked_embeddings_extended = extend_embeddings(masked_embeddings)
-        attention_masks_masking_extended = extend_attention_masks(
-            attention_masks_masking
-        ).transpose(1, 0)
-
-        masked_output = self.model(
-            masked_embeddings_extended, attention_masks_masking_extended
-        )[: masked_embeddings.shape[0]]
+        masked_output = self.model(masked_embeddings, attention_masks_masking)
 
         # TODO - Normalize for sentence size?
         # input_len = int(attention_masks.sum().item())
@@ -1,5 +1,4 @@
 from captum.attr import Saliency, InputXGradient
-from explain.utils_batching import *
 
 from ferret.explainers import BaseExplainer
 from ferret.explainers.explanation import Explanation
@@ -28,13 +27,7 @@ class GradientSentenceExplainer(BaseExplainer):
         # TODO reshape input embeds
 
         def func(input_embeds):
-            embeddings_extended = extend_embeddings(input_embeds)
-            attention_masks_extended = extend_attention_masks(
-                attention_masks
-            ).transpose(1, 0)
-            output = self.model(
-                embeddings_extended, attention_masks_extended.transpose(1, 0)
-            )
+            output = self.model(input_embeds, attention_masks)
             scores = output[0]
             return scores.unsqueeze(0)
 
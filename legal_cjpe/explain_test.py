@@ -69,9 +69,10 @@ if __name__ == "__main__":
 
     lr = "_5e-05"
 
-    embd = np.load(
-        os.path.join(input_data_dir, f"{type_mod}_test_embeddings_explain.npy"),
-        allow_pickle=True,
+    from code.embedding_store import RaggedEmbeddings
+
+    embd = RaggedEmbeddings.load(
+        os.path.join(input_data_dir, f"{type_mod}_test_embeddings_explain")
     )
     from architecture.second_level_model import SecondLevelModel
 
@@ -81,7 +82,7 @@ if __name__ == "__main__":
 
     # Create model
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    embedding_size = torch.from_numpy(embd[0]).shape[1]
+    embedding_size = embd.embedding_size
     model = SecondLevelModel(
         d_model=embedding_size,
         d_hid=embedding_size,
@@ -101,7 +102,7 @@ if __name__ == "__main__":
 
     data_ds = LJPESecondLevelClassificationDataset(
         embd,
-        np.array([1] * embd.shape[0]),
+        np.array([1] * len(embd)),
         strategy=strategy,
         max_sentences=max_sentences,
     )
@@ -110,29 +111,24 @@ if __name__ == "__main__":
         data_ds, batch_size=256, shuffle=False, num_workers=16, pin_memory=True
     )
     #
-    ds_path_sentences = os.path.join(input_data_dir, "public_data_sentences.csv")
-    df_sentences = pd.read_csv(ds_path_sentences)
+    # sentence index of sentence_splitter.py built with --id_column doc_ids, the sentences of a document are
+    # slices of its text
+    from code.sentence_index import SentenceIndex
+
+    sentence_index = SentenceIndex.load(os.path.join(input_data_dir, "public_data_sentences.npz"))
     with open(
         os.path.join(input_data_dir, "multi_test_doc_ids_explain.txt"), "r"
     ) as fp:
         docs_id = fp.read().splitlines()
 
-    from explain.utils_batching import extend_embeddings, extend_attention_masks
-
     predicted_classes = []
 
     for batch in ds_dataloader:
         embeddings, attention_masks, labels = batch
-        embeddings_extended = extend_embeddings(embeddings.to(device))
+        embeddings = embeddings.to(device)
         attention_masks = attention_masks.to(device)
-        attention_masks_extended = extend_attention_masks(attention_masks).transpose(
-            1, 0
-        )
-        output = model(embeddings_extended, attention_masks_extended)[
-            : embeddings.shape[0]
-        ]
+        output = model(embeddings, attention_masks)
         predicted_classes.extend((output.squeeze(1) > 0.5).int().cpu().detach().numpy())
-        break
 
     # LOO
 
@@ -144,9 +140,7 @@ if __name__ == "__main__":
 
         embeddings, attention_masks, labels = data_ds[i]
         doc_id = docs_id[i]
-        sentences = list(
-            df_sentences.loc[df_sentences["doc_ids"] == doc_id].sentence.values
-        )
+        sentences = sentence_index.sentences_of(doc_id)
 
         target_class = predicted_classes[i]
         LOOE = LeaveOneOutSentenceExplainer(model, None)
@@ -167,9 +161,7 @@ if __name__ == "__main__":
     for i in tqdm(range(0, len(data_ds))):
         embeddings, attention_masks, labels = data_ds[i]
         doc_id = docs_id[i]
-        sentences = list(
-            df_sentences.loc[df_sentences["doc_ids"] == doc_id].sentence.values
-        )
+        sentences = sentence_index.sentences_of(doc_id)
         embeddings = embeddings.to(device).unsqueeze(0)
         attention_masks = attention_masks.to(device).unsqueeze(0)
 
@@ -255,9 +247,7 @@ if __name__ == "__main__":
 
         embeddings, attention_masks, labels = data_ds[i]
         doc_id = docs_id[i]
-        sentences = list(
-            df_sentences.loc[df_sentences["doc_ids"] == doc_id].sentence.values
-        )
+        sentences = sentence_index.sentences_of(doc_id)
         exp_ner = ner_explainer.compute_feature_importance(sentences)
         ner_explanations.append(exp_ner)
 
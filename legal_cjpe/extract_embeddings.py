@@ -0,0 +1,109 @@
+"""Sentence embeddings of the documents of a sentences CSV or sentence index, every document encoded once.
+Example:
+python extract_embeddings.py --sentences trainData/ILDC_single_train_dev_sentences.npz --split dev \
+    --sentence_encoder_path results/legal-bert-base-uncased_last_single --output trainData/single_dev
+
+The embeddings are saved in shards in <output>_shards while they are computed, so an interrupted run
+started again with the same arguments computes only the missing shards. At the end the ragged store
+<output>_embeddings (see code/embedding_store.py), <output>_doc_ids.txt and, if the documents have labels,
+<output>_labels.npy are written.
+"""
+
+import os
+import torch
+import numpy as np
+from argparse import ArgumentParser
+
+from code.embedding_store import RaggedEmbeddings
+from code.sentence_embeddings import SentenceDataset, extract_embeddings, load_sentence_encoder
+
+
+def add_extraction_args(parser):
+    """Arguments of the encoder and of the extraction, shared by the extraction scripts."""
+    parser.add_argument('--tokenizer_path', 
+        help='HF model name', 
+        default="roberta-base", 
+        required=False, 
+        type=str)
+    parser.add_argument('--sentence_encoder_path', 
+        help='HF model name', 
+        default="roberta-base", 
+        required=False, 
+        type=str)
+    parser.add_argument('--strategy',
+        help='Sentences kept from the documents longer than max_sentences',
+        default="last",
+        choices=["first", "last"],
+        required=False,
+        type=str)
+    parser.add_argument('--max_sentences',
+        help='Max number of sentences of a document',
+        default=256,
+        required=False,
+        type=int)
+    parser.add_argument('--max_tokens',
+        help='Tokens of a batch of sentences, padding included',
+        default=16384,
+        required=False,
+        type=int)
+    parser.add_argument('--docs_per_batch',
+        help='Documents whose sentences are sorted by length and batched together',
+        default=64,
+        required=False,
+        type=int)
+    parser.add_argument('--docs_per_shard',
+        help='Documents of a shard of the store, the unit of work saved and resumed',
+        default=1024,
+        required=False,
+        type=int)
+    parser.add_argument('--dtype',
+        help='Type of the saved embeddings',
+        default="float16",
+        choices=["float16", "float32"],
+        required=False,
+        type=str)
+    return parser
+
+
+def encoder_from_args(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return load_sentence_encoder(args.tokenizer_path, args.sentence_encoder_path, device, max_tokens=args.max_tokens)
+
+
+def run_extraction(args, sentence_encoder, sentences, split, store_dir):
+    """Embeddings, keys and labels of the documents of split of the file sentences, stored in store_dir."""
+    dataset = SentenceDataset(sentences, split=split, strategy=args.strategy, max_sentences=args.max_sentences)
+    meta = {'sentences': os.path.abspath(sentences), 'split': split, 'strategy': args.strategy,
+            'max_sentences': args.max_sentences, 'tokenizer': args.tokenizer_path,
+            'sentence_encoder': args.sentence_encoder_path}
+    return extract_embeddings(dataset, sentence_encoder, store_dir, meta, docs_per_shard=args.docs_per_shard,
+                              docs_per_batch=args.docs_per_batch, source=sentences)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description='Extraction of the sentence embeddings')
+    parser.add_argument('--sentences', 
+        help='Sentences CSV or sentence index (.npz) of sentence_splitter.py', 
+        required=True,
+        type=str)
+    parser.add_argument('--split', 
+        help='Split of the documents, all the documents if not given', 
+        default=None, 
+        required=False,
+        type=str)
+    parser.add_argument('--output', 
+        help='Prefix of the output files', 
+        required=True,
+        type=str)
+    args = add_extraction_args(parser).parse_args()
+
+    embeddings, keys, labels = run_extraction(args, encoder_from_args(args), args.sentences, args.split,
+                                             args.output + "_shards")
+
+    RaggedEmbeddings.save(args.output + "_embeddings", embeddings, dtype=np.dtype(args.dtype))
+    if all(label is not None for label in labels):
+        np.save(args.output + "_labels.npy", np.array([[label] for label in labels]))
+    with open(args.output + "_doc_ids.txt", "w") as f:
+        for key in keys:
+            f.write(str(key) + "\n")
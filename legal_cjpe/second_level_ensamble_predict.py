@@ -3,7 +3,8 @@ python second_level_train.py --data_type single --strategy last --max_sentences
 '''
 
 import json
-from code.second_level_dataset import LJPESecondLevelClassificationDataset
+from code.second_level_dataset import LJPESecondLevelClassificationDataset, collate_documents
+from code.embedding_store import RaggedEmbeddings
 from argparse import ArgumentParser
 from torch.utils.data import DataLoader
 from architecture.second_level_model import SecondLevelModel
@@ -46,26 +47,26 @@ if __name__ == "__main__":
     config = json.load(open(args.config))
 
     # Load data
-    single_test_embeddings = np.load(os.path.join("testData", "predict", "single_test_embeddings.npy"), allow_pickle=True)
+    single_test_embeddings = RaggedEmbeddings.load(os.path.join("testData", "predict", "single_test_embeddings"))
     with open(os.path.join("testData", "predict", "single_test_doc_ids.txt"), "r") as f:
         test_ids = f.readlines()
     single_test_ids = [line.split(".")[0] for line in test_ids]
-    multi_test_embeddings = np.load(os.path.join("testData", "predict", "multi_test_embeddings.npy"), allow_pickle=True)
+    multi_test_embeddings = RaggedEmbeddings.load(os.path.join("testData", "predict", "multi_test_embeddings"))
     with open(os.path.join("testData", "predict", "multi_test_doc_ids.txt"), "r") as f:
         test_ids = f.readlines()
     multi_test_ids = [line.split(".")[0] for line in test_ids]
 
     # Create dataloaders
-    single_test_ds = LJPESecondLevelClassificationDataset(single_test_embeddings, np.array([1]*len(single_test_embeddings)), max_sentences=max_sentences, strategy=strategy)
-    single_test_dataloader = DataLoader(single_test_ds, batch_size=config['BATCH_SIZE'], shuffle=False, num_workers=16, pin_memory=True)
-    multi_test_ds = LJPESecondLevelClassificationDataset(multi_test_embeddings, np.array([1]*len(multi_test_embeddings)), max_sentences=max_sentences, strategy=strategy)
-    multi_test_dataloader = DataLoader(multi_test_ds, batch_size=config['BATCH_SIZE'], shuffle=False, num_workers=16, pin_memory=True)
+    single_test_ds = LJPESecondLevelClassificationDataset(single_test_embeddings, np.array([1]*len(single_test_embeddings)), max_sentences=max_sentences, strategy=strategy, pad=False)
+    single_test_dataloader = DataLoader(single_test_ds, batch_size=config['BATCH_SIZE'], shuffle=False, collate_fn=collate_documents, num_workers=16, pin_memory=True)
+    multi_test_ds = LJPESecondLevelClassificationDataset(multi_test_embeddings, np.array([1]*len(multi_test_embeddings)), max_sentences=max_sentences, strategy=strategy, pad=False)
+    multi_test_dataloader = DataLoader(multi_test_ds, batch_size=config['BATCH_SIZE'], shuffle=False, collate_fn=collate_documents, num_workers=16, pin_memory=True)
 
     # Create model
     #device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     device = torch.device("cpu")
-    single_embedding_size = single_test_embeddings[0].shape[1]
-    multi_embedding_size = multi_test_embeddings[0].shape[1]
+    single_embedding_size = single_test_embeddings.embedding_size
+    multi_embedding_size = multi_test_embeddings.embedding_size
     checkpoint_folder_list = [
         #"second_level_results/second_level_train_single_last_2_3_5e-05",
         #"second_level_results/NEW_second_level_train_single_last_2_5_5e-05",
@@ -100,7 +101,6 @@ if __name__ == "__main__":
                 embeddings, attention_masks, labels = batch
                 embeddings = embeddings.to(device)
                 attention_masks = attention_masks.to(device)
-                attention_masks = attention_masks.transpose(1, 0)
                 output = model(embeddings, attention_masks)
                 predicted.extend(output.cpu().detach().numpy())
         predicted = np.array(predicted)
@@ -3,7 +3,8 @@ python second_level_train.py --data_type single --strategy last --max_sentences
 '''
 
 import json
-from code.second_level_dataset import LJPESecondLevelClassificationDataset
+from code.second_level_dataset import LJPESecondLevelClassificationDataset, collate_documents
+from code.embedding_store import RaggedEmbeddings
 from argparse import ArgumentParser
 from torch.utils.data import DataLoader
 from architecture.second_level_model import SecondLevelModel
@@ -66,20 +67,20 @@ if __name__ == "__main__":
     config = json.load(open(args.config))
 
     # Load data
-    test_embeddings = np.load(os.path.join("testData", "predict", data_type+"_test_embeddings.npy"), allow_pickle=True)
+    test_embeddings = RaggedEmbeddings.load(os.path.join("testData", "predict", data_type+"_test_embeddings"))
     with open(os.path.join("testData", "predict", data_type+"_test_doc_ids.txt"), "r") as f:
         test_ids = f.readlines()
     test_ids = [line.split(".")[0] for line in test_ids]
 
     # Create dataloaders
-    test_ds = LJPESecondLevelClassificationDataset(test_embeddings, np.array([1]*len(test_embeddings)), max_sentences=max_sentences, strategy=strategy)
-    test_dataloader = DataLoader(test_ds, batch_size=config['BATCH_SIZE'], shuffle=False, num_workers=16, pin_memory=True)
+    test_ds = LJPESecondLevelClassificationDataset(test_embeddings, np.array([1]*len(test_embeddings)), max_sentences=max_sentences, strategy=strategy, pad=False)
+    test_dataloader = DataLoader(test_ds, batch_size=config['BATCH_SIZE'], shuffle=False, collate_fn=collate_documents, num_workers=16, pin_memory=True)
     #test_dataloader = DataLoader(test_ds, batch_size=8, shuffle=False, num_workers=16, pin_memory=True)
 
     # Create model
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     device = torch.device("cpu")
-    embedding_size = test_embeddings[0].shape[1]
+    embedding_size = test_embeddings.embedding_size
     checkpoint = torch.load(os.path.join(checkpoint_folder, "model.pt"))
     model = SecondLevelModel(d_model=embedding_size, d_hid=embedding_size, nhead=4, nlayers=attention_layers, dropout=0, mlp_layers=mlp_layers)
     model.load_state_dict(checkpoint)
@@ -92,29 +93,8 @@ if __name__ == "__main__":
         for batch in tqdm(test_dataloader):
             embeddings, attention_masks, labels = batch
 
-            #################
-
-            e = embeddings[0, :, :]
-            e = e.unsqueeze(0).repeat(64, 1, 1)
-            print(e)
-            print(e.shape)
-
-            a = attention_masks[0, :]
-            a = a.unsqueeze(0).repeat(64, 1)
-            a = a.transpose(1, 0)
-            print(a.shape)
-
-            output = model(e, a)
-            print(output)
-
-            exit()
-
-            #################
-
-
             embeddings = embeddings.to(device)
             attention_masks = attention_masks.to(device)
-            attention_masks = attention_masks.transpose(1, 0)
             output = model(embeddings, attention_masks)
             predicted.extend(output.cpu().detach().numpy())
 
@@ -3,7 +3,8 @@ python second_level_train.py --data_type single --strategy last --max_sentences
 '''
 
 import json
-from code.second_level_dataset import LJPESecondLevelClassificationDataset
+from code.second_level_dataset import LJPESecondLevelClassificationDataset, collate_documents, LengthBucketSampler
+from code.embedding_store import RaggedEmbeddings
 from argparse import ArgumentParser
 from torch.utils.data import DataLoader
 from architecture.second_level_model import SecondLevelModel
@@ -65,20 +66,22 @@ if __name__ == "__main__":
     config = json.load(open(args.config))
 
     # Load data
-    train_embeddings = np.load(os.path.join("trainData", data_type + "_embeddings_train.npy"), allow_pickle=True)
-    train_labels = np.load(os.path.join("trainData", data_type + "_labels_train.npy"), allow_pickle=True)
-    val_embeddings = np.load(os.path.join("trainData", data_type + "_embeddings_val.npy"), allow_pickle=True)
-    val_labels = np.load(os.path.join("trainData", data_type + "_labels_val.npy"), allow_pickle=True)
+    train_embeddings = RaggedEmbeddings.load(os.path.join("trainData", data_type + "_embeddings_train"))
+    train_labels = np.load(os.path.join("trainData", data_type + "_labels_train.npy"))
+    val_embeddings = RaggedEmbeddings.load(os.path.join("trainData", data_type + "_embeddings_val"))
+    val_labels = np.load(os.path.join("trainData", data_type + "_labels_val.npy"))
     
     # Create dataloaders
-    train_ds = LJPESecondLevelClassificationDataset(train_embeddings, train_labels, strategy=strategy, max_sentences=max_sentences)
-    train_dataloader = DataLoader(train_ds, batch_size=config['BATCH_SIZE'], shuffle=True, num_workers=16, pin_memory=True) 
-    valid_ds = LJPESecondLevelClassificationDataset(val_embeddings, val_labels)
-    valid_dataloader = DataLoader(valid_ds, batch_size=config['BATCH_SIZE'], shuffle=False, num_workers=16, pin_memory=True)
+    # the documents are padded to the longest one of their batch, batched with documents of similar lengths
+    train_ds = LJPESecondLevelClassificationDataset(train_embeddings, train_labels, strategy=strategy, max_sentences=max_sentences, pad=False)
+    train_sampler = LengthBucketSampler(train_ds.lengths(), config['BATCH_SIZE'])
+    train_dataloader = DataLoader(train_ds, batch_sampler=train_sampler, collate_fn=collate_documents, num_workers=16, pin_memory=True) 
+    valid_ds = LJPESecondLevelClassificationDataset(val_embeddings, val_labels, pad=False)
+    valid_dataloader = DataLoader(valid_ds, batch_size=config['BATCH_SIZE'], shuffle=False, collate_fn=collate_documents, num_workers=16, pin_memory=True)
 
     # Create model
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    embedding_size = torch.from_numpy(train_embeddings[0]).shape[1]
+    embedding_size = train_embeddings.embedding_size
     model = SecondLevelModel(d_model=embedding_size, d_hid=embedding_size, nhead=4, nlayers=attention_layers, dropout=0.25, mlp_layers=mlp_layers)
     model.to(device)
     optimizer = torch.optim.AdamW(model.parameters(), lr=config['LR'])
@@ -107,7 +110,6 @@ if __name__ == "__main__":
             embeddings, attention_masks, labels = batch
             embeddings = embeddings.to(device)
             attention_masks = attention_masks.to(device)
-            attention_masks = attention_masks.transpose(1, 0)
             output = model(embeddings, attention_masks)
             predicted.extend(output.cpu().detach().numpy())
             gt.extend(labels.cpu().detach().numpy())
@@ -141,7 +143,6 @@ if __name__ == "__main__":
                 embeddings, attention_masks, labels = batch
                 embeddings = embeddings.to(device)
                 attention_masks = attention_masks.to(device)
-                attention_masks = attention_masks.transpose(1, 0)
                 output = model(embeddings, attention_masks)
                 predicted.extend(output.cpu().detach().numpy())
                 gt.extend(labels.cpu().detach().numpy())
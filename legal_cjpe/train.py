@@ -51,6 +51,11 @@ if __name__ == "__main__":
         choices=["first", "last", "sentences"],
         required=False,
         type=str)
+    parser.add_argument('--cache_dir',
+        help='Directory where the token windows are saved once and reused, tokenized at every access if not given',
+        default=None,
+        required=False,
+        type=str)
   
     args = parser.parse_args()
 
@@ -61,8 +66,8 @@ if __name__ == "__main__":
     strategy = args.strategy            # e.g., 'first'
     config = json.load(open(args.config))
     
-    train_ds = LJPEClassificationDataset(ds_train_path, model_path, split="train", strategy=strategy)
-    dev_ds = LJPEClassificationDataset(ds_valid_path, model_path, split="dev", strategy=strategy)
+    train_ds = LJPEClassificationDataset(ds_train_path, model_path, split="train", strategy=strategy, cache_dir=args.cache_dir)
+    dev_ds = LJPEClassificationDataset(ds_valid_path, model_path, split="dev", strategy=strategy, cache_dir=args.cache_dir)
     model = AutoModelForSequenceClassification.from_pretrained(model_path, num_labels=2)
     
     if "single" in ds_train_path:
@@ -0,0 +1,270 @@
+"""Micro-benchmarks of the components of AdaptiveModule on synthetic embeddings.
+
+Every component runs in its own process, so that its peak RSS is not hidden by the previous ones:
+
+    python3 domain_adaptation/benchmarks/bench_adaptive_module.py --tokens 4096 --dim 1024 --output bench.json
+
+Forward and backward are timed separately (median over --repeat steps) and reported as tokens/s, the
+host memory allocated by the operators of one step is measured with torch.profiler and the Python heap
+peak with tracemalloc. The peak RSS growth is the increase of the peak RSS over the one after the setup.
+Two result files, e.g. of two commits, are compared with
+
+    python3 domain_adaptation/benchmarks/bench_adaptive_module.py --compare before.json after.json
+
+which flags every throughput drop or memory growth above --threshold and exits with 1 if there is any.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import torch
+import torch.nn.functional as F
+
+DOMAIN_ADAPTATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = ('task', 'domain_classifier', 'windows', 'game', 'compute_loss', 'adaptive_module')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the domain adaptation model")
+    parser.add_argument("--tokens", help="Tokens per batch", type=int, default=4096)
+    parser.add_argument("--dim", help="Dimension of the embeddings", type=int, default=1024)
+    parser.add_argument("--num_classes", type=int, default=29)
+    parser.add_argument("--window_size", type=int, default=2)
+    parser.add_argument("--repeat", help="Timed steps of each case", type=int, default=20)
+    parser.add_argument("--warmup", help="Untimed steps before the timed ones", type=int, default=3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--cases", help="Comma separated cases to run", default=",".join(CASES), type=str)
+    parser.add_argument("--case", help=argparse.SUPPRESS, default=None, type=str)
+    parser.add_argument("--output", help="JSON file where the results are saved", default=None, type=str)
+    parser.add_argument("--compare", help="Compare two result files instead of running", nargs=2, default=None)
+    parser.add_argument("--threshold", help="Relative change flagged as a regression", type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+def build_config(bench_args):
+    """Model configuration: the defaults of utils/args.py with the sizes of the benchmark."""
+    sys.path.insert(0, DOMAIN_ADAPTATION_DIR)
+    from utils.args import get_args
+    from omegaconf import OmegaConf
+    return OmegaConf.merge(vars(get_args([])), {
+        'in_features_dim': bench_args.dim,
+        'num_classes_source': bench_args.num_classes,
+        'num_classes_target': bench_args.num_classes,
+        'window_size': bench_args.window_size,
+        'total_batch': bench_args.tokens,
+        'batch_size': bench_args.tokens,
+    })
+
+
+def make_case(name, cfg, bench_args, device):
+    """Return (prepare, forward, backward) of a case, only forward and backward are timed."""
+    from domain_adaptation_ner import AdaptiveModule, DomainAdaptationNER, make_windows
+
+    n, dim, ws, classes = bench_args.tokens, bench_args.dim, bench_args.window_size, bench_args.num_classes
+    x = torch.randn(n, dim, device=device)
+    labels = torch.randint(0, classes, (n,), device=device)
+
+    def backward(loss):
+        loss.backward()
+
+    if name == 'task':
+        module = AdaptiveModule.TaskModule(cfg.num_fcl, dim, dim, dropout=cfg.dropout).to(device)
+        return (lambda: x), (lambda inputs: module(inputs).sum()), backward
+
+    if name == 'domain_classifier':
+        module = AdaptiveModule.DomainClassifier(dim, cfg.beta_token).to(device)
+        domains = torch.randint(0, 2, (n,), device=device)
+        # the input requires grad, so that the gradient reversal is part of the backward
+        return (lambda: x.clone().requires_grad_()), (lambda inputs: F.cross_entropy(module(inputs), domains)), backward
+
+    if name == 'windows':
+        module = AdaptiveModule.FullyConnectedLayer(ws * dim, dim).to(device)
+        return (lambda: x.clone().requires_grad_()), (lambda inputs: module(make_windows(inputs, ws)).sum()), backward
+
+    if name == 'game':
+        module = AdaptiveModule.GameModule(dim, ws, classes).to(device)
+        window_labels = make_windows(labels, ws).float()
+        return (lambda: x.clone().requires_grad_()), (lambda inputs: module.play(inputs, window_labels).sum()), backward
+
+    model = DomainAdaptationNER(cfg)
+    model.load_on_gpu(device)
+    model.train(True)
+
+    def model_backward(_):
+        model.backward()
+        model.zero_grad()
+        model.reset_loss()
+
+    if name == 'compute_loss':
+        def prepare():
+            return model(x, x, labels, labels)
+        return prepare, (lambda output: model.compute_loss(labels, labels, output)), model_backward
+
+    if name == 'adaptive_module':
+        def forward(_):
+            model.compute_loss(labels, labels, model(x, x, labels, labels))
+        return (lambda: None), forward, model_backward
+
+    raise ValueError(f"Unknown case {name}, expected one of {CASES}")
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run_case(name, bench_args):
+    device = torch.device(bench_args.device)
+    torch.manual_seed(0)
+    cfg = build_config(bench_args)
+    prepare, forward, backward = make_case(name, cfg, bench_args, device)
+
+    def step():
+        inputs = prepare()
+        synchronize(device)
+        start = time.perf_counter()
+        out = forward(inputs)
+        synchronize(device)
+        middle = time.perf_counter()
+        backward(out)
+        synchronize(device)
+        return middle - start, time.perf_counter() - middle
+
+    # ru_maxrss is in KB on Linux
+    setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for _ in range(bench_args.warmup):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    times = [step() for _ in range(bench_args.repeat)]
+    forward_s = statistics.median(t[0] for t in times)
+    backward_s = statistics.median(t[1] for t in times)
+
+    # allocations and Python heap are measured on separate steps, their bookkeeping would distort the timings
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        step()
+    allocations = [e.self_cpu_memory_usage for e in prof.events() if e.name != '[memory]' and e.self_cpu_memory_usage > 0]
+    tracemalloc.start()
+    step()
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        'forward_ms': 1000 * forward_s,
+        'backward_ms': 1000 * backward_s,
+        'forward_tokens_per_s': bench_args.tokens / forward_s,
+        'backward_tokens_per_s': bench_args.tokens / backward_s,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_rss_growth_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - setup_rss) / 1024,
+        'allocating_ops_per_step': len(allocations),
+        'allocated_mb_per_step': sum(allocations) / 2 ** 20,
+        'python_peak_mb': python_peak / 2 ** 20,
+    }
+    if device.type == 'cuda':
+        result['cuda_peak_mb'] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DOMAIN_ADAPTATION_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(bench_args):
+    results = {}
+    for name in bench_args.cases.split(','):
+        command = [sys.executable, os.path.abspath(__file__), '--case', name,
+                   '--tokens', str(bench_args.tokens), '--dim', str(bench_args.dim),
+                   '--num_classes', str(bench_args.num_classes), '--window_size', str(bench_args.window_size),
+                   '--repeat', str(bench_args.repeat), '--warmup', str(bench_args.warmup), '--device', bench_args.device]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"Benchmark {name} failed:\n{completed.stderr}")
+        results[name] = json.loads(completed.stdout.strip().splitlines()[-1])
+        print("{:<18} forward {:>12,.0f} tok/s  backward {:>12,.0f} tok/s  peak RSS {:>8.1f} MB  {:>8.1f} MB allocated/step".format(
+            name, results[name]['forward_tokens_per_s'], results[name]['backward_tokens_per_s'],
+            results[name]['peak_rss_mb'], results[name]['allocated_mb_per_step']))
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'torch': torch.__version__,
+            'device': bench_args.device,
+            'threads': torch.get_num_threads(),
+            'tokens': bench_args.tokens,
+            'dim': bench_args.dim,
+            'num_classes': bench_args.num_classes,
+            'window_size': bench_args.window_size,
+            'repeat': bench_args.repeat,
+        },
+        'results': results,
+    }
+
+
+# metric -> True if higher is better
+COMPARED_METRICS = {
+    'forward_tokens_per_s': True,
+    'backward_tokens_per_s': True,
+    'peak_rss_mb': False,
+    'peak_rss_growth_mb': False,
+    'allocated_mb_per_step': False,
+    'allocating_ops_per_step': False,
+}
+
+
+def compare(before, after, threshold):
+    """Print the relative change of every metric and return the list of regressions."""
+    for key in ('tokens', 'dim', 'device'):
+        if before['meta'].get(key) != after['meta'].get(key):
+            print(f"Warning: the runs differ in {key}: {before['meta'].get(key)} vs {after['meta'].get(key)}")
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}")
+
+    regressions = []
+    for name in before['results']:
+        if name not in after['results']:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = before['results'][name][metric], after['results'][name][metric]
+            change = (new - old) / old if old else 0.0
+            regression = change < -threshold if higher_is_better else change > threshold
+            if regression:
+                regressions.append((name, metric, change))
+            print("{:<18} {:<24} {:>14.2f} {:>14.2f} {:>+8.1%}{}".format(
+                name, metric, old, new, change, '  REGRESSION' if regression else ''))
+    return regressions
+
+
+def main():
+    bench_args = parse_args()
+
+    if bench_args.compare is not None:
+        with open(bench_args.compare[0]) as f:
+            before = json.load(f)
+        with open(bench_args.compare[1]) as f:
+            after = json.load(f)
+        regressions = compare(before, after, bench_args.threshold)
+        print(f"{len(regressions)} regression(s) over {bench_args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+    if bench_args.case is not None:
+        print(json.dumps(run_case(bench_args.case, bench_args)))
+        return
+
+    report = run_all(bench_args)
+    if bench_args.output is not None:
+        with open(bench_args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
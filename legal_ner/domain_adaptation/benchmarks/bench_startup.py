@@ -0,0 +1,142 @@
+"""Startup time of the modules and entry points of legal_ner.
+
+Every target runs --repeat times in a fresh interpreter, the median wall time is reported together with
+the modules that take longest to import (from python -X importtime):
+
+    python3 domain_adaptation/benchmarks/bench_startup.py --output startup.json
+    python3 domain_adaptation/benchmarks/bench_startup.py --compare before.json after.json
+
+The comparison flags the targets slower by more than --threshold and exits with 1 if there is any.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DOMAIN_ADAPTATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LEGAL_NER_DIR = os.path.dirname(DOMAIN_ADAPTATION_DIR)
+
+# name -> arguments of the interpreter
+TARGETS = {
+    'import utils.args': ['-c', 'import utils.args'],
+    'import utils.logger': ['-c', 'import utils.logger'],
+    'import embeddingsDataLoader': ['-c', 'import embeddingsDataLoader'],
+    'import domain_adaptation_ner': ['-c', 'import domain_adaptation_ner'],
+    'import trainer': ['-c', 'import trainer'],
+    'import utils.dataset': ['-c', 'import utils.dataset'],
+    'train.py --help': [os.path.join(DOMAIN_ADAPTATION_DIR, 'train.py'), '--help'],
+    'main.py --help': [os.path.join(LEGAL_NER_DIR, 'main.py'), '--help'],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Startup time of the legal_ner modules and entry points")
+    parser.add_argument("--repeat", help="Runs of each target", type=int, default=5)
+    parser.add_argument("--top", help="Slowest imports reported for each target", type=int, default=5)
+    parser.add_argument("--output", help="JSON file where the results are saved", default=None, type=str)
+    parser.add_argument("--compare", help="Compare two result files instead of running", nargs=2, default=None)
+    parser.add_argument("--threshold", help="Relative slowdown flagged as a regression", type=float, default=0.1)
+    return parser.parse_args()
+
+
+def run_target(arguments, env):
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable] + arguments, capture_output=True, text=True, env=env,
+                               cwd=DOMAIN_ADAPTATION_DIR)
+    elapsed = time.perf_counter() - start
+    return elapsed, completed
+
+
+def slowest_imports(arguments, env, top):
+    """Modules imported by the target with the largest cumulative import time (s), from -X importtime."""
+    completed = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, capture_output=True, text=True,
+                               env=env, cwd=DOMAIN_ADAPTATION_DIR)
+    imports = []
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        # the nesting is given by the indentation, two spaces for each level: only the modules imported by
+        # the top level ones are kept, the deeper ones are part of their cumulative time
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth == 1:
+            imports.append((module.strip(), int(cumulative) / 1e6))
+    return sorted(imports, key=lambda i: i[1], reverse=True)[:top]
+
+
+def run_all(bench_args):
+    env = dict(os.environ)
+    # main.py imports the utils package of domain_adaptation
+    env['PYTHONPATH'] = os.pathsep.join(p for p in [DOMAIN_ADAPTATION_DIR, env.get('PYTHONPATH')] if p)
+
+    results = {}
+    for name, arguments in TARGETS.items():
+        times = []
+        for _ in range(bench_args.repeat):
+            elapsed, completed = run_target(arguments, env)
+            if completed.returncode != 0:
+                break
+            times.append(elapsed)
+        if not times:
+            # a missing optional dependency must not stop the other measures
+            last_line = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else ''
+            print("{:<30} failed: {}".format(name, last_line))
+            results[name] = {'error': last_line}
+            continue
+        results[name] = {'median_s': statistics.median(times), 'min_s': min(times),
+                         'slowest_imports': slowest_imports(arguments, env, bench_args.top)}
+        print("{:<30} {:>8.3f} s   slowest: {}".format(name, results[name]['median_s'], ', '.join(
+            '{} {:.2f}s'.format(m, t) for m, t in results[name]['slowest_imports'][:3])))
+
+    return {'meta': {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                     'python': sys.version.split()[0], 'repeat': bench_args.repeat},
+            'results': results}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DOMAIN_ADAPTATION_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after, threshold):
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}")
+    regressions = []
+    for name, old in before['results'].items():
+        new = after['results'].get(name)
+        if new is None or 'median_s' not in old or 'median_s' not in new:
+            continue
+        change = (new['median_s'] - old['median_s']) / old['median_s']
+        regression = change > threshold
+        if regression:
+            regressions.append((name, change))
+        print("{:<30} {:>8.3f} s {:>8.3f} s {:>+8.1%}{}".format(
+            name, old['median_s'], new['median_s'], change, '  REGRESSION' if regression else ''))
+    return regressions
+
+
+def main():
+    bench_args = parse_args()
+    if bench_args.compare is not None:
+        with open(bench_args.compare[0]) as f:
+            before = json.load(f)
+        with open(bench_args.compare[1]) as f:
+            after = json.load(f)
+        regressions = compare(before, after, bench_args.threshold)
+        print(f"{len(regressions)} regression(s) over {bench_args.threshold:.0%}")
+        sys.exit(1 if regressions else 0)
+
+    report = run_all(bench_args)
+    if bench_args.output is not None:
+        with open(bench_args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,91 +1,136 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Function
 from torch.nn.init import normal_, constant_
 from collections import OrderedDict, defaultdict
 import logging
+import random
+import numpy as np
 from typing import Dict, Optional
 from utils import logger
 from utils import metrics
+from utils import profiler
+from utils.checkpoint import CheckpointWriter, read_manifest
+from utils.grad_monitor import GradientMonitor
+from utils.domains import domain_specs
+from embeddingsDataLoader import PAD_LABEL
 import os
-from datetime import datetime
-from pathlib import Path
 from utils.logger import logger
-from utils.args import writer
 from collections import defaultdict
 
+
+def make_windows(x, window_size):
+    """Concatenate every element of x with the window_size - 1 elements that follow it.
+
+    x holds features of shape (..., N, D) or, if it is an integer tensor, labels of shape (..., N); with a
+    batch of chunks (C, N, ...) the windows are built inside every chunk. The windows running past the end
+    are zero padded. The result has shape (..., N, window_size * D), or (..., N, window_size) for labels.
+    """
+    if not x.is_floating_point():
+        return F.pad(x, (0, window_size - 1)).unfold(-1, window_size, 1)
+    x = F.pad(x, (0, 0, 0, window_size - 1))
+    return x.unfold(-2, window_size, 1).transpose(-1, -2).reshape(*x.shape[:-2], -1, window_size * x.shape[-1])
+
+
+def chunk_tokens(x, labels):
+    """Tokens of a batch of chunks x of shape (C, L, ...), without the padding (labels (C, L) equal to PAD_LABEL).
+
+    A batch of tokens (labels of shape (N,)) is returned as it is.
+    """
+    if labels.dim() == 1:
+        return x
+    return x[labels != PAD_LABEL]
+
+
 class AdaptiveModule(nn.Module):
 
-    def __init__(self, in_features_dim, model_config, num_classes_source=None, num_classes_target=None):
+    def __init__(self, in_features_dim, model_config, num_classes_source=None, num_classes_target=None, num_classes=None):
+        """num_classes maps every domain, the source first, to its number of classes; by default the domains
+        are source and target with num_classes_source and num_classes_target classes."""
 
         super(AdaptiveModule, self).__init__()
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model_config = model_config
+        if num_classes is None:
+            num_classes = {'source': num_classes_source, 'target': num_classes_target}
+        self.domains = list(num_classes)
 
         self.multi_head_attention = nn.MultiheadAttention(in_features_dim, num_heads=8, dropout=model_config.dropout)
         self.fc_task_specific_layer = self.TaskModule(model_config.num_fcl, in_features_dim=in_features_dim, out_features_dim=in_features_dim, dropout=model_config.dropout)
         
         if 'token_domain_classifier' in self.model_config.blocks:
-            self.token_domain_classifier = self.DomainClassifier(in_features_dim, model_config.beta_token)
+            self.token_domain_classifier = self.DomainClassifier(in_features_dim, model_config.beta_token, len(self.domains))
         
         if 'window_domain_classifier' in self.model_config.blocks or 'game_module' in self.model_config.blocks:
             self.fc_window_features = self.FullyConnectedLayer(model_config.window_size * in_features_dim, in_features_dim)
 
         if 'window_domain_classifier' in self.model_config.blocks:
-            self.window_domain_classifier = self.DomainClassifier(in_features_dim, model_config.beta_window)
+            self.window_domain_classifier = self.DomainClassifier(in_features_dim, model_config.beta_window, len(self.domains))
 
+        # the heads of every domain are attributes named after it, e.g. game_module_target and fc_classifier_target
         if 'game_module' in self.model_config.blocks:
-            self.game_module_source = self.GameModule(in_features_dim, model_config.window_size, num_classes_source)
-            self.game_module_target = self.GameModule(in_features_dim, model_config.window_size, num_classes_target)
+            for domain in self.domains:
+                setattr(self, f'game_module_{domain}', self.GameModule(in_features_dim, model_config.window_size, num_classes[domain]))
 
-        self.fc_classifier_source = nn.Linear(in_features_dim, num_classes_source)
-        self.fc_classifier_target = nn.Linear(in_features_dim, num_classes_target)
+        for domain in self.domains:
+            setattr(self, f'fc_classifier_{domain}', nn.Linear(in_features_dim, num_classes[domain]))
         std = 0.001
-        
-        if num_classes_target is not None:
-            normal_(self.fc_classifier_target.weight, 0, std)
-            constant_(self.fc_classifier_target.bias, 0)
 
-        if num_classes_source is not None:
-            normal_(self.fc_classifier_source.weight, 0, std)
-            constant_(self.fc_classifier_source.bias, 0)
+        # from the last domain to the first, as the two domain model did, so that the seeded runs do not change
+        for domain in reversed(self.domains):
+            normal_(getattr(self, f'fc_classifier_{domain}').weight, 0, std)
+            constant_(getattr(self, f'fc_classifier_{domain}').bias, 0)
 
-    def forward(self, source=None, target=None, class_labels_source=None, class_labels_target=None, is_train=True):
+    def forward(self, source=None, target=None, class_labels_source=None, class_labels_target=None, is_train=True, feats=None, class_labels=None):
+        """feats and class_labels map the domains of the batch to their features and labels, source and target
+        are the same for the two domain runs."""
         output = defaultdict(lambda: None)
-
-        for domain, feats, class_labels in [('source', source, class_labels_source), ('target', target, class_labels_target)]:
-            if feats is not None:
+        window_size = int(self.model_config.window_size)
+
+        inputs = dict(feats or {})
+        labels = dict(class_labels or {})
+        for domain, domain_feats, domain_labels in [('source', source, class_labels_source), ('target', target, class_labels_target)]:
+            if domain_feats is not None:
+                inputs[domain] = domain_feats
+                labels[domain] = domain_labels
+
+        for domain in inputs:
+            feats, class_labels = inputs[domain], labels.get(domain)
+            # with a batch of chunks (C, L, D) of DocumentChunkDataset the windows are built inside the chunks,
+            # everything else works on the tokens without the padding
+            chunks = feats.dim() == 3
+            with profiler.phase('forward/task'):
                 # feats = self.multi_head_attention(feats, feats, feats)[0]
-                feats = self.fc_task_specific_layer(feats)
+                feats = self.fc_task_specific_layer(chunk_tokens(feats, class_labels) if chunks else feats)
                 output[f'feats_fcl'] = feats
-                if domain == 'source':
-                    output[f'preds_class_{domain}'] = self.fc_classifier_source(feats)
-                else:
-                    output[f'preds_class_{domain}'] = self.fc_classifier_target(feats)
-            else:
-                continue
+                output[f'preds_class_{domain}'] = getattr(self, f'fc_classifier_{domain}')(feats)
 
             if 'token_domain_classifier' in self.model_config.blocks and is_train:
-                output[f'preds_domain_token_{domain}'] = self.token_domain_classifier(feats)
+                with profiler.phase('forward/token_domain'):
+                    output[f'preds_domain_token_{domain}'] = self.token_domain_classifier(feats)
 
             if ('window_domain_classifier' in self.model_config.blocks or 'game_module' in self.model_config.blocks) and is_train:
-                try:
-                    window_class_labels = torch.vstack(tuple(torch.hstack(tuple(class_labels[i+start] if i+start<len(class_labels) else torch.zeros((1,)).to(self.device) for i in range(self.model_config.window_size))) for start in range(len(class_labels))))
-                except:
-                    raise Exception(f'Could not create window_class_labels_{domain}, class_labels.shape: {class_labels.shape}, self.model_config.window_size: {self.model_config.window_size}')
-                
-                feats_window = torch.vstack(tuple(torch.hstack(tuple(feats[i+start,:] if i+start<len(feats) else torch.zeros(feats.shape[1:]).to(self.device) for i in range(self.model_config.window_size))) for start in range(len(feats))))
-                feats_window = self.fc_window_features(feats_window)
+                with profiler.phase('forward/windows'):
+                    if chunks:
+                        mask = class_labels != PAD_LABEL
+                        chunk_feats = feats.new_zeros(*mask.shape, feats.shape[-1])
+                        chunk_feats[mask] = feats
+                        window_class_labels = make_windows(class_labels.masked_fill(~mask, 0), window_size)[mask].float()
+                        feats_window = make_windows(chunk_feats, window_size)[mask]
+                    else:
+                        window_class_labels = make_windows(class_labels, window_size).float()
+                        feats_window = make_windows(feats, window_size)
+                    feats_window = self.fc_window_features(feats_window)
 
                 if 'window_domain_classifier' in self.model_config.blocks:
-                    output[f'preds_domain_window_{domain}'] = self.window_domain_classifier(feats_window)
+                    with profiler.phase('forward/window_domain'):
+                        output[f'preds_domain_window_{domain}'] = self.window_domain_classifier(feats_window)
 
                 if 'game_module' in self.model_config.blocks:
-                    if domain == 'source':
-                        output[f'wordle_{domain}'] = self.game_module_source.play(feats_window, window_class_labels)
-                    else:
-                        output[f'wordle_{domain}'] = self.game_module_target.play(feats_window, window_class_labels)
+                    with profiler.phase('forward/wordle'):
+                        output[f'wordle_{domain}'] = getattr(self, f'game_module_{domain}').play(feats_window, window_class_labels)
 
                 output[f'window_class_labels_{domain}'] = window_class_labels
 
@@ -151,7 +196,7 @@ class AdaptiveModule(nn.Module):
     
     class DomainClassifier(nn.Module):
 
-        def __init__(self, in_features_dim, beta):
+        def __init__(self, in_features_dim, beta, n_domains=2):
 
             std = 0.001
 
@@ -160,7 +205,7 @@ class AdaptiveModule(nn.Module):
             self.domain_classifier = nn.Sequential(OrderedDict([
                 ('linear1', nn.Linear(self.in_features_dim, self.in_features_dim)),
                 ('relu1', nn.ReLU(inplace=True)),
-                ('linear2', nn.Linear(self.in_features_dim, 2))
+                ('linear2', nn.Linear(self.in_features_dim, n_domains))
             ]))
             self.beta = beta
 
@@ -245,13 +290,19 @@ class DomainAdaptationNER(nn.Module):
         self.name = self.args.name
         self.models_dir = self.args.models_dir
 
+        self.best_iter = 0
         self.best_iter_score = 0
-        self.model_count = 0
+        self.last_checkpoint_path = None
+        self.checkpoint_writer = None
+        # MetricsSink where the learning rates are logged, set by the training script
+        self.writer = None
 
         self.total_batch = args.total_batch
         self.batch_size = args.batch_size
 
         self.current_iter = 0
+        # samplers of the training loaders, their position is saved with the checkpoints (see training_state)
+        self.samplers = {}
 
         args.blocks = []
 
@@ -267,8 +318,17 @@ class DomainAdaptationNER(nn.Module):
         self.blocks = args.blocks
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-        self.model = AdaptiveModule(args.in_features_dim, args, args.num_classes_target, args.num_classes_source)
+        # the source is the first domain, the others are the targets (see utils/domains.py)
+        self.num_classes = {spec['name']: spec['num_classes'] for spec in domain_specs(args)}
+        self.domains = list(self.num_classes)
+        logger.info(f'Domains: {self.domains}')
+
+        self.model = AdaptiveModule(args.in_features_dim, args, num_classes=self.num_classes)
         self.model.to(self.device)
+        # the parameters stay the same objects when the model is moved or wrapped by DataParallel
+        self.grad_monitor = GradientMonitor(self.model.named_parameters(), every=args.grad_monitor_every,
+                                            history=args.grad_history, threshold=args.grad_norm_threshold,
+                                            max_norm=args.clip_grad_norm)
 
         self.criterion = torch.nn.CrossEntropyLoss(weight=None, size_average=None, ignore_index=-100,
                                                     reduce=None, reduction='none')
@@ -292,115 +352,103 @@ class DomainAdaptationNER(nn.Module):
                                             momentum=args.sgd_momentum)
         
         self.accuracy = {}
-        self.accuracy['source'] = metrics.Accuracy(topk=(1,), classes=args.num_classes_source)
-        self.accuracy['target'] = metrics.Accuracy(topk=(1,), classes=args.num_classes_target)
-
         self.f1 = {}
-        self.f1['source'] = metrics.F1(topk=(1,), classes=args.num_classes_source)
-        self.f1['target'] = metrics.F1(topk=(1,), classes=args.num_classes_target)
-
-        self.num_classes_source = args.num_classes_source
-        self.num_classes_target = args.num_classes_target
+        for domain, num_classes in self.num_classes.items():
+            self.accuracy[domain] = metrics.Accuracy(topk=(1,), classes=num_classes)
+            self.f1[domain] = metrics.F1(topk=(1,), classes=num_classes)
+            setattr(self, f'num_classes_{domain}', num_classes)
 
         self.domain_token_loss = metrics.AverageMeter()
         self.domain_window_loss = metrics.AverageMeter()
-        self.classification_loss_source = metrics.AverageMeter()
-        self.classification_loss_target = metrics.AverageMeter()
+        # the losses of every domain are attributes named after it, e.g. classification_loss_target
+        for domain in self.domains:
+            setattr(self, f'classification_loss_{domain}', metrics.AverageMeter())
+            setattr(self, f'wordle_{domain}_position_loss', metrics.AverageMeter())
+            setattr(self, f'wordle_{domain}_window_loss', metrics.AverageMeter())
+    
+    def forward(self, source = None, target = None, class_labels_source: 'torch.Tensor' = None, class_labels_target: 'torch.Tensor' = None, is_train=True,
+                feats: Optional[Dict[str, 'torch.Tensor']] = None, class_labels: Optional[Dict[str, 'torch.Tensor']] = None):
+        return self.model(source, target, class_labels_source, class_labels_target, is_train=is_train, feats=feats, class_labels=class_labels)
+
+    @staticmethod
+    def domain_labels(class_labels_source, class_labels_target, class_labels):
+        """Labels of the domains of a batch, the dict class_labels with the source and target ones added."""
+        class_labels = dict(class_labels or {})
+        if class_labels_source is not None:
+            class_labels['source'] = class_labels_source
+        if class_labels_target is not None:
+            class_labels['target'] = class_labels_target
+        return class_labels
 
-        self.wordle_source_position_loss = metrics.AverageMeter()
-        self.wordle_target_position_loss = metrics.AverageMeter()
+    def domain_loss(self, predictions: Dict[str, 'torch.Tensor'], domains, level: str):
+        """Cross entropy of the domain classifier of level (token or window), the label of a domain is its index.
 
-        self.wordle_source_window_loss = metrics.AverageMeter()
-        self.wordle_target_window_loss = metrics.AverageMeter()
-    
-    def forward(self, source = None, target = None, class_labels_source: 'torch.Tensor' = None, class_labels_target: 'torch.Tensor' = None, is_train=True):
-        return self.model(source, target, class_labels_source, class_labels_target, is_train=is_train)
+        The loss of every domain is averaged over its own tokens and the domains are averaged, so that a domain
+        weighs the same whatever its share of the batch (see --source_ratio).
+        """
+        preds_domain = [predictions[f'preds_domain_{level}_{domain}'] for domain in domains]
+        domain_label_all = torch.cat([torch.full((preds.shape[0],), self.domains.index(domain), dtype=torch.int64)
+                                      for domain, preds in zip(domains, preds_domain)], 0).to(self.device)
+        loss = self.criterion(torch.cat(preds_domain, 0), domain_label_all)
+        return torch.stack([domain_loss.mean() for domain_loss in loss.split([preds.shape[0] for preds in preds_domain])]).mean()
+
+    def compute_loss(self, class_labels_source: 'torch.Tensor' = None, class_labels_target: 'torch.Tensor' = None, predictions: Dict[str, 'torch.Tensor'] = None,
+                     class_labels: Optional[Dict[str, 'torch.Tensor']] = None):
+        """Compute the losses of the domains in class_labels (or class_labels_source and class_labels_target).
+
+        The batches of the domains can have different sizes (see --source_ratio): every loss of a domain is
+        normalised by the number of its own tokens, or windows, in the batch, then by the accumulation steps.
+        """
+        class_labels = self.domain_labels(class_labels_source, class_labels_target, class_labels)
+        domains = [domain for domain in self.domains if domain in class_labels]
+        accumulation_steps = self.total_batch / self.batch_size
+        tokens = {domain: predictions[f'preds_class_{domain}'].shape[0] for domain in domains}
 
-    def compute_loss(self, class_labels_source: 'torch.Tensor', class_labels_target: 'torch.Tensor', predictions: Dict[str, 'torch.Tensor']):
-        
-        try:
-            classification_loss_source = self.criterion(predictions['preds_class_source'], class_labels_source) #cross entropy loss
-            classification_loss_target = self.criterion(predictions['preds_class_target'], class_labels_target) #cross entropy loss
-        except:
-            raise ValueError(f'Could not compute classification loss, predictions: {predictions["preds_class_source"].shape}', f'Class labels source: {class_labels_source.shape}',\
-                             f'Class labels target: {class_labels_target.shape}, predictions: {predictions["preds_class_target"].shape}', \
-                             f'Labels source: {class_labels_source.unique()}', f'Labels target: {class_labels_target.unique()}')
-
-        self.classification_loss_source.update(torch.mean(classification_loss_source) / (self.total_batch / self.batch_size), self.batch_size)
-        self.classification_loss_target.update(torch.mean(classification_loss_target) / (self.total_batch / self.batch_size), self.batch_size)
+        for domain in domains:
+            try:
+                classification_loss = self.criterion(predictions[f'preds_class_{domain}'], class_labels[domain]) #cross entropy loss
+            except:
+                raise ValueError(f'Could not compute classification loss of {domain}, predictions: {predictions[f"preds_class_{domain}"].shape}',
+                                 f'Class labels: {class_labels[domain].shape}', f'Labels: {class_labels[domain].unique()}')
+            getattr(self, f'classification_loss_{domain}').update(torch.mean(classification_loss) / accumulation_steps, tokens[domain])
         
+        # the domain classifiers tell apart all the domains of the batch, the source one is shared by all the targets
         if 'token_domain_classifier' in self.blocks:
-            preds_domain_token_source = predictions['preds_domain_token_source']
-            domain_label_source=torch.zeros(preds_domain_token_source.shape[0], dtype=torch.int64)    
-            
-            preds_domain_token_target = predictions['preds_domain_token_target']
-            domain_label_target=torch.ones(preds_domain_token_target.shape[0], dtype=torch.int64)    
-
-            domain_label_all=torch.cat((domain_label_source, domain_label_target),0).to(self.device)
-            pred_domain_token_all=torch.cat((preds_domain_token_source, preds_domain_token_target),0)
-
-            domain_token_loss = self.criterion(pred_domain_token_all, domain_label_all)
-            self.domain_token_loss.update(torch.mean(domain_token_loss) / (self.total_batch / self.batch_size), self.batch_size)
+            domain_token_loss = self.domain_loss(predictions, domains, 'token')
+            self.domain_token_loss.update(domain_token_loss / accumulation_steps, sum(tokens.values()))
 
         if 'window_domain_classifier' in self.blocks:
-            preds_domain_window_source = predictions['preds_domain_window_source']
-            domain_label_source=torch.zeros(preds_domain_window_source.shape[0], dtype=torch.int64)    
-            
-            preds_domain_window_target = predictions['preds_domain_window_target']
-            domain_label_target=torch.ones(preds_domain_window_target.shape[0], dtype=torch.int64)    
-
-            domain_label_all=torch.cat((domain_label_source, domain_label_target),0).to(self.device)
-            pred_domain_window_all=torch.cat((preds_domain_window_source, preds_domain_window_target),0)
-
-            domain_window_loss = self.criterion(pred_domain_window_all, domain_label_all)
-            self.domain_window_loss.update(torch.mean(domain_window_loss) / (self.total_batch / self.batch_size), self.batch_size)
+            domain_window_loss = self.domain_loss(predictions, domains, 'window')
+            self.domain_window_loss.update(domain_window_loss / accumulation_steps, sum(tokens.values()))
         
         if 'game_module' in self.blocks:
-            wordle_source = predictions['wordle_source'] # Dimension: (windows_in_batch, window_size, num_classes)
-            wordle_target = predictions['wordle_target']
-
-            window_class_labels_source = predictions['window_class_labels_source'] # Dimension: (windows_in_batch, window_size)
-            window_class_labels_target = predictions['window_class_labels_target']
-
-            # Now we need something like (windows_in_batch*window_size, num_classes)
-            # We do this by one-hot encoding the labels
-            window_class_labels_source_one_hot = torch.nn.functional.one_hot(window_class_labels_source.long(), num_classes=self.num_classes_source).to(float)
-            window_class_labels_target_one_hot = torch.nn.functional.one_hot(window_class_labels_target.long(), num_classes=self.num_classes_target).to(float)
-
-            window_class_labels_source_one_hot_word = window_class_labels_source_one_hot.view(-1, self.num_classes_source)
-            window_class_labels_target_one_hot_word = window_class_labels_target_one_hot.view(-1, self.num_classes_target)
-
-            wordle_source_position = wordle_source.view(-1, self.num_classes_source)
-            wordle_target_position = wordle_target.view(-1, self.num_classes_target)
-
-            wordle_source_position_loss = self.criterion(wordle_source_position, window_class_labels_source_one_hot_word)
-            wordle_target_position_loss = self.criterion(wordle_target_position, window_class_labels_target_one_hot_word)
-
-            wordle_source_position_loss = torch.mean(wordle_source_position_loss) / (self.total_batch / self.batch_size)
-            wordle_target_position_loss = torch.mean(wordle_target_position_loss) / (self.total_batch / self.batch_size)
+            for domain in domains:
+                num_classes = self.num_classes[domain]
+                wordle = predictions[f'wordle_{domain}'] # Dimension: (windows_in_batch, window_size, num_classes)
+                window_class_labels = predictions[f'window_class_labels_{domain}'] # Dimension: (windows_in_batch, window_size)
 
-            self.wordle_source_position_loss.update(wordle_source_position_loss, self.batch_size)
-            self.wordle_target_position_loss.update(wordle_target_position_loss, self.batch_size)
+                # Now we need something like (windows_in_batch*window_size, num_classes)
+                # We do this by one-hot encoding the labels
+                window_class_labels_one_hot = torch.nn.functional.one_hot(window_class_labels.long(), num_classes=num_classes).to(float)
+                window_class_labels_one_hot_word = window_class_labels_one_hot.view(-1, num_classes)
 
-            # Now we need to compute the loss which does not take into account the position of the entity
+                wordle_position = wordle.view(-1, num_classes)
+                wordle_position_loss = self.criterion(wordle_position, window_class_labels_one_hot_word)
+                wordle_position_loss = torch.mean(wordle_position_loss) / accumulation_steps
+                getattr(self, f'wordle_{domain}_position_loss').update(wordle_position_loss, tokens[domain])
 
-            wordle_source_window = torch.ones((wordle_source.shape[0], wordle_source.shape[2]))-torch.prod(torch.ones_like(wordle_source)-wordle_source, dim=1).to(self.device) # Dimension: (windows_in_batch, num_classes)
-            wordle_target_window = torch.ones((wordle_target.shape[0], wordle_target.shape[2]))-torch.prod(torch.ones_like(wordle_target)-wordle_target, dim=1).to(self.device)
+                # Now we need to compute the loss which does not take into account the position of the entity
 
-            window_class_labels_source_one_hot_window = window_class_labels_source_one_hot.sum(dim=1)
-            window_class_labels_target_one_hot_window = window_class_labels_target_one_hot.sum(dim=1)
+                wordle_window = torch.ones((wordle.shape[0], wordle.shape[2]))-torch.prod(torch.ones_like(wordle)-wordle, dim=1).to(self.device) # Dimension: (windows_in_batch, num_classes)
+                window_class_labels_one_hot_window = window_class_labels_one_hot.sum(dim=1)
 
-            try:
-                wordle_source_window_loss = self.criterion(wordle_source_window, window_class_labels_source_one_hot_window)
-                wordle_target_window_loss = self.criterion(wordle_target_window, window_class_labels_target_one_hot_window)
-            except:
-                raise Exception(f'Pred shape: {wordle_source_window.shape}', f'Label shape: {window_class_labels_source_one_hot.shape}')
-
-            wordle_source_window_loss = torch.mean(wordle_source_window_loss) / (self.total_batch / self.batch_size)
-            wordle_target_window_loss = torch.mean(wordle_target_window_loss) / (self.total_batch / self.batch_size)
+                try:
+                    wordle_window_loss = self.criterion(wordle_window, window_class_labels_one_hot_window)
+                except:
+                    raise Exception(f'Pred shape: {wordle_window.shape}', f'Label shape: {window_class_labels_one_hot.shape}')
 
-            self.wordle_source_window_loss.update(wordle_source_window_loss, self.batch_size)
-            self.wordle_target_window_loss.update(wordle_target_window_loss, self.batch_size)
+                wordle_window_loss = torch.mean(wordle_window_loss) / accumulation_steps
+                getattr(self, f'wordle_{domain}_window_loss').update(wordle_window_loss, tokens[domain])
 
     def reduce_learning_rate(self):
         """Perform a learning rate step."""
@@ -424,17 +472,15 @@ class DomainAdaptationNER(nn.Module):
         if 'window_domain_classifier' in self.blocks:
             self.domain_window_loss.reset()
         
-        if 'game_module' in self.blocks:
-            self.wordle_source_position_loss.reset()
-            self.wordle_target_position_loss.reset()
-            self.wordle_source_window_loss.reset()
-            self.wordle_target_window_loss.reset()
-
-        self.classification_loss_source.reset()
-        self.classification_loss_target.reset()
+        for domain in self.domains:
+            if 'game_module' in self.blocks:
+                getattr(self, f'wordle_{domain}_position_loss').reset()
+                getattr(self, f'wordle_{domain}_window_loss').reset()
+            getattr(self, f'classification_loss_{domain}').reset()
     
-    def compute_accuracy(self, output: Dict[str, 'torch.Tensor'], class_labels_source: 'torch.Tensor' = None, class_labels_target: 'torch.Tensor' = None):
-        """Compute the classification accuracy for source and target.
+    def compute_accuracy(self, output: Dict[str, 'torch.Tensor'], class_labels_source: 'torch.Tensor' = None, class_labels_target: 'torch.Tensor' = None,
+                         class_labels: Optional[Dict[str, 'torch.Tensor']] = None):
+        """Compute the classification accuracy for the domains in class_labels (or source and target).
 
         Parameters
         ----------
@@ -443,10 +489,8 @@ class DomainAdaptationNER(nn.Module):
         label : torch.Tensor
             ground truth
         """
-        if class_labels_source is not None:
-            self.accuracy['source'].update(output['preds_class_source'], class_labels_source)
-        if class_labels_target is not None:
-            self.accuracy['target'].update(output['preds_class_target'], class_labels_target)
+        for domain, labels in self.domain_labels(class_labels_source, class_labels_target, class_labels).items():
+            self.accuracy[domain].update(output[f'preds_class_{domain}'], labels)
 
     def compute_f1(self, output: 'torch.Tensor', class_labels: 'torch.Tensor', domain: 'str'):
         """Compute the classification accuracy for source and target.
@@ -464,10 +508,9 @@ class DomainAdaptationNER(nn.Module):
 
     def reset_acc(self):
         """Reset the classification accuracy."""
-        self.accuracy['source'].reset()
-        self.accuracy['target'].reset()
-        self.f1['source'].reset()
-        self.f1['target'].reset()
+        for domain in self.domains:
+            self.accuracy[domain].reset()
+            self.f1[domain].reset()
 
 
     def step(self):
@@ -477,8 +520,8 @@ class DomainAdaptationNER(nn.Module):
         and the accuracy.
         """
         for i, param_group in enumerate(self.optimizer.param_groups):
-            if self.args.action != "gridsearch":
-                writer.add_scalar(f'learning_rates/lr_{i}', param_group["lr"], global_step=int(self.current_iter))
+            if self.writer is not None:
+                self.writer.add_scalar(f'learning_rates/lr_{i}', param_group["lr"], global_step=int(self.current_iter))
         self.optimizer.step()
         self.reset_loss()
         self.reset_acc()
@@ -497,8 +540,8 @@ class DomainAdaptationNER(nn.Module):
 
         loss = 0
 
-        loss += self.classification_loss_source.val
-        loss += self.classification_loss_target.val
+        for domain in self.domains:
+            loss += getattr(self, f'classification_loss_{domain}').val
         
         if 'token_domain_classifier' in self.blocks:
             loss += self.domain_token_loss.val
@@ -507,10 +550,11 @@ class DomainAdaptationNER(nn.Module):
             loss += self.domain_window_loss.val
         
         if 'game_module' in self.blocks:
-            wordle_loss = self.wordle_source_position_loss.val
-            wordle_loss += self.wordle_target_position_loss.val
-            wordle_loss += self.wordle_source_window_loss.val
-            wordle_loss += self.wordle_target_window_loss.val
+            wordle_loss = 0
+            for domain in self.domains:
+                wordle_loss += getattr(self, f'wordle_{domain}_position_loss').val
+            for domain in self.domains:
+                wordle_loss += getattr(self, f'wordle_{domain}_window_loss').val
             loss += self.args.beta_wordle*wordle_loss
 
         loss.backward(retain_graph=retain_graph)
@@ -527,28 +571,94 @@ class DomainAdaptationNER(nn.Module):
         self.model = torch.nn.DataParallel(self.model).to(device)
     
     def check_grad(self):
-        """Check that the gradients of the model are not over a certain threshold."""
-        for name, param in self.model.named_parameters():
-            if param.requires_grad and param.grad is not None:
-                if param.grad.norm(2).item() > 25:
-                    logger.info(f"Param {name} has a gradient whose L2 norm is over 25")
+        """Sample the gradient norms of the blocks (and clip them if args.clip_grad_norm is set) before the step.
+
+        The norms stay on the device, they are logged through the writer and checked against the threshold
+        by log_grad_health, see utils/grad_monitor.py.
+        """
+        block_norms = self.grad_monitor.update()
+        if block_norms is not None and self.writer is not None:
+            for block, norm in zip(self.grad_monitor.blocks, block_norms):
+                self.writer.add_scalar(f'grad_norm/{block}', norm, global_step=int(self.current_iter))
+
+    def log_grad_health(self):
+        """Log the statistics of the recent gradient norms of every block and the parameters over the threshold.
+
+        The domain classifiers are behind a gradient reversal layer, their gradients are the first to explode.
+        """
+        stats, over_threshold = self.grad_monitor.summary()
+        for block, block_stats in stats.items():
+            grl = ' (GRL)' if block in ('token_domain_classifier', 'window_domain_classifier') else ''
+            logger.info("Gradient norm of {}{}: last {:.3f}, mean {:.3f}, max {:.3f}".format(
+                block, grl, block_stats['last'], block_stats['mean'], block_stats['max']))
+        for name, norm in over_threshold:
+            logger.info(f"Param {name} has a gradient whose L2 norm reached {norm:.2f}, over {self.grad_monitor.threshold}")
+
+    def loss_meters(self):
+        """Return the AverageMeters of the losses, by attribute name."""
+        return {name: meter for name, meter in vars(self).items() if isinstance(meter, metrics.AverageMeter)}
+
+    def training_state(self):
+        """Return the state needed to continue training exactly where it stopped.
+
+        Besides the model and the optimizer, a resumed run needs the position of the training samplers,
+        the random number generators (dropout, shuffling), the running loss meters and the learning rates,
+        which already include the decay applied at args.lr_step.
+        """
+        return {
+            "samplers": {domain: sampler.state_dict() for domain, sampler in self.samplers.items()},
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+                "numpy": np.random.get_state(),
+                "python": random.getstate(),
+            },
+            "meters": {name: meter.state_dict() for name, meter in self.loss_meters().items()},
+            "lr": [param_group["lr"] for param_group in self.optimizer.param_groups],
+        }
+
+    def load_training_state(self, state: dict):
+        """Restore a state returned by training_state.
+
+        The samplers must be registered in self.samplers before the state is loaded.
+        """
+        for domain, sampler_state in state["samplers"].items():
+            if domain in self.samplers:
+                self.samplers[domain].load_state_dict(sampler_state)
+            else:
+                logger.warning(f"No {domain} sampler to restore, its data will be reshuffled")
+
+        # the generators only accept CPU ByteTensors
+        torch.set_rng_state(state["rng"]["torch"].cpu())
+        if torch.cuda.is_available() and len(state["rng"]["cuda"]) == torch.cuda.device_count():
+            torch.cuda.set_rng_state_all([cuda_state.cpu() for cuda_state in state["rng"]["cuda"]])
+        np.random.set_state(state["rng"]["numpy"])
+        random.setstate(state["rng"]["python"])
+
+        meters = self.loss_meters()
+        for name, meter_state in state["meters"].items():
+            meters[name].load_state_dict(meter_state)
 
-    def __restore_checkpoint(self, m: str, path: str):
+        for param_group, lr in zip(self.optimizer.param_groups, state["lr"]):
+            param_group["lr"] = lr
+
+    def __restore_checkpoint(self, path: str):
         """Restore a checkpoint from path.
 
         Parameters
         ----------
-        m : str
-            modality to load from
         path : str
             path to load from
         """
-        logger.info("Restoring {} for modality {} from {}".format(self.name, m, path))
+        logger.info("Restoring {} from {}".format(self.name, path))
 
-        checkpoint = torch.load(path)
+        # the training state contains numpy and python objects, not only tensors. Loaded on the CPU, where the
+        # random number generator states must stay: load_state_dict copies the weights and the optimizer state
+        # to the device of the model
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
 
         # Restore the state of the task
-        self.current_iter = checkpoint["iteration"]
+        self.current_iter = int(checkpoint["iteration"])
         self.best_iter = checkpoint["best_iter"]
         self.best_iter_score = checkpoint["best_iter_score"]
         self.last_iter_acc = checkpoint["acc_mean"]
@@ -557,58 +667,48 @@ class DomainAdaptationNER(nn.Module):
         self.model.load_state_dict(checkpoint["model_state_dict"], strict=True)
         # Restore the optimizer parameters
         self.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
-
-        try:
-            self.model_count = checkpoint["last_model_count_saved"]
-            self.model_count = self.model_count + 1 if self.model_count < 9 else 1
-        except KeyError:
-            # for compatibility with models saved before refactoring
-            self.model_count = 1
+        if "training_state" in checkpoint:
+            self.load_training_state(checkpoint["training_state"])
+        else:
+            logger.warning("The checkpoint has no training state, the data loaders will start from scratch")
+        self.last_checkpoint_path = path
 
         logger.info(
-            f"{m}-Model for {self.name} restored at iter {self.current_iter}\n"
+            f"Model for {self.name} restored at iter {self.current_iter}\n"
             f"Best accuracy on val: {self.best_iter_score:.2f} at iter {self.best_iter}\n"
             f"Last accuracy on val: {self.last_iter_acc:.2f}\n"
-            f"Last loss: {checkpoint['loss_mean']:.2f}"
+            f"Last loss: {sum(checkpoint[f'loss_cls_{domain}_mean'] for domain in self.domains):.2f}"
         )
 
-    def load_model(self, path: str, idx: int):
-        """Load a specific model (idx-one) among the last 9 saved.
+    def load_checkpoint(self, path: str):
+        """Load a model from a specific checkpoint file.
+
+        Parameters
+        ----------
+        path : str
+            path of the .pth file to load
+        """
+        self.__restore_checkpoint(path)
 
-        Load a specific model (idx-one) among the last 9 saved from a specific path,
-        might be overwritten in case the task requires it.
+    def load_model(self, path: str, idx: int):
+        """Load a specific model (idx-one) among the last ones saved.
 
         Parameters
         ----------
         path : str
-            directory to load models from
+            directory to load models from, the one containing the checkpoint manifest
         idx : int
-            index of the model to load
+            index of the model to load, 1 is the most recent one
         """
-        # List all the files in the path in chronological order (1st is most recent, last is less recent)
-        last_dir = Path(
-            list(
-                sorted(
-                    Path(path).iterdir(),
-                    key=lambda date: datetime.strptime(os.path.basename(os.path.normpath(date)), "%b%d_%H-%M-%S"),
-                )
-            )[-1]
-        )
-        last_models_dir = last_dir.iterdir()
-
-        for m in self.modalities:
-            # Get the correct model (modality, name, idx)
-            model = list(
-                filter(
-                    lambda x: m == x.name.split(".")[0].split("_")[-2]
-                    and self.name == x.name.split(".")[0].split("_")[-3]
-                    and str(idx) == x.name.split(".")[0].split("_")[-1],
-                    last_models_dir,
-                )
-            )[0].name
-            model_path = os.path.join(str(last_dir), model)
-
-            self.__restore_checkpoint(m, model_path)
+        manifest = read_manifest(path)
+        if manifest is None or not manifest['checkpoints']:
+            raise FileNotFoundError(f"No checkpoint manifest in {path}")
+        checkpoints = manifest['checkpoints']
+        if not 1 <= idx <= len(checkpoints):
+            available = ', '.join(f"{len(checkpoints) - i}: {entry['file']}" for i, entry in enumerate(checkpoints))
+            raise ValueError(f"No checkpoint {idx} in {path}, the checkpoints available are {available}")
+        entry = checkpoints[-idx]
+        self.__restore_checkpoint(os.path.join(path, entry['file']))
 
     def load_last_model(self, path: str):
         """Load the last model from a specific path.
@@ -616,33 +716,40 @@ class DomainAdaptationNER(nn.Module):
         Parameters
         ----------
         path : str
-            directory to load models from
+            directory to load models from, the one containing the checkpoint manifest
+        """
+        manifest = read_manifest(path)
+        if manifest is not None and manifest['checkpoints']:
+            model_path = os.path.join(path, manifest['checkpoints'][-1]['file'])
+        else:
+            # for compatibility with checkpoints saved before the manifest was introduced
+            saved_models = sorted((f for f in os.listdir(path) if f.endswith('.pth')),
+                                  key=lambda f: os.path.getmtime(os.path.join(path, f)))
+            if not saved_models:
+                raise FileNotFoundError(f"No checkpoint in {path}")
+            logger.warning(f"No checkpoint manifest in {path}, loading the most recent file")
+            model_path = os.path.join(path, saved_models[-1])
+        self.__restore_checkpoint(model_path)
+
+    def load_best_model(self, path: str):
+        """Load the model with the best validation score from a specific path.
+
+        Parameters
+        ----------
+        path : str
+            directory to load models from, the one containing the checkpoint manifest
         """
-        # List all the files in the path in chronological order (1st is most recent, last is less recent)
-        last_models_dir = list(
-            sorted(
-                Path(path).iterdir(),
-                key=lambda date: datetime.strptime(os.path.basename(os.path.normpath(date)), "%b%d_%H-%M-%S"),
-            )
-        )[-1]
-        saved_models = [x for x in reversed(sorted(Path(last_models_dir).iterdir(), key=os.path.getmtime))]
-
-        for m in self.modalities:
-            # Get the correct model (modality, name, idx)
-            model = list(
-                filter(
-                    lambda x: m == x.name.split(".")[0].split("_")[-2]
-                    and self.name == x.name.split(".")[0].split("_")[-3],
-                    saved_models,
-                )
-            )[0].name
-
-            model_path = os.path.join(last_models_dir, model)
-            self.__restore_checkpoint(m, model_path)
+        manifest = read_manifest(path)
+        if manifest is None or manifest['best'] is None:
+            raise FileNotFoundError(f"No best checkpoint in the manifest of {path}")
+        self.__restore_checkpoint(os.path.join(path, manifest['best']['file']))
 
     def save_model(self, current_iter: int, last_iter_acc: float, prefix: Optional[str] = None):
         """Save the model.
 
+        The model and optimizer states are copied to the CPU and written on a background thread,
+        the last args.keep_checkpoints checkpoints and the best one are kept.
+
         Parameters
         ----------
         current_iter : int
@@ -654,33 +761,35 @@ class DomainAdaptationNER(nn.Module):
         """
         # build the filename of the model
         if prefix is not None:
-            filename = prefix + "_" + self.name + "_" + str(self.model_count) + ".pth"
+            filename = prefix + "_" + self.name + "_iter" + str(int(current_iter)) + ".pth"
         else:
-            filename = self.name + "_" + str(self.model_count) + ".pth"
-
-        if not os.path.exists(os.path.join(self.models_dir, self.args.experiment_dir)):
-            os.makedirs(os.path.join(self.models_dir, self.args.experiment_dir))
-
-        try:
-            torch.save(
-                {
-                    "iteration": current_iter,
-                    "best_iter": self.best_iter,
-                    "best_iter_score": self.best_iter_score,
-                    "acc_mean": last_iter_acc,
-                    "loss_cls_source_mean": self.classification_loss_source.acc,
-                    "loss_cls_target_mean": self.classification_loss_target.acc,
-                    "model_state_dict": self.model.state_dict(),
-                    "optimizer_state_dict": self.optimizer.state_dict(),
-                    "last_model_count_saved": self.model_count,
-                },
-                os.path.join(self.models_dir, self.args.experiment_dir, filename),
-            )
-            self.model_count = self.model_count + 1 if self.model_count < 9 else 1
-
-        except Exception as e:
-            logger.error("An error occurred while saving the checkpoint: ")
-            logger.error(e)
+            filename = self.name + "_iter" + str(int(current_iter)) + ".pth"
+
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(os.path.join(self.models_dir, self.args.experiment_dir),
+                                                                 keep_last=self.args.keep_checkpoints)
+
+        self.checkpoint_writer.save(
+            {
+                "iteration": current_iter,
+                "best_iter": self.best_iter,
+                "best_iter_score": self.best_iter_score,
+                "acc_mean": last_iter_acc,
+                **{f"loss_cls_{domain}_mean": getattr(self, f'classification_loss_{domain}').acc for domain in self.domains},
+                "model_state_dict": self.model.state_dict(),
+                "optimizer_state_dict": self.optimizer.state_dict(),
+                "training_state": self.training_state(),
+            },
+            filename,
+            iteration=int(current_iter),
+            score=float(last_iter_acc),
+        )
+        self.last_checkpoint_path = os.path.join(self.checkpoint_writer.directory, filename)
+
+    def flush_checkpoints(self):
+        """Wait until all the checkpoints saved so far are written on disk."""
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
 
     def train(self, mode: bool = True):
         """Activate the training in all models.
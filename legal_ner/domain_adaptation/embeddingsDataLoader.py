@@ -1,7 +1,11 @@
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torch
+import torch.nn.functional as F
 import numpy as np
 
+# label of the padding of the chunks, ignored by the loss like the -100 of the transformers datasets
+PAD_LABEL = -100
+
 class EmbeddingDataset(Dataset):
 
     def __init__(self, embeddings_path, labels_path):
@@ -20,4 +24,127 @@ class EmbeddingDataset(Dataset):
         return len(self.embeddings)
 
     def __getitem__(self, idx):
-        return self.embeddings[idx], self.labels[idx]
\ No newline at end of file
+        return self.embeddings[idx], self.labels[idx]
+
+
+class DocumentChunkDataset(EmbeddingDataset):
+    """Chunks of chunk_len contiguous tokens of the same document.
+
+    offsets holds the position of the first token of every document followed by the total number of
+    tokens, as saved by extract_embeddings. Every document is cut in chunks of chunk_len tokens and the
+    last one is padded with zero embeddings and PAD_LABEL labels, so a chunk never joins two documents
+    and the windows built on it are made of real neighbours. A chunk is a slice of the embeddings.
+    """
+
+    def __init__(self, embeddings_path, labels_path, offsets_path, chunk_len):
+        super(DocumentChunkDataset, self).__init__(embeddings_path, labels_path)
+        offsets = torch.load(offsets_path, map_location='cpu').long().view(-1)
+        if offsets[0] != 0 or offsets[-1] != len(self.labels):
+            raise ValueError(f"DocumentChunkDataset: the offsets in {offsets_path} do not cover the {len(self.labels)} tokens of {labels_path}")
+        self.chunk_len = chunk_len
+
+        lengths = offsets[1:] - offsets[:-1]
+        chunks_per_document = (lengths + chunk_len - 1) // chunk_len
+        document_ends = torch.repeat_interleave(offsets[1:], chunks_per_document)
+        first_chunks = torch.repeat_interleave(torch.cumsum(chunks_per_document, 0) - chunks_per_document, chunks_per_document)
+        chunk_in_document = torch.arange(len(document_ends)) - first_chunks
+        self.starts = torch.repeat_interleave(offsets[:-1], chunks_per_document) + chunk_in_document * chunk_len
+        self.ends = torch.minimum(self.starts + chunk_len, document_ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        start, end = int(self.starts[idx]), int(self.ends[idx])
+        embeddings, labels = self.embeddings[start:end], self.labels[start:end]
+        if end - start < self.chunk_len:
+            embeddings = F.pad(embeddings, (0, 0, 0, self.chunk_len - (end - start)))
+            labels = F.pad(labels, (0, self.chunk_len - (end - start)), value=PAD_LABEL)
+        return embeddings, labels
+
+
+class ResumableRandomSampler(Sampler):
+    """Random sampler whose position in the data can be saved and restored.
+
+    The permutation of every epoch only depends on seed and epoch, so restoring (epoch, index)
+    continues the same sequence of samples: the indices already consumed are skipped by slicing
+    the permutation instead of replaying the batches. The position counts the indices handed to
+    the DataLoader, so it is exact only with num_workers=0, as used by train.py.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.num_samples = len(data_source)
+        self.seed = seed
+        self.epoch = 0
+        self.index = 0
+
+    def __len__(self):
+        return self.num_samples
+
+    def indices(self, generator):
+        """Indices of the current epoch, drawn with generator."""
+        return torch.randperm(self.num_samples, generator=generator)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        permutation = self.indices(generator).tolist()
+        for idx in permutation[self.index:]:
+            self.index += 1
+            yield idx
+        self.epoch += 1
+        self.index = 0
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'index': self.index}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.index = state['index']
+
+
+class ClassBalancedTokenSampler(ResumableRandomSampler):
+    """Sampler drawing the tokens with a probability that depends on their class.
+
+    The probability of drawing class c is proportional to n_c ** (1 / temperature), where n_c is the
+    number of tokens of class c: temperature=1 keeps the frequencies of the data, temperature=inf draws
+    every class equally (class balanced). The probability of the O class (o_label) is also multiplied
+    by o_keep, to subsample the uninformative tokens. The tokens of a class are drawn uniformly with
+    replacement. An epoch has num_samples draws, by default the tokens left after the subsampling of O.
+
+    The indices of the tokens, grouped by class, are computed once as an int32 array, and the draws
+    only depend on seed and epoch, so the position is saved and restored as in ResumableRandomSampler.
+    """
+
+    def __init__(self, labels, seed=0, temperature=1.0, o_keep=1.0, o_label=0, num_samples=None):
+        labels = labels.view(-1).cpu()
+        classes, counts = torch.unique(labels, return_counts=True)
+        # the tokens sorted by class, the ones of classes[i] are order[offsets[i]:offsets[i] + counts[i]]
+        self.order = torch.argsort(labels, stable=True).to(torch.int32)
+        self.counts = counts
+        self.offsets = torch.cumsum(counts, 0) - counts
+        self.classes = classes
+
+        if temperature == float('inf'):
+            weights = torch.ones(len(classes), dtype=torch.float64)
+        else:
+            weights = counts.to(torch.float64) ** (1.0 / temperature)
+        kept = counts.to(torch.float64)
+        is_o = classes == o_label
+        weights[is_o] *= o_keep
+        kept[is_o] *= o_keep
+        if weights.sum() <= 0:
+            raise ValueError("ClassBalancedTokenSampler: no class left to sample, check o_keep")
+        self.class_probabilities = weights / weights.sum()
+
+        self.num_samples = num_samples if num_samples is not None else max(int(round(kept.sum().item())), 1)
+        self.seed = seed
+        self.epoch = 0
+        self.index = 0
+
+    def indices(self, generator):
+        drawn_classes = torch.multinomial(self.class_probabilities, self.num_samples, replacement=True, generator=generator)
+        positions = (torch.rand(self.num_samples, generator=generator, dtype=torch.float64) * self.counts[drawn_classes]).long()
+        positions = torch.minimum(positions, self.counts[drawn_classes] - 1)
+        return self.order[self.offsets[drawn_classes] + positions].long()
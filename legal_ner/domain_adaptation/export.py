@@ -0,0 +1,93 @@
+"""Export of the task head of a trained AdaptiveModule, to tag new embeddings outside of the training code.
+
+Only the task layers and the classifier of one domain are kept: the domain classifiers with the gradient
+reversal and the Wordle game are training only. The head is saved as TorchScript or ONNX, with optional
+int8 weights, next to a JSON file with its metadata, and loaded back with ExportedHead.
+"""
+import copy
+import json
+import os
+import torch
+import torch.nn as nn
+
+FORMATS = ('torchscript', 'onnx')
+
+
+class TaggerHead(nn.Module):
+    """Task layers (linear + ReLU, dropout removed) followed by the classifier, from embeddings to logits."""
+
+    def __init__(self, layers):
+        super(TaggerHead, self).__init__()
+        self.layers = nn.Sequential(*layers)
+
+    def forward(self, embeddings):
+        return self.layers(embeddings)
+
+
+def build_tagger_head(model, domain='target'):
+    """Copy the task head of domain out of an AdaptiveModule (not wrapped by DataParallel), on the CPU."""
+    layers = []
+    for fcl in model.fc_task_specific_layer.fc_layers:
+        layers += [copy.deepcopy(fcl.fc), nn.ReLU()]
+    layers.append(copy.deepcopy(getattr(model, f'fc_classifier_{domain}')))
+    head = TaggerHead(layers).cpu().eval()
+    for param in head.parameters():
+        param.requires_grad_(False)
+    return head
+
+
+def export_head(head, path, export_format='torchscript', int8=False, metadata=None):
+    """Save head in export_format at path and its metadata in path + '.json'.
+
+    With int8 the weights of the linear layers are quantized (dynamic quantization): by torch for
+    TorchScript, by onnxruntime, which has to be installed, for ONNX.
+    """
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown export format {export_format}, expected one of {FORMATS}")
+    in_features = head.layers[0].in_features
+    num_classes = head.layers[-1].out_features
+    example = torch.randn(8, in_features)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    if export_format == 'torchscript':
+        if int8:
+            head = torch.ao.quantization.quantize_dynamic(head, {nn.Linear}, dtype=torch.qint8)
+        torch.jit.save(torch.jit.trace(head, example), path)
+    else:
+        torch.onnx.export(head, (example,), path, input_names=['embeddings'], output_names=['logits'],
+                          dynamic_axes={'embeddings': {0: 'tokens'}, 'logits': {0: 'tokens'}})
+        if int8:
+            try:
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+            except ImportError as e:
+                raise ImportError("The int8 ONNX export needs onnxruntime, install it or export without --export_int8") from e
+            quantize_dynamic(path, path + '.int8', weight_type=QuantType.QInt8)
+            os.replace(path + '.int8', path)
+
+    metadata = dict(metadata or {}, format=export_format, int8=int8, in_features_dim=in_features, num_classes=num_classes)
+    with open(path + '.json', 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+class ExportedHead(object):
+    """Head saved by export_head, called on embeddings (N, D) it returns the logits (N, num_classes)."""
+
+    def __init__(self, path):
+        with open(path + '.json', 'r') as f:
+            self.metadata = json.load(f)
+        if self.metadata['format'] == 'torchscript':
+            self.module = torch.jit.load(path, map_location='cpu').eval()
+            self.session = None
+        else:
+            # imported here, so that onnxruntime is needed only for the ONNX heads
+            import onnxruntime
+            self.module = None
+            self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def __call__(self, embeddings):
+        embeddings = embeddings.detach().to('cpu', torch.float32)
+        if self.session is None:
+            with torch.no_grad():
+                return self.module(embeddings)
+        return torch.from_numpy(self.session.run(['logits'], {'embeddings': embeddings.numpy()})[0])
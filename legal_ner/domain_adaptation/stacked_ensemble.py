@@ -0,0 +1,392 @@
+import torch
+import torch.nn as nn
+from torch.nn.init import normal_, constant_
+from collections import OrderedDict, defaultdict
+from typing import Dict
+import os
+from domain_adaptation_ner import AdaptiveModule, make_windows
+from utils import metrics
+from utils.logger import logger
+from utils.checkpoint import CheckpointWriter
+
+# hyperparameters that can change between the variants of a stacked ensemble, every other key of a
+# gridsearch combination changes the architecture and needs a separate ensemble
+VARIANT_KEYS = ('beta_wordle', 'beta_token', 'beta_window', 'lr', 'lr_discriminator')
+
+
+def group_combinations(combinations, ensemble_size):
+    """Split the gridsearch combinations in groups that can be trained as one stacked ensemble.
+
+    Returns a list of (architecture, combinations) pairs, where architecture contains the keys of the
+    combinations which are not in VARIANT_KEYS and combinations has at most ensemble_size elements.
+    """
+    groups = OrderedDict()
+    for combination in combinations:
+        architecture = tuple(sorted((k, v) for k, v in combination.items() if k not in VARIANT_KEYS))
+        groups.setdefault(architecture, []).append(combination)
+
+    batches = []
+    for architecture, group in groups.items():
+        for start in range(0, len(group), ensemble_size):
+            batches.append((dict(architecture), group[start:start + ensemble_size]))
+    return batches
+
+
+class StackedLinear(nn.Module):
+    """n_variants independent linear layers evaluated with a single batched matmul.
+
+    The input is either shared by all the variants, (N, in_features_dim), or has one slice per
+    variant, (n_variants, N, in_features_dim); the output is (n_variants, N, out_features_dim).
+    """
+
+    def __init__(self, n_variants, in_features_dim, out_features_dim, std=0.001):
+        super(StackedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(n_variants, out_features_dim, in_features_dim))
+        self.bias = nn.Parameter(torch.empty(n_variants, 1, out_features_dim))
+        normal_(self.weight, 0, std)
+        constant_(self.bias, 0)
+
+    def forward(self, x):
+        return torch.matmul(x, self.weight.transpose(1, 2)) + self.bias
+
+
+class StackedAdaptiveModule(nn.Module):
+    """AdaptiveModule for n_variants models with the same architecture but different GRL betas.
+
+    Every block of AdaptiveModule is replaced by its stacked counterpart, so all the variants see the
+    same batch in a single forward/backward and every output gets a leading n_variants dimension.
+    """
+
+    def __init__(self, in_features_dim, model_config, n_variants, beta_token, beta_window, num_classes_source=None, num_classes_target=None):
+
+        super(StackedAdaptiveModule, self).__init__()
+
+        self.model_config = model_config
+        self.window_size = int(model_config.window_size)
+        self.n_variants = n_variants
+
+        self.fc_task_specific_layer = nn.Sequential(*[
+            self.FullyConnectedLayer(n_variants, in_features_dim, in_features_dim, model_config.dropout)
+            for _ in range(model_config.num_fcl)])
+
+        if 'token_domain_classifier' in self.model_config.blocks:
+            self.token_domain_classifier = self.DomainClassifier(n_variants, in_features_dim, beta_token)
+
+        if 'window_domain_classifier' in self.model_config.blocks or 'game_module' in self.model_config.blocks:
+            self.fc_window_features = self.FullyConnectedLayer(n_variants, self.window_size * in_features_dim, in_features_dim)
+
+        if 'window_domain_classifier' in self.model_config.blocks:
+            self.window_domain_classifier = self.DomainClassifier(n_variants, in_features_dim, beta_window)
+
+        if 'game_module' in self.model_config.blocks:
+            self.game_module_source = self.GameModule(n_variants, in_features_dim, self.window_size, num_classes_source)
+            self.game_module_target = self.GameModule(n_variants, in_features_dim, self.window_size, num_classes_target)
+
+        self.fc_classifier_source = StackedLinear(n_variants, in_features_dim, num_classes_source)
+        self.fc_classifier_target = StackedLinear(n_variants, in_features_dim, num_classes_target)
+
+    def forward(self, source=None, target=None, class_labels_source=None, class_labels_target=None, is_train=True):
+        output = defaultdict(lambda: None)
+
+        for domain, feats, class_labels in [('source', source, class_labels_source), ('target', target, class_labels_target)]:
+            if feats is None:
+                continue
+
+            feats = self.fc_task_specific_layer(feats)
+            output['feats_fcl'] = feats
+            output[f'preds_class_{domain}'] = getattr(self, f'fc_classifier_{domain}')(feats)
+
+            if 'token_domain_classifier' in self.model_config.blocks and is_train:
+                output[f'preds_domain_token_{domain}'] = self.token_domain_classifier(feats)
+
+            if ('window_domain_classifier' in self.model_config.blocks or 'game_module' in self.model_config.blocks) and is_train:
+                window_class_labels = make_windows(class_labels, self.window_size).float()
+                feats_window = self.fc_window_features(make_windows(feats, self.window_size))
+
+                if 'window_domain_classifier' in self.model_config.blocks:
+                    output[f'preds_domain_window_{domain}'] = self.window_domain_classifier(feats_window)
+
+                if 'game_module' in self.model_config.blocks:
+                    output[f'wordle_{domain}'] = getattr(self, f'game_module_{domain}').play(feats_window, window_class_labels)
+
+                output[f'window_class_labels_{domain}'] = window_class_labels
+
+        return output
+
+    class FullyConnectedLayer(nn.Module):
+        def __init__(self, n_variants, in_features_dim, out_features_dim, dropout=0.5):
+            super(StackedAdaptiveModule.FullyConnectedLayer, self).__init__()
+            self.fc = StackedLinear(n_variants, in_features_dim, out_features_dim)
+            self.relu = nn.ReLU()
+            self.dropout = nn.Dropout(p=dropout)
+
+        def forward(self, x):
+            return self.dropout(self.relu(self.fc(x)))
+
+    class DomainClassifier(nn.Module):
+        def __init__(self, n_variants, in_features_dim, beta):
+            super(StackedAdaptiveModule.DomainClassifier, self).__init__()
+            self.linear1 = StackedLinear(n_variants, in_features_dim, in_features_dim)
+            self.relu1 = nn.ReLU(inplace=True)
+            self.linear2 = StackedLinear(n_variants, in_features_dim, 2)
+            # one GRL coefficient per variant, broadcast over the (variant, token, feature) gradient
+            self.register_buffer('beta', torch.tensor(beta, dtype=torch.float).view(n_variants, 1, 1))
+
+        def forward(self, x):
+            x = AdaptiveModule.GradReverse.apply(x, self.beta)
+            return self.linear2(self.relu1(self.linear1(x)))
+
+    class GameModule(nn.Module):
+        def __init__(self, n_variants, in_features_dim, window_size, n_classes, dropout=0.5, n_attempts=6):
+            super(StackedAdaptiveModule.GameModule, self).__init__()
+            self.window_size = window_size
+            self.n_classes = n_classes
+            self.fc_layer = StackedAdaptiveModule.FullyConnectedLayer(n_variants, in_features_dim + 2 * window_size, window_size * n_classes, dropout)
+            self.softmax = torch.nn.Softmax(dim=3)
+            self.n_attempts = n_attempts
+
+        def play(self, feats, gt):
+            """Same game as AdaptiveModule.GameModule.play, gt is shared by all the variants."""
+            gt = gt.unsqueeze(0).expand(feats.shape[0], -1, -1)
+            hint = torch.zeros_like(gt)
+            last_attempt = torch.zeros_like(gt)
+
+            for _ in range(self.n_attempts):
+                logits = self.forward(feats, hint, last_attempt)
+                last_attempt = torch.argmax(logits, dim=3)
+                hint = last_attempt == gt
+
+            return logits
+
+        def forward(self, feats, hint, last_attempt):
+            feats = torch.cat((feats, hint.to(feats.dtype), last_attempt.to(feats.dtype)), dim=2)
+            feats = self.fc_layer(feats)
+            feats = feats.view((feats.shape[0], -1, self.window_size, self.n_classes))
+            return self.softmax(feats)
+
+
+class StackedSGD(object):
+    """SGD with momentum and weight decay where every variant of a stacked parameter has its own learning rate.
+
+    It performs exactly the update of torch.optim.SGD (no dampening, no nesterov), the learning rate of
+    each parameter group is a (n_variants,) tensor broadcast over the leading dimension of the parameters.
+    """
+
+    def __init__(self, param_groups, momentum=0, weight_decay=0):
+        self.param_groups = [{'params': list(group['params']), 'lr': group['lr']} for group in param_groups]
+        self.momentum = momentum
+        self.weight_decay = weight_decay
+        self.momentum_buffers = {}
+
+    @torch.no_grad()
+    def step(self):
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                d_p = p.grad.add(p, alpha=self.weight_decay)
+                if self.momentum != 0:
+                    buf = self.momentum_buffers.get(p)
+                    if buf is None:
+                        buf = self.momentum_buffers[p] = d_p.clone()
+                    else:
+                        buf.mul_(self.momentum).add_(d_p)
+                    d_p = buf
+                lr = group['lr'].to(p.device).view(-1, *([1] * (p.dim() - 1)))
+                p.sub_(lr * d_p)
+
+    def zero_grad(self):
+        for group in self.param_groups:
+            for p in group['params']:
+                p.grad = None
+
+    def state_dict(self):
+        params = [p for group in self.param_groups for p in group['params']]
+        return {'lr': [group['lr'] for group in self.param_groups],
+                'momentum_buffers': {i: self.momentum_buffers[p] for i, p in enumerate(params) if p in self.momentum_buffers}}
+
+    def load_state_dict(self, state_dict):
+        """Restore the learning rates and the momentum buffers of a state_dict of an optimizer of the same model."""
+        params = [p for group in self.param_groups for p in group['params']]
+        if len(state_dict['lr']) != len(self.param_groups):
+            raise ValueError(f"The state has {len(state_dict['lr'])} parameter groups, the optimizer {len(self.param_groups)}")
+        for group, lr in zip(self.param_groups, state_dict['lr']):
+            if lr.shape != group['lr'].shape:
+                raise ValueError(f"The state has learning rates for {lr.numel()} variants, the optimizer for {group['lr'].numel()}")
+            group['lr'] = lr.detach().cpu().clone()
+        self.momentum_buffers = {}
+        for i, buf in state_dict['momentum_buffers'].items():
+            p = params[int(i)]
+            if buf.shape != p.shape:
+                raise ValueError(f"The momentum buffer {i} has shape {tuple(buf.shape)}, its parameter {tuple(p.shape)}")
+            self.momentum_buffers[p] = buf.detach().to(p.device).clone()
+
+
+class StackedDomainAdaptationNER(nn.Module):
+    """DomainAdaptationNER training len(combinations) hyperparameter variants as one stacked model.
+
+    combinations are gridsearch combinations sharing the same architecture (see group_combinations),
+    the values in VARIANT_KEYS missing from a combination are taken from args.
+    """
+
+    def __init__(self, args, combinations) -> None:
+
+        super(StackedDomainAdaptationNER, self).__init__()
+
+        self.args = args
+        self.name = self.args.name
+        self.models_dir = self.args.models_dir
+        self.n_variants = len(combinations)
+
+        self.total_batch = args.total_batch
+        self.batch_size = args.batch_size
+
+        args.blocks = []
+        if not args.remove_window_domain_classifier:
+            args.blocks.append('window_domain_classifier')
+        if not args.remove_token_domain_classifier:
+            args.blocks.append('token_domain_classifier')
+        if not args.remove_wordle_game_module:
+            args.blocks.append('game_module')
+        self.blocks = args.blocks
+
+        variants = {k: [combination.get(k, args[k]) for combination in combinations] for k in VARIANT_KEYS}
+        logger.info(f'Blocks: {self.blocks}, variants: {variants}')
+
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model = StackedAdaptiveModule(args.in_features_dim, args, self.n_variants, variants['beta_token'], variants['beta_window'],
+                                           args.num_classes_source, args.num_classes_target)
+        self.model.to(self.device)
+        self.register_buffer('beta_wordle', torch.tensor(variants['beta_wordle'], dtype=torch.float, device=self.device))
+
+        self.criterion = torch.nn.CrossEntropyLoss(reduction='none')
+
+        discriminators = [getattr(self.model, block) for block in ('token_domain_classifier', 'window_domain_classifier') if block in self.blocks]
+        discriminator_params = set(p for d in discriminators for p in d.parameters())
+        self.optimizer = StackedSGD([{'params': [p for p in self.model.parameters() if p not in discriminator_params],
+                                      'lr': torch.tensor(variants['lr'], dtype=torch.float)},
+                                     {'params': [p for d in discriminators for p in d.parameters()],
+                                      'lr': torch.tensor(variants['lr_discriminator'], dtype=torch.float)}],
+                                    momentum=args.sgd_momentum, weight_decay=args.weight_decay)
+
+        self.accuracy = [{'source': metrics.Accuracy(topk=(1,), classes=args.num_classes_source),
+                          'target': metrics.Accuracy(topk=(1,), classes=args.num_classes_target)} for _ in range(self.n_variants)]
+        self.f1 = [{'source': metrics.F1(topk=(1,), classes=args.num_classes_source),
+                    'target': metrics.F1(topk=(1,), classes=args.num_classes_target)} for _ in range(self.n_variants)]
+        self.best_iter_score = torch.zeros(self.n_variants)
+        self.best_iter = torch.zeros(self.n_variants, dtype=torch.long)
+
+        self.loss = None
+        self.losses = {}
+        self.checkpoint_writer = None
+
+    def forward(self, source=None, target=None, class_labels_source=None, class_labels_target=None, is_train=True):
+        return self.model(source, target, class_labels_source, class_labels_target, is_train=is_train)
+
+    def _variant_loss(self, predictions, labels):
+        """Mean cross entropy of every variant, predictions (B, N, C) and labels (N,) or (N, C)."""
+        n_variants, n = predictions.shape[:2]
+        labels = labels.unsqueeze(0).expand(n_variants, *labels.shape).reshape(n_variants * n, *labels.shape[1:])
+        loss = self.criterion(predictions.reshape(n_variants * n, -1), labels).view(n_variants, n)
+        return loss.mean(dim=1) / (self.total_batch / self.batch_size)
+
+    def compute_loss(self, class_labels_source: 'torch.Tensor', class_labels_target: 'torch.Tensor', predictions: Dict[str, 'torch.Tensor']):
+        """Same losses of DomainAdaptationNER.compute_loss, computed for all the variants at once."""
+        losses = {'cls loss source': self._variant_loss(predictions['preds_class_source'], class_labels_source),
+                  'cls loss target': self._variant_loss(predictions['preds_class_target'], class_labels_target)}
+        loss = losses['cls loss source'] + losses['cls loss target']
+
+        for block, name in [('token_domain_classifier', 'token'), ('window_domain_classifier', 'window')]:
+            if block in self.blocks:
+                preds_source = predictions[f'preds_domain_{name}_source']
+                preds_target = predictions[f'preds_domain_{name}_target']
+                # averaged over the tokens of each domain, the two domains weigh the same whatever their batch sizes
+                source_labels = torch.zeros(preds_source.shape[1], dtype=torch.int64, device=self.device)
+                target_labels = torch.ones(preds_target.shape[1], dtype=torch.int64, device=self.device)
+                losses[f'{name} domain loss'] = (self._variant_loss(preds_source, source_labels) +
+                                                 self._variant_loss(preds_target, target_labels)) / 2
+                loss = loss + losses[f'{name} domain loss']
+
+        if 'game_module' in self.blocks:
+            wordle_loss = 0
+            for domain, num_classes in [('source', self.args.num_classes_source), ('target', self.args.num_classes_target)]:
+                wordle = predictions[f'wordle_{domain}']  # Dimension: (variants, windows_in_batch, window_size, num_classes)
+                one_hot = torch.nn.functional.one_hot(predictions[f'window_class_labels_{domain}'].long(), num_classes=num_classes).to(wordle.dtype)
+
+                position_loss = self._variant_loss(wordle.flatten(1, 2), one_hot.view(-1, num_classes))
+                wordle_window = 1 - torch.prod(1 - wordle, dim=2)
+                window_loss = self._variant_loss(wordle_window, one_hot.sum(dim=1))
+
+                losses[f'cls wordle {domain}'] = window_loss
+                wordle_loss = wordle_loss + position_loss + window_loss
+            loss = loss + self.beta_wordle * wordle_loss
+
+        self.losses = {k: v.detach() for k, v in losses.items()}
+        self.loss = loss.sum()
+
+    def count_correct(self, output: Dict[str, 'torch.Tensor'], class_labels_source: 'torch.Tensor' = None, class_labels_target: 'torch.Tensor' = None):
+        """Top-1 correct predictions of every variant on the current batch, as ((n_variants,) tensor, tokens) pairs.
+
+        The counts stay on the device, so that the accuracy of a whole accumulated step costs a single copy.
+        """
+        counts = {}
+        for domain, labels in [('source', class_labels_source), ('target', class_labels_target)]:
+            if labels is not None:
+                counts[domain] = ((output[f'preds_class_{domain}'].argmax(dim=2) == labels).sum(dim=1), labels.shape[0])
+        return counts
+
+    def update_val_metrics(self, output: Dict[str, 'torch.Tensor'], class_labels: 'torch.Tensor', domain: str):
+        for variant in range(self.n_variants):
+            self.accuracy[variant][domain].update(output[f'preds_class_{domain}'][variant], class_labels)
+
+    def reset_acc(self):
+        for variant in range(self.n_variants):
+            for domain in ('source', 'target'):
+                self.accuracy[variant][domain].reset()
+                self.f1[variant][domain].reset()
+
+    def backward(self, retain_graph: bool = False):
+        self.loss.backward(retain_graph=retain_graph)
+
+    def step(self):
+        self.optimizer.step()
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def reduce_learning_rate(self):
+        for param_group in self.optimizer.param_groups:
+            param_group['lr'] = param_group['lr'] / 10
+
+    def train(self, mode: bool = True):
+        self.model.train(mode)
+        return self
+
+    def save_model(self, current_iter: int, path: str):
+        """Save the stacked model, the per-variant learning rates and momentum buffers and the best scores."""
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(os.path.dirname(path), keep_last=self.args.keep_checkpoints)
+        self.checkpoint_writer.save(
+            {
+                "iteration": current_iter,
+                "best_iter": self.best_iter,
+                "best_iter_score": self.best_iter_score,
+                "model_state_dict": self.model.state_dict(),
+                "optimizer_state_dict": self.optimizer.state_dict(),
+            },
+            os.path.basename(path),
+            iteration=int(current_iter),
+        )
+
+    def load_checkpoint(self, path: str):
+        """Restore the stacked model, its optimizer and the best scores saved by save_model, return the iteration."""
+        checkpoint = torch.load(path, map_location='cpu')
+        self.model.load_state_dict(checkpoint["model_state_dict"], strict=True)
+        self.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+        self.best_iter = checkpoint["best_iter"]
+        self.best_iter_score = checkpoint["best_iter_score"]
+        return checkpoint["iteration"]
+
+    def flush_checkpoints(self):
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
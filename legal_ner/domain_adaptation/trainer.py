@@ -0,0 +1,712 @@
+import torch
+from torch.utils.data import DataLoader
+import os
+import numpy as np
+from domain_adaptation_ner import DomainAdaptationNER, chunk_tokens
+from utils.logger import logger
+from utils.asha import ASHAScheduler
+from stacked_ensemble import StackedDomainAdaptationNER, group_combinations
+from export import ExportedHead, build_tagger_head, export_head
+from embeddingsDataLoader import EmbeddingDataset, DocumentChunkDataset, ResumableRandomSampler, ClassBalancedTokenSampler
+from omegaconf import OmegaConf
+from copy import deepcopy
+from utils.projection import Projector, ProjectionWorker, stratified_indices
+from utils.profiler import StepProfiler
+from utils.metrics_sink import MetricsSink, default_log_dir
+from utils.domains import domain_specs
+import itertools
+import yaml
+from datetime import datetime
+import random
+
+# set by main, the functions of this module read the arguments of the run from here
+args = None
+writer = None
+projection_worker = None
+
+
+def get_combinations(config_path):
+    with open(config_path, 'r') as file:
+        config = yaml.safe_load(file)
+    keys, values = zip(*config.items())
+    combinations = [dict(zip(keys, v)) for v in itertools.product(*values)]
+    return combinations
+
+
+def load_train_dataset(embeddings_path, labels_path, offsets_path):
+    """
+    function to load a training dataset: chunks of args.chunk_len tokens of the same document if the offsets of the
+    documents (saved by extract_embeddings) are given and chunk_len > 0, single tokens otherwise
+    """
+    if offsets_path is not None and args.chunk_len > 0:
+        return DocumentChunkDataset(embeddings_path, labels_path, offsets_path, args.chunk_len)
+    return EmbeddingDataset(embeddings_path, labels_path)
+
+
+def build_sampler(dataset, seed, run_args):
+    """
+    function to build the resumable sampler of a training dataset chosen by run_args.sampling
+    uniform shuffles the tokens, balanced draws every class equally and temperature draws the classes with
+    probability proportional to their frequency ** (1 / sampling_temperature), the O tokens are kept with
+    probability o_keep in all the modes (see ClassBalancedTokenSampler)
+    """
+    if run_args.sampling == 'uniform' and run_args.o_keep == 1:
+        return ResumableRandomSampler(dataset, seed=seed)
+    if isinstance(dataset, DocumentChunkDataset):
+        raise ValueError("The chunks of the documents can only be shuffled uniformly, use --sampling uniform and --o_keep 1")
+    if run_args.sampling == 'uniform':
+        temperature = 1.0
+    elif run_args.sampling == 'balanced':
+        temperature = float('inf')
+    elif run_args.sampling == 'temperature':
+        temperature = run_args.sampling_temperature
+    else:
+        raise ValueError(f"Unknown sampling {run_args.sampling}, expected uniform, balanced or temperature")
+    return ClassBalancedTokenSampler(dataset.labels, seed=seed, temperature=temperature, o_keep=run_args.o_keep)
+
+
+def build_train_loader(dataset, batch_size, seed, run_args):
+    """
+    function to build a training dataloader whose position can be saved in the checkpoints
+    the loader has its own generator, so creating its iterators does not consume the global RNG restored on resume
+    batch_size is in tokens, a DocumentChunkDataset is batched in batch_size // chunk_len chunks
+    """
+    if isinstance(dataset, DocumentChunkDataset):
+        batch_size = max(batch_size // dataset.chunk_len, 1)
+    sampler = build_sampler(dataset, seed, run_args)
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, generator=generator)
+
+
+def load_datasets(run_args):
+    """
+    function to load the training and validation datasets of the domains of run_args (see utils/domains.py)
+    returns two dicts domain -> dataset, in the order of the domains (the source first)
+    """
+    train_datasets, val_datasets = {}, {}
+    for spec in domain_specs(run_args):
+        train_datasets[spec['name']] = load_train_dataset(spec['embeddings'], spec['labels'], spec['offsets'])
+        val_datasets[spec['name']] = EmbeddingDataset(spec['val_embeddings'], spec['val_labels'])
+    return train_datasets, val_datasets
+
+
+def build_train_loaders(train_datasets, run_args):
+    """
+    function to build the training dataloaders of the domains, a dict domain -> dataset with the source first
+    the token budget of a step (batch_size for every domain) is split equally, or with run_args.source_ratio of it
+    taken from the source and the rest split equally between the targets: one source batch serves all the targets
+    the losses of every domain are normalised by its own tokens, so the split changes the tokens each domain
+    contributes to a step and not how much it weighs in the loss
+    returns a dict domain -> dataloader
+    """
+    domains = list(train_datasets)
+    n_targets = len(domains) - 1
+    budget = len(domains) * run_args.batch_size
+    if run_args.source_ratio is None:
+        source_batch_size = run_args.batch_size
+    else:
+        source_batch_size = min(max(int(round(budget * run_args.source_ratio)), 1), budget - n_targets)
+    batch_sizes = [source_batch_size] + [(budget - source_batch_size) // n_targets + (i < (budget - source_batch_size) % n_targets)
+                                         for i in range(n_targets)]
+    return {domain: build_train_loader(train_datasets[domain], batch_size, run_args.seed + i, run_args)
+            for i, (domain, batch_size) in enumerate(zip(domains, batch_sizes))}
+
+
+def make_writer(log_dir=None):
+    """
+    function to build the MetricsSink of a run with the backends chosen in args
+    log_dir: directory of the run, by default the one SummaryWriter would use
+    """
+    return MetricsSink(log_dir if log_dir is not None else default_log_dir(),
+                       backends=args.metrics_backends.split(','), flush_every=args.metrics_flush_every)
+
+
+def main(run_args):
+    """
+    function to run the action of run_args (parsed by utils.args.get_args), the entry point is train.py
+    """
+    global args, training_iterations, writer
+    args = run_args
+
+    # device where everything is run
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # initialization and dropout are seeded, a resumed run then restores the RNG states saved in the checkpoint
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    # these dictionaries are for more multi-modal training/testing, each key is a modality used
+    # the models are wrapped into the ActionRecognition task which manages all the training steps
+    classifier = DomainAdaptationNER(args)
+    classifier.load_on_gpu(device)
+
+    if args.action in ("train", "validate"):
+        writer = make_writer(args.run_name)
+        classifier.writer = writer
+
+    if args.action == "train":
+        # define number of iterations I'll do with the actual batch: we do not reason with epochs but with iterations
+        # i.e. number of batches passed
+        # notice, here it is multiplied by tot_batch/batch_size since gradient accumulation technique is adopted
+        training_iterations = args.num_iter * (args.total_batch // args.batch_size)
+        # all dataloaders are generated here
+
+        train_datasets, val_datasets = load_datasets(args)
+        train_loaders = build_train_loaders(train_datasets, args)
+        val_loaders = {domain: DataLoader(dataset, batch_size=1) for domain, dataset in val_datasets.items()}
+        classifier.samplers = {domain: loader.sampler for domain, loader in train_loaders.items()}
+
+        # resume_from argument is adopted in case of restoring from a checkpoint,
+        # the samplers are restored too so that the loaders continue from the same position
+        if args.resume_from is not None:
+            classifier.load_last_model(args.resume_from)
+
+        train(classifier, train_loaders, val_loaders, device)
+        wait_projections()
+        writer.close()
+
+
+    elif args.action == "validate":
+        if args.resume_from is not None:
+            classifier.load_last_model(args.resume_from)
+        for spec in domain_specs(args):
+            val_loader = DataLoader(EmbeddingDataset(spec['val_embeddings'], spec['val_labels']), batch_size=1)
+            validate(classifier, val_loader, device, classifier.current_iter, spec['name'])
+        writer.close()
+    
+    elif args.action == "gridsearch":
+        run_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        combinations = get_combinations(args.gridsearch_config)
+        random.shuffle(combinations)
+        old_args = deepcopy(args)
+        num_combinations = min(args.grid_combinations, len(combinations))
+        for combination in combinations[:num_combinations]:
+            try:
+                writer = make_writer("runs/gridsearch_{}/{}".format(run_time, combination))
+                args = OmegaConf.merge(vars(old_args), combination)
+            except:
+                raise Exception(f"Could not load args from {args.gridsearch_config}, type of combination: {type(combination)}, type of old args: {type(vars(old_args))}")
+            if args.resume_from is not None:
+                classifier.load_last_model(args.resume_from)
+            classifier = DomainAdaptationNER(args)
+            classifier.load_on_gpu(device)
+            classifier.writer = writer
+            # define number of iterations I'll do with the actual batch: we do not reason with epochs but with iterations
+            # i.e. number of batches passed
+            # notice, here it is multiplied by tot_batch/batch_size since gradient accumulation technique is adopted
+            training_iterations = args.num_iter * (args.total_batch // args.batch_size)
+            # all dataloaders are generated here
+
+            train_datasets, val_datasets = load_datasets(args)
+            train_loaders = build_train_loaders(train_datasets, args)
+            val_loaders = {domain: DataLoader(dataset, batch_size=1) for domain, dataset in val_datasets.items()}
+            classifier.samplers = {domain: loader.sampler for domain, loader in train_loaders.items()}
+
+            train(classifier, train_loaders, val_loaders, device)
+            wait_projections()
+            writer.close()
+
+    elif args.action == "asha":
+        run_asha(args, device)
+
+    elif args.action == "export":
+        export_tagger(classifier, device)
+
+    elif args.action == "ensemble":
+        run_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        combinations = get_combinations(args.gridsearch_config)
+        random.shuffle(combinations)
+        combinations = combinations[:min(args.grid_combinations, len(combinations))]
+        old_args = deepcopy(args)
+
+        train_datasets, val_datasets = load_datasets(args)
+        if len(train_datasets) != 2:
+            raise ValueError("The stacked ensemble is trained on one source and one target, the domains are {}".format(list(train_datasets)))
+        val_source, val_target = val_datasets.values()
+        train_loader_source, train_loader_target = build_train_loaders(train_datasets, args).values()
+        # validation does not build windows, so tokens can be classified in batches without changing the results
+        val_loader_source = DataLoader(val_source, batch_size=args.batch_size)
+        val_loader_target = DataLoader(val_target, batch_size=args.batch_size)
+
+        for i_group, (architecture, group) in enumerate(group_combinations(combinations, args.ensemble_size)):
+            group_args = OmegaConf.merge(vars(old_args), architecture)
+            group_args.experiment_dir = os.path.join(old_args.experiment_dir, "ensemble_{}".format(run_time))
+            classifier = StackedDomainAdaptationNER(group_args, group)
+            writers = [make_writer("runs/ensemble_{}/{}".format(run_time, dict(combination, **architecture))) for combination in group]
+            logger.info("Training stacked ensemble {} with {} variants".format(i_group, len(group)))
+            train_ensemble(classifier, writers, train_loader_source, train_loader_target, val_loader_source, val_loader_target,
+                           device, os.path.join(group_args.models_dir, group_args.experiment_dir, "ensemble_{}.pth".format(i_group)),
+                           group_args)
+            for w in writers:
+                w.close()
+
+
+def run_asha(args, device):
+    """
+    function to run the asynchronous successive halving search over the gridsearch combinations
+    args: parsed arguments, the combinations are read from args.gridsearch_config
+    device: device on which you want to train
+
+    Each sampled combination is a trial: it is trained for the budget of its rung, then it is validated
+    and paused on its last checkpoint. Only the best 1/asha_eta trials of each rung are resumed and trained
+    up to the budget of the next rung, the objective is the same used to track the best iteration
+    (sum of the validation accuracies of the domains).
+    The search can be resumed by passing its directory with --resume_from.
+    """
+    global writer, training_iterations
+
+    if args.resume_from is not None:
+        search_dir = args.resume_from
+        scheduler = ASHAScheduler.load(os.path.join(search_dir, 'asha_state.json'))
+        run_time = os.path.basename(os.path.normpath(search_dir)).replace('asha_', '')
+        logger.info("Resuming ASHA search from {}".format(search_dir))
+    else:
+        run_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        search_dir = os.path.join(args.models_dir, args.experiment_dir, "asha_{}".format(run_time))
+        os.makedirs(search_dir, exist_ok=True)
+        combinations = get_combinations(args.gridsearch_config)
+        random.shuffle(combinations)
+        combinations = combinations[:min(args.grid_combinations, len(combinations))]
+        min_iter = args.asha_min_iter if args.asha_min_iter is not None else args.eval_freq
+        scheduler = ASHAScheduler(combinations, min_iter, args.num_iter, eta=args.asha_eta, eval_freq=args.eval_freq,
+                                  state_path=os.path.join(search_dir, 'asha_state.json'))
+        scheduler.save()
+    logger.info("ASHA rungs (real iterations): {}".format(scheduler.rungs))
+
+    # the datasets are the same for every trial, so they are loaded only once
+    train_datasets, val_datasets = load_datasets(args)
+
+    old_args = deepcopy(args)
+    job = scheduler.next_job()
+    while job is not None:
+        trial, rung = job
+        trial_args = OmegaConf.merge(vars(old_args), trial['config'])
+        trial_args.experiment_dir = os.path.join(os.path.relpath(search_dir, args.models_dir), "trial_{}".format(trial['id']))
+        logger.info("ASHA trial {} ({}) -> rung {}, budget {}".format(trial['id'], trial['config'], rung, scheduler.budget(rung)))
+
+        writer = make_writer("runs/asha_{}/{}".format(run_time, trial['config']))
+        classifier = DomainAdaptationNER(trial_args)
+        classifier.load_on_gpu(device)
+        classifier.writer = writer
+
+        training_iterations = scheduler.budget(rung) * (trial_args.total_batch // trial_args.batch_size)
+        train_loaders = build_train_loaders(train_datasets, trial_args)
+        val_loaders = {domain: DataLoader(dataset, batch_size=1) for domain, dataset in val_datasets.items()}
+        classifier.samplers = {domain: loader.sampler for domain, loader in train_loaders.items()}
+        # a promoted trial continues from the data position and RNG state where its previous rung stopped
+        if trial['checkpoint'] is not None:
+            classifier.load_checkpoint(trial['checkpoint'])
+
+        val_metrics = train(classifier, train_loaders, val_loaders, device, tsne=False)
+        writer.close()
+
+        score = sum(metrics['top1'] for metrics in val_metrics.values())
+        scheduler.report(trial, rung, score, classifier.last_checkpoint_path)
+        logger.info("ASHA trial {} reached rung {} with score {:.2f}".format(trial['id'], rung, score))
+        job = scheduler.next_job()
+
+    best = scheduler.best()
+    logger.info("ASHA search finished, best trial {} ({}) at rung {} with score {:.2f}, checkpoint {}".format(
+        best['id'], best['config'], best['rung'], best['scores'][str(best['rung'])], best['checkpoint']))
+
+
+def export_tagger(classifier, device):
+    """
+    function to export the task head of the domain args.export_domain of the best checkpoint in args.resume_from (see export.py)
+    the exported head is checked against the model in evaluation mode on random embeddings
+    """
+    if args.resume_from is None:
+        raise ValueError("The export needs the checkpoint directory of the run in --resume_from")
+    classifier.load_best_model(args.resume_from)
+    classifier.train(False)
+    model = classifier.model.module if isinstance(classifier.model, torch.nn.DataParallel) else classifier.model
+    head = build_tagger_head(model, args.export_domain)
+
+    metadata = {'domain': args.export_domain, 'source': args.export_domain == classifier.domains[0],
+                'iteration': classifier.current_iter, 'checkpoint_dir': args.resume_from}
+    export_head(head, args.export_path, args.export_format, args.export_int8, metadata)
+
+    embeddings = torch.randn(256, args.in_features_dim, device=device)
+    with torch.no_grad():
+        expected = classifier(feats={args.export_domain: embeddings}, is_train=False)[f'preds_class_{args.export_domain}'].cpu()
+    exported = ExportedHead(args.export_path)(embeddings)
+    agreement = (exported.argmax(dim=1) == expected.argmax(dim=1)).float().mean().item()
+    logger.info("Exported the {} head of iteration {} to {} ({}{}): max logit difference {:.2e}, same prediction on {:.1%} of random embeddings".format(
+        args.export_domain, classifier.current_iter, args.export_path, args.export_format, ', int8' if args.export_int8 else '',
+        (exported - expected).abs().max().item(), agreement))
+
+
+def make_tsne(model, val_loaders, device, name=None):
+    """
+    function to project in 2D the features of the validation tokens of the domains and log the plot in TensorBoard
+    val_loaders: dict domain -> validation dataloader
+    only args.projection_max_per_class tokens of each class and domain are used, always the same ones, and the model
+    is run only on them. The projection is made on a background thread, use wait_projections before closing the writer
+    """
+    global projection_worker
+    if projection_worker is None:
+        projection_worker = ProjectionWorker(Projector(args.projection_method, pca_components=args.projection_pca,
+                                                       seed=args.seed))
+    model.train(False)
+    features_list = []
+    domains_list = []
+
+    with torch.no_grad():
+        # the points of every domain are labelled with its index, 0 for the source
+        for i_domain, (domain, dataloader) in enumerate(val_loaders.items()):
+            dataset = dataloader.dataset
+            idx = stratified_indices(dataset.labels, args.projection_max_per_class, seed=args.seed)
+            for chunk in idx.split(4096):
+                inputs = dataset.embeddings[chunk.to(dataset.embeddings.device)].to(device)
+                features_list.append(model(feats={domain: inputs}, is_train=False)['feats_fcl'].cpu())
+            domains_list.append(np.full(len(idx), i_domain))
+
+    features = torch.cat(features_list).numpy()
+    domains = np.concatenate(domains_list)
+    projection_worker.submit(writer, name if name is not None else 't-SNE', features, domains)
+
+    model.train(True)
+
+
+def wait_projections():
+    """function to wait until the projections submitted by make_tsne are logged"""
+    if projection_worker is not None:
+        projection_worker.flush()
+
+
+def train(classifier, train_loaders, val_loaders, device, tsne=True):
+    """
+    function to train the model on the test set
+    classifier: Task containing the model to be trained
+    train_loaders: dict domain -> dataloader containing the training data, the source first
+    val_loaders: dict domain -> dataloader containing the validation data
+    device: device on which you want to test
+    tsne: bool, whether to make the t-SNE of the features before and after training
+    returns a dict domain -> metrics of the last validation
+    """
+
+    global training_iterations, modalities
+
+    data_loaders = {domain: iter(loader) for domain, loader in train_loaders.items()}
+
+    classifier.train(True)
+    classifier.zero_grad()
+    iteration = classifier.current_iter * (args.total_batch // args.batch_size)
+    val_metrics = None
+
+    # the batch size should be total_batch but batch accumulation is done with batch size = batch_size.
+    # real_iter is the number of iterations if the batch size was really total_batch
+    
+    if tsne:
+        # the projection runs in background, only the features of the sampled tokens are computed here
+        make_tsne(classifier, val_loaders, device, name='t-SNE before training')
+
+    # with --profile every phase of the steps is timed, see utils/profiler.py
+    profiler = StepProfiler(enabled=args.profile, trace_steps=args.profile_steps, device=device,
+                            output_dir=os.path.join(args.log_dir, 'profile'),
+                            name=args.run_name if args.run_name is not None else datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+    profiler.start()
+
+    for i in range(iteration, training_iterations):
+        # iteration w.r.t. the paper (w.r.t the bs to simulate).... i is the iteration with the actual bs( < tot_bs)
+        real_iter = (i + 1) / (args.total_batch // args.batch_size)
+        if real_iter == args.lr_step:
+            # learning rate decay at iteration = lr_steps
+            classifier.reduce_learning_rate()
+        # gradient_accumulation_step is a bool used to understand if we accumulated at least total_batch
+        # samples' gradient
+        gradient_accumulation_step = real_iter.is_integer()
+
+        """
+        Retrieve the data from the loaders
+        """
+        # the following code is necessary as we do not reason in epochs so as soon as the dataloader is finished we need
+        # to redefine the iterator
+        with profiler.phase('data'):
+            batches = {}
+            for domain, loader in train_loaders.items():
+                try:
+                    batches[domain] = next(data_loaders[domain])
+
+                except StopIteration:
+                    data_loaders[domain] = iter(loader)
+                    batches[domain] = next(data_loaders[domain])
+
+        with profiler.phase('h2d'):
+            labels = {domain: label.to(device) for domain, (_, label) in batches.items()}
+            data = {domain: batch_data.to(device) for domain, (batch_data, _) in batches.items()}
+
+        with profiler.phase('forward'):
+            output = classifier.forward(feats=data, class_labels=labels)
+
+        with profiler.phase('loss'):
+            # the outputs are per token, without the padding of the chunks
+            labels = {domain: chunk_tokens(label, label) for domain, label in labels.items()}
+            classifier.compute_loss(predictions=output, class_labels=labels)
+        with profiler.phase('backward'):
+            classifier.backward(retain_graph=False)
+        with profiler.phase('accuracy'):
+            classifier.compute_accuracy(output, class_labels=labels)
+
+        # update weights and zero gradients if total_batch samples are passed
+        if gradient_accumulation_step:
+            classifier.current_iter = int(real_iter)
+            with profiler.phase('logging'):
+                # the values stay on the device, the writer copies them to the host in batches
+                for domain in classifier.domains:
+                    writer.add_scalar(f'train/cls loss {domain}', getattr(classifier, f'classification_loss_{domain}').val, global_step=int(real_iter))
+                    writer.add_scalar(f'train/cls wordle {domain}', getattr(classifier, f'wordle_{domain}_window_loss').val, global_step=int(real_iter))
+                writer.add_scalar('train/token domain loss', classifier.domain_token_loss.val, global_step=int(real_iter))
+                writer.add_scalar('train/window domain loss', classifier.domain_window_loss.val, global_step=int(real_iter))
+                for domain in classifier.domains:
+                    writer.add_scalar(f'train/accuracy {domain}', classifier.accuracy[domain].val[1], global_step=int(real_iter))
+                    writer.add_scalar(f'train/accuracy {domain} by classes', classifier.accuracy[domain].mean_class_accuracy(), global_step=int(real_iter))
+
+            with profiler.phase('check_grad'):
+                classifier.check_grad()
+            with profiler.phase('optimizer'):
+                classifier.step()
+                classifier.zero_grad()
+
+        # every eval_freq "real iteration" (iterations on total_batch) the validation is done, notice we validate and
+        # save the last 9 models
+
+        if gradient_accumulation_step and real_iter % args.eval_freq == 0:
+            logger.info("Iteration: {}".format(i))
+            with profiler.phase('validation'):
+                val_metrics = {domain: validate(classifier, loader, device, int(real_iter), domain)
+                               for domain, loader in val_loaders.items()}
+            classifier.log_grad_health()
+
+            # the score of an iteration is the sum of the accuracies of all the domains
+            score = sum(metrics['top1'] for metrics in val_metrics.values())
+            if score > classifier.best_iter_score:
+                logger.info("New best average accuracy: {}".format(
+                    ", ".join("{}={:.2f}%".format(domain, metrics['top1']) for domain, metrics in val_metrics.items())))
+                logger.info("Old best score: {:.2f}%".format(classifier.best_iter_score))
+                classifier.best_iter = real_iter
+                classifier.best_iter_score = score
+
+            with profiler.phase('checkpoint'):
+                classifier.save_model(real_iter, score, prefix=None)
+            classifier.train(True)
+
+        profiler.step()
+
+    classifier.flush_checkpoints()
+    summary = profiler.stop()
+    if summary is not None:
+        logger.info("Time spent in each phase of the training steps:\n" + summary)
+
+    if tsne:
+        make_tsne(classifier, val_loaders, device, name='t-SNE after training')
+
+    return val_metrics
+
+
+def train_ensemble(classifier, writers, train_loader_source, train_loader_target, val_loader_source, val_loader_target, device, checkpoint_path,
+                   run_args):
+    """
+    function to train a stacked ensemble, every variant sees the same batches of the same loaders
+    classifier: StackedDomainAdaptationNER containing the variants to be trained
+    writers: list of MetricsSink, one for each variant
+    checkpoint_path: file where the stacked model is saved at every validation
+    run_args: arguments of the ensemble (iterations, batches, learning rate decay and validation frequency)
+    """
+    training_iterations = run_args.num_iter * (run_args.total_batch // run_args.batch_size)
+
+    data_loader_source = iter(train_loader_source)
+    data_loader_target = iter(train_loader_target)
+
+    classifier.train(True)
+    classifier.zero_grad()
+    # correct predictions and tokens of the batches of the current accumulated step
+    correct, tokens = {}, {}
+
+    for i in range(training_iterations):
+        real_iter = (i + 1) / (run_args.total_batch // run_args.batch_size)
+        if real_iter == run_args.lr_step:
+            classifier.reduce_learning_rate()
+        gradient_accumulation_step = real_iter.is_integer()
+
+        try:
+            source_data, source_label = next(data_loader_source)
+        except StopIteration:
+            data_loader_source = iter(train_loader_source)
+            source_data, source_label = next(data_loader_source)
+
+        try:
+            target_data, target_label = next(data_loader_target)
+        except StopIteration:
+            data_loader_target = iter(train_loader_target)
+            target_data, target_label = next(data_loader_target)
+
+        source_label = source_label.to(device)
+        target_label = target_label.to(device)
+        data_source = source_data.to(device)
+        data_target = target_data.to(device)
+        # the stacked model works on tokens, the chunks are flattened and its windows span the whole batch
+        data_source, source_label = chunk_tokens(data_source, source_label), chunk_tokens(source_label, source_label)
+        data_target, target_label = chunk_tokens(data_target, target_label), chunk_tokens(target_label, target_label)
+
+        output = classifier(data_source, data_target, source_label, target_label)
+        classifier.compute_loss(source_label, target_label, output)
+        classifier.backward(retain_graph=False)
+        for domain, (n_correct, n_tokens) in classifier.count_correct(output, source_label, target_label).items():
+            correct[domain] = correct[domain] + n_correct if domain in correct else n_correct
+            tokens[domain] = tokens.get(domain, 0) + n_tokens
+
+        if gradient_accumulation_step:
+            # a single device to host copy for the losses and accuracies of all the variants
+            scalars = dict(classifier.losses)
+            for domain in correct:
+                scalars[f'accuracy {domain}'] = correct[domain] * 100 / max(tokens[domain], 1)
+            correct, tokens = {}, {}
+            values = torch.stack([v.float() for v in scalars.values()]).cpu()
+            for variant, w in enumerate(writers):
+                for tag, value in zip(scalars.keys(), values):
+                    w.add_scalar(f'train/{tag}', value[variant].item(), global_step=int(real_iter))
+
+            classifier.step()
+            classifier.zero_grad()
+
+        if gradient_accumulation_step and real_iter % run_args.eval_freq == 0:
+            logger.info("Iteration: {}".format(i))
+            val_metrics_source = validate_ensemble(classifier, writers, val_loader_source, device, int(real_iter), 'source')
+            val_metrics_target = validate_ensemble(classifier, writers, val_loader_target, device, int(real_iter), 'target')
+
+            for variant in range(classifier.n_variants):
+                score = val_metrics_source[variant]['top1'] + val_metrics_target[variant]['top1']
+                if score > classifier.best_iter_score[variant]:
+                    logger.info("Variant {}: new best average accuracy: source={:.2f}%, target={:.2f}%".format(
+                        variant, val_metrics_source[variant]['top1'], val_metrics_target[variant]['top1']))
+                    classifier.best_iter[variant] = int(real_iter)
+                    classifier.best_iter_score[variant] = score
+
+            classifier.save_model(real_iter, checkpoint_path)
+            classifier.train(True)
+
+    classifier.flush_checkpoints()
+
+
+def validate_ensemble(model, writers, val_loader, device, it, domain):
+    """
+    function to validate all the variants of a stacked ensemble, see validate
+    returns a list with the test results of each variant
+    """
+    model.reset_acc()
+    model.train(False)
+
+    all_output = []
+    all_labels = []
+
+    with torch.no_grad():
+        for data, label in val_loader:
+            label = label.to(device)
+            data = data.to(device)
+
+            if domain == 'source':
+                output = model(source=data, is_train=False)
+            else:
+                output = model(target=data, is_train=False)
+            model.update_val_metrics(output, label, domain)
+
+            all_output.append(output[f'preds_class_{domain}'])
+            all_labels.append(label)
+
+        all_labels = torch.cat(all_labels, dim=0)
+        all_output = torch.cat(all_output, dim=1)
+
+    test_results = []
+    for variant, w in enumerate(writers):
+        accuracy = model.accuracy[variant][domain]
+        f1 = model.f1[variant][domain]
+        f1.update(all_output[variant], all_labels)
+
+        class_accuracies = accuracy.class_accuracies().cpu().numpy()
+        avg_acc = float(accuracy.mean_class_accuracy())
+        logger.info('Variant {} domain {}: accuracy {:.2f}%, accuracy by classes {:.2f}%, F1 {:.2f}'.format(
+            variant, domain, accuracy.avg[1], avg_acc, f1.avg[1]))
+
+        w.add_scalar(f'val/accuracy {domain}', accuracy.avg[1], global_step=int(it))
+        w.add_scalar(f'val/f1 {domain}', f1.avg[1], global_step=int(it))
+        w.add_scalar(f'val/accuracy {domain} by classes', avg_acc, global_step=int(it))
+
+        test_results.append({'top1': float(accuracy.avg[1]),
+                             'class_accuracies': class_accuracies,
+                             'f1': f1.avg[1],
+                             'domain': domain})
+
+    model.train(True)
+    return test_results
+
+
+def validate(model, val_loader, device, it, domain):
+    """
+    function to validate the model on the test set
+    model: Task containing the model to be tested
+    val_loader: dataloader containing the validation data
+    device: device on which you want to test
+    it: int, iteration among the training num_iter at which the model is tested
+    num_classes: int, number of classes in the classification problem
+    """
+    global modalities
+
+    model.reset_acc()
+    model.train(False)
+
+    all_output = []
+    all_labels = []
+
+    # Iterate over the models
+    with torch.no_grad():
+        for i_val, (data, label) in enumerate(val_loader):
+            label = label.to(device)
+            data = data.to(device)
+
+            output = model(feats={domain: data}, is_train=False)
+            model.compute_accuracy(output, class_labels={domain: label})
+            
+            all_output.append(output[f'preds_class_{domain}'])
+            all_labels.append(label)
+
+            if (i_val + 1) % (len(val_loader) // 5) == 0:
+                logger.info("Domain {} [{}/{}] {:.3f}%".format(domain, i_val + 1, len(val_loader),
+                                                                          model.accuracy[domain].avg[1]))
+        all_labels = torch.cat(all_labels, dim=0)
+        all_output = torch.cat(all_output, dim=0)
+
+        model.compute_f1(all_output, all_labels, domain)
+
+        class_accuracies = model.accuracy[domain].class_accuracies().cpu().numpy()
+        # class_accuracies_text = [f'({x} / {y})' for x, y in zip(model.accuracy[domain].correct, model.accuracy[domain].total)]
+        logger.info('Final accuracy: %.2f%%' % (model.accuracy[domain].avg[1],))
+        # logger.info(f'Accuracy by class: {class_accuracies_text}')
+        for i_class, class_acc in enumerate(class_accuracies):
+            if not np.isnan(class_acc):
+                logger.info('Class %d = [%d/%d] = %.2f%%' % (i_class,
+                                                         int(model.accuracy[domain].correct[i_class]),
+                                                         int(model.accuracy[domain].total[i_class]),
+                                                         class_acc))
+    writer.add_scalar(f'val/accuracy {domain}', model.accuracy[domain].avg[1], global_step=int(it))
+    writer.add_scalar(f'val/f1 {domain}', model.f1[domain].avg[1], global_step=int(it))
+    
+    avg_acc = float(model.accuracy[domain].mean_class_accuracy())
+    writer.add_scalar(f'val/accuracy {domain} by classes', avg_acc, global_step=int(it))
+
+    logger.info('Accuracy by averaging class accuracies (same weight for each class): {}%'
+                .format(avg_acc))
+    test_results = {'top1': float(model.accuracy[domain].avg[1]),
+                    'class_accuracies': class_accuracies,
+                    'f1':  model.f1[domain].avg[1],
+                    'domain': domain}
+    if args.run_name is None:
+        # Save the run with the date and time
+        run_name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    else:
+        run_name = args.run_name
+    with open(os.path.join(args.log_dir, f'val_precision_{domain}_{run_name}.txt'), 'a+') as f:
+        f.write("[%d/%d]\tAcc@: %.2f%%\tAcc class %.2f%%\tF1 %.2f%%" % (it, args.num_iter, test_results['top1'], avg_acc, test_results['f1']))
+
+    model.train(True)
+    return test_results
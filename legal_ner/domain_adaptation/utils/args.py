@@ -1,57 +1,83 @@
 import argparse
-from torch.utils.tensorboard import SummaryWriter
 
-# Initialize the pars
 
-parser = argparse.ArgumentParser(description="A simple command line argument parser")
+def build_parser():
+    """Return the parser of the arguments of the domain adaptation training."""
+    parser = argparse.ArgumentParser(description="A simple command line argument parser")
 
-# Add the arguments
-parser.add_argument("--in_features_dim", help="The dimension of the feature vector/embedding in input", type=int, default=1024)
-parser.add_argument("--num_classes_target", help="Number of classes of the target", type=int, default=29)
-parser.add_argument("--num_classes_source", help="Number of classes of the source", type=int, default=29)
-parser.add_argument("--num_fcl", help="Number of fcl in ", type=int, default=1)
-parser.add_argument("--eval_freq", help="Evaluation frequency", type=int, default=300)
-parser.add_argument("--action", help="Train or validate", type=str, default="train")
-parser.add_argument("--resume_from", help="Checkpoint path if needed", default=None, type=str)
-parser.add_argument("--num_iter", help="Number of iterations for training", default=5000, type=int)
-parser.add_argument("--total_batch", type=int, default=256)
-parser.add_argument("--batch_size", type=int, default=64)
-parser.add_argument("--lr_step", help="At which iteration to decrease learning rate", type=int, default=3000)
-parser.add_argument("--log_dir", help="Where to store file for log and results", type=str, default=".")
-parser.add_argument("--lr", help="Learning rate of the task", type=float, default=0.01)
-parser.add_argument("--lr_discriminator", help="Learning rate of the discriminator", type=float, default=0.002)
-parser.add_argument("--weight_decay", help="Weight decay for regularisation", type=float, default=1e-6)
-parser.add_argument("--sgd_momentum", help="Momentum of the sgd optimiser", type=float, default=1e-4)
-parser.add_argument("--experiment_dir", help="Directory where to store model if needed", type=str, default='experiments')
-parser.add_argument("--remove_window_domain_classifier", help="Removes the window domain classifier", action='store_true', default=False)
-parser.add_argument("--remove_token_domain_classifier", help="Removes the token domain classifier", action='store_true', default=False)
-parser.add_argument("--remove_wordle_game_module", help="Removes the wordle game module", action='store_true', default=False)
-parser.add_argument("--dropout", help="Dropout of fully connected layers", type=float, default=0.5)
-parser.add_argument("--window_size", help="Length of the context window", type=str, default=2)
-parser.add_argument("--beta_window", help="GRL parameter for window", type=float, default=0.75)
-parser.add_argument("--beta_token", help="GRL parameter for token", type=float, default=0.75)
-parser.add_argument("--beta_wordle", help="parameter for wordle loss", type=float, default=0.75)
-parser.add_argument("--path_source_embeddings", default='./source/embeddings.pt', type=str)
-parser.add_argument("--path_source_labels", default='./source/labels.pt', type=str)
-parser.add_argument("--path_target_embeddings", default='./target/train/embeddings.pt', type=str)
-parser.add_argument("--path_target_labels", default='./target/train/labels.pt', type=str)
-parser.add_argument("--path_target_val_embeddings", default='./target/val/embeddings.pt', type=str)
-parser.add_argument("--path_source_val_embeddings", default='./source/val/embeddings.pt', type=str)
-parser.add_argument("--path_target_val_labels", default='./target/val/labels.pt', type=str)
-parser.add_argument("--path_source_val_labels", default='./target/val/labels.pt', type=str)
-parser.add_argument("--name", default='domain_adaptation_NER', type=str)
-parser.add_argument("--models_dir", default='models', type=str)
-parser.add_argument("--gridsearch_config", default='domain_adaptation/config/gridsearch.yaml', type=str)
-parser.add_argument("--grid_combinations", type=int, default=10)
-parser.add_argument("--run_name", default=None, type=str)
+    # Add the arguments
+    parser.add_argument("--in_features_dim", help="The dimension of the feature vector/embedding in input", type=int, default=1024)
+    parser.add_argument("--num_classes_target", help="Number of classes of the target", type=int, default=29)
+    parser.add_argument("--num_classes_source", help="Number of classes of the source", type=int, default=29)
+    parser.add_argument("--num_fcl", help="Number of fcl in ", type=int, default=1)
+    parser.add_argument("--eval_freq", help="Evaluation frequency", type=int, default=300)
+    parser.add_argument("--action", help="train, validate, gridsearch, asha, ensemble or export", type=str, default="train")
+    parser.add_argument("--resume_from", help="Checkpoint directory (the one with manifest.json) if needed", default=None, type=str)
+    parser.add_argument("--num_iter", help="Number of iterations for training", default=5000, type=int)
+    parser.add_argument("--total_batch", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--lr_step", help="At which iteration to decrease learning rate", type=int, default=3000)
+    parser.add_argument("--log_dir", help="Where to store file for log and results", type=str, default=".")
+    parser.add_argument("--lr", help="Learning rate of the task", type=float, default=0.01)
+    parser.add_argument("--lr_discriminator", help="Learning rate of the discriminator", type=float, default=0.002)
+    parser.add_argument("--weight_decay", help="Weight decay for regularisation", type=float, default=1e-6)
+    parser.add_argument("--sgd_momentum", help="Momentum of the sgd optimiser", type=float, default=1e-4)
+    parser.add_argument("--experiment_dir", help="Directory where to store model if needed", type=str, default='experiments')
+    parser.add_argument("--remove_window_domain_classifier", help="Removes the window domain classifier", action='store_true', default=False)
+    parser.add_argument("--remove_token_domain_classifier", help="Removes the token domain classifier", action='store_true', default=False)
+    parser.add_argument("--remove_wordle_game_module", help="Removes the wordle game module", action='store_true', default=False)
+    parser.add_argument("--dropout", help="Dropout of fully connected layers", type=float, default=0.5)
+    parser.add_argument("--window_size", help="Length of the context window", type=str, default=2)
+    parser.add_argument("--beta_window", help="GRL parameter for window", type=float, default=0.75)
+    parser.add_argument("--beta_token", help="GRL parameter for token", type=float, default=0.75)
+    parser.add_argument("--beta_wordle", help="parameter for wordle loss", type=float, default=0.75)
+    parser.add_argument("--path_source_embeddings", default='./source/embeddings.pt', type=str)
+    parser.add_argument("--path_source_labels", default='./source/labels.pt', type=str)
+    parser.add_argument("--path_target_embeddings", default='./target/train/embeddings.pt', type=str)
+    parser.add_argument("--path_target_labels", default='./target/train/labels.pt', type=str)
+    parser.add_argument("--path_source_offsets", help="Offsets of the documents in the source embeddings, to train on chunks of documents", default=None, type=str)
+    parser.add_argument("--path_target_offsets", help="Offsets of the documents in the target embeddings, to train on chunks of documents", default=None, type=str)
+    parser.add_argument("--domains_config", help="YAML list of the domains of the run, the source first (see config/domains.yaml), replaces the path_* arguments", default=None, type=str)
+    parser.add_argument("--chunk_len", help="Tokens of the document chunks used for training when the offsets are given, 0 for single tokens", type=int, default=64)
+    parser.add_argument("--path_target_val_embeddings", default='./target/val/embeddings.pt', type=str)
+    parser.add_argument("--path_source_val_embeddings", default='./source/val/embeddings.pt', type=str)
+    parser.add_argument("--path_target_val_labels", default='./target/val/labels.pt', type=str)
+    parser.add_argument("--path_source_val_labels", default='./target/val/labels.pt', type=str)
+    parser.add_argument("--name", default='domain_adaptation_NER', type=str)
+    parser.add_argument("--models_dir", default='models', type=str)
+    parser.add_argument("--keep_checkpoints", help="Number of most recent checkpoints to keep, besides the best one", type=int, default=9)
+    parser.add_argument("--gridsearch_config", default='domain_adaptation/config/gridsearch.yaml', type=str)
+    parser.add_argument("--grid_combinations", type=int, default=10)
+    parser.add_argument("--run_name", default=None, type=str)
+    parser.add_argument("--metrics_backends", help="Comma separated backends of the training metrics: tensorboard, csv, jsonl", type=str, default="tensorboard")
+    parser.add_argument("--metrics_flush_every", help="Number of steps after which the metrics are copied to the host and written", type=int, default=50)
+    parser.add_argument("--seed", help="Seed of the initialization and of the shuffling of the training data", type=int, default=0)
+    parser.add_argument("--projection_method", help="Backend of the t-SNE of the features: auto, opentsne, umap or sklearn", type=str, default="auto")
+    parser.add_argument("--projection_max_per_class", help="Validation tokens of each class and domain used for the t-SNE", type=int, default=200)
+    parser.add_argument("--projection_pca", help="Dimensions kept by the PCA before the t-SNE, 0 to disable it", type=int, default=50)
+    parser.add_argument("--profile", help="Time every phase of the training steps and log a summary (slower on GPU)", action='store_true', default=False)
+    parser.add_argument("--profile_steps", help="With --profile, number of steps also recorded by torch.profiler as a Chrome trace", type=int, default=0)
+    parser.add_argument("--sampling", help="How the training tokens are drawn: uniform, balanced (every class equally) or temperature", type=str, default="uniform")
+    parser.add_argument("--sampling_temperature", help="With --sampling temperature, classes are drawn proportionally to frequency ** (1 / T)", type=float, default=2.0)
+    parser.add_argument("--o_keep", help="Fraction of the O tokens kept by the training sampler", type=float, default=1.0)
+    parser.add_argument("--source_ratio", help="Fraction of the tokens of a step (batch_size for every domain) taken from the source, by default batch_size", type=float, default=None)
+    parser.add_argument("--export_path", help="File of the head saved by --action export", type=str, default="tagger_head.pt")
+    parser.add_argument("--export_format", help="Format of the exported head: torchscript or onnx", type=str, default="torchscript")
+    parser.add_argument("--export_domain", help="Domain whose classifier is exported, source or target or a name of the domains config", type=str, default="target")
+    parser.add_argument("--export_int8", help="Quantize the weights of the exported head to int8", action='store_true', default=False)
+    parser.add_argument("--grad_monitor_every", help="Optimizer steps between two samples of the gradient norms", type=int, default=1)
+    parser.add_argument("--grad_history", help="Samples of the gradient norms kept on the device for the statistics", type=int, default=100)
+    parser.add_argument("--grad_norm_threshold", help="Gradient L2 norm over which a parameter is reported at validation", type=float, default=25.)
+    parser.add_argument("--clip_grad_norm", help="Clip the total L2 norm of the gradients to this value, disabled by default", type=float, default=None)
+    parser.add_argument("--asha_eta", help="Reduction factor of the successive halving search", type=int, default=3)
+    parser.add_argument("--ensemble_size", help="Number of gridsearch combinations trained together as one stacked model", type=int, default=4)
+    parser.add_argument("--asha_min_iter", help="Budget (real iterations) of the first successive halving rung, defaults to eval_freq", type=int, default=None)
+    return parser
 
-# Parse the arguments
-args = parser.parse_args()
 
-if args.run_name is not None:
-    writer = SummaryWriter(args.run_name)
-else:
-    writer = SummaryWriter()
+def get_args(argv=None):
+    """Parse the arguments in argv, by default the ones of the command line.
 
-if args.action == "gridsearch":
-    writer = None
+    Nothing is parsed at import, so the modules of the project can be imported without a command line.
+    """
+    return build_parser().parse_args(argv)
@@ -0,0 +1,95 @@
+import json
+import os
+
+
+class ASHAScheduler(object):
+    """Asynchronous successive halving (ASHA) over a fixed list of configurations.
+
+    Every configuration (trial) starts at the first rung with a budget of min_iter
+    real iterations. Whenever at least eta trials have completed a rung, the best
+    1/eta of them are promoted to the next rung, whose budget is eta times larger,
+    without waiting for the whole rung to be filled. Trials that are not promoted
+    stay paused on their last checkpoint and may still be promoted later if the rung
+    grows.
+    """
+
+    def __init__(self, combinations, min_iter, max_iter, eta=3, eval_freq=1, state_path=None):
+        assert eta >= 2, "eta must be at least 2"
+        self.eta = eta
+        self.state_path = state_path
+
+        # budgets are multiples of eval_freq, so that every rung ends on a validation/checkpoint step
+        min_iter = max(eval_freq, eval_freq * -(-min_iter // eval_freq))
+        max_iter = max(min_iter, eval_freq * (max_iter // eval_freq))
+        self.rungs = []
+        budget = min_iter
+        while budget < max_iter:
+            self.rungs.append(budget)
+            budget *= eta
+        self.rungs.append(max_iter)
+
+        self.trials = [{'id': i, 'config': dict(c), 'rung': -1, 'scores': {}, 'checkpoint': None}
+                       for i, c in enumerate(combinations)]
+        self.promoted = [[] for _ in self.rungs]
+
+    def next_job(self):
+        """Return the next (trial, rung) to run, or None if the search is over.
+
+        Promotions are checked from the highest rung down, so that the most promising
+        trials are carried to the full budget as soon as possible; otherwise a new
+        trial is started at the first rung.
+        """
+        for rung in reversed(range(len(self.rungs) - 1)):
+            completed = [t for t in self.trials if str(rung) in t['scores']]
+            ranked = sorted(completed, key=lambda t: t['scores'][str(rung)], reverse=True)
+            for trial in ranked[:len(completed) // self.eta]:
+                if trial['id'] not in self.promoted[rung] and trial['rung'] == rung:
+                    self.promoted[rung].append(trial['id'])
+                    return trial, rung + 1
+
+        for trial in self.trials:
+            if trial['rung'] == -1:
+                return trial, 0
+        return None
+
+    def report(self, trial, rung, score, checkpoint):
+        """Record the validation score reached by a trial at the end of a rung."""
+        trial['rung'] = rung
+        trial['scores'][str(rung)] = float(score)
+        trial['checkpoint'] = checkpoint
+        self.save()
+
+    def budget(self, rung):
+        return self.rungs[rung]
+
+    def best(self):
+        """Return the trial with the best score on the highest rung reached."""
+        reached = [t for t in self.trials if t['rung'] >= 0]
+        if not reached:
+            return None
+        return max(reached, key=lambda t: (t['rung'], t['scores'][str(t['rung'])]))
+
+    def state_dict(self):
+        return {'eta': self.eta, 'rungs': self.rungs, 'trials': self.trials, 'promoted': self.promoted}
+
+    def load_state_dict(self, state):
+        self.eta = state['eta']
+        self.rungs = state['rungs']
+        self.trials = state['trials']
+        self.promoted = state['promoted']
+
+    def save(self):
+        if self.state_path is None:
+            return
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state_dict(), f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    @classmethod
+    def load(cls, state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        scheduler = cls([], 1, 1, eta=state['eta'], state_path=state_path)
+        scheduler.load_state_dict(state)
+        return scheduler
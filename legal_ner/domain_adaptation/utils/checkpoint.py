@@ -0,0 +1,125 @@
+import json
+import os
+import queue
+import threading
+import time
+import torch
+
+MANIFEST = 'manifest.json'
+
+
+def to_cpu(obj):
+    """Recursively copy the tensors of a (state) dict to the CPU.
+
+    The copy is taken on the training thread, so the background writer never sees parameters
+    or optimizer buffers that are being updated by the following steps.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def read_manifest(directory):
+    """Return the manifest of a checkpoint directory, None if the directory has no manifest."""
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file which replaces path only once it is complete."""
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints on a background thread and keeps a manifest of the last keep_last ones.
+
+    Every checkpoint is written to a temporary file and renamed, so a crash while saving never
+    replaces a good checkpoint with a partial one. The manifest lists the checkpoints from the oldest
+    to the most recent and the best one so far, which is never deleted. Errors of the background
+    thread are raised on the training thread at the next save or flush.
+    """
+
+    def __init__(self, directory, keep_last=9, max_pending=2):
+        if keep_last <= 0:
+            raise ValueError(f"keep_last must be at least 1, got {keep_last}")
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = read_manifest(directory) or {'checkpoints': [], 'best': None}
+
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._worker, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def save(self, state, filename, iteration, score=None):
+        """Snapshot state to the CPU and queue it to be written as filename."""
+        self._raise_error()
+        self.queue.put((to_cpu(state), filename, iteration, score))
+
+    def flush(self):
+        """Wait until all the queued checkpoints are on disk."""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Could not write checkpoint in {}".format(self.directory)) from error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state, filename, iteration, score):
+        atomic_save(state, os.path.join(self.directory, filename))
+
+        entry = {'file': filename, 'iteration': iteration, 'score': score, 'time': time.time()}
+        checkpoints = [c for c in self.manifest['checkpoints'] if c['file'] != filename] + [entry]
+        best = self.manifest['best']
+        if score is not None and (best is None or score > best['score']):
+            best = entry
+
+        kept, removed = checkpoints[-self.keep_last:], checkpoints[:-self.keep_last]
+        self.manifest = {'checkpoints': kept, 'best': best}
+        self._write_manifest()
+
+        in_use = set(c['file'] for c in kept) | ({best['file']} if best is not None else set())
+        for c in removed:
+            if c['file'] not in in_use and os.path.exists(os.path.join(self.directory, c['file'])):
+                os.remove(os.path.join(self.directory, c['file']))
+
+    def _write_manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,38 @@
+import yaml
+
+# keys of a domain in the domains config, the offsets are optional
+DOMAIN_KEYS = ('name', 'num_classes', 'embeddings', 'labels', 'val_embeddings', 'val_labels')
+
+
+def domain_specs(args):
+    """Domains of a run, in order: the first one is the source, the others are the targets.
+
+    Every domain is a dict with its name, its number of classes and the paths of its training embeddings,
+    labels and document offsets and of its validation embeddings and labels. They are read from the YAML list
+    in args.domains_config (see config/domains.yaml); without it they are the source and the target given by
+    the path_* arguments, so the names of the parameters of the model are those of the two domain runs.
+    """
+    if getattr(args, 'domains_config', None) is None:
+        return [{'name': domain,
+                 'num_classes': getattr(args, f'num_classes_{domain}'),
+                 'embeddings': getattr(args, f'path_{domain}_embeddings'),
+                 'labels': getattr(args, f'path_{domain}_labels'),
+                 'offsets': getattr(args, f'path_{domain}_offsets'),
+                 'val_embeddings': getattr(args, f'path_{domain}_val_embeddings'),
+                 'val_labels': getattr(args, f'path_{domain}_val_labels')} for domain in ('source', 'target')]
+
+    with open(args.domains_config, 'r') as f:
+        specs = yaml.safe_load(f)
+    if not isinstance(specs, list) or len(specs) < 2:
+        raise ValueError(f"{args.domains_config} must list at least two domains, the source first")
+    names = set()
+    for spec in specs:
+        missing = [key for key in DOMAIN_KEYS if key not in spec]
+        if missing:
+            raise ValueError(f"Domain {spec.get('name')} of {args.domains_config} has no {', '.join(missing)}")
+        # the name is the suffix of the attributes of the domain heads, e.g. fc_classifier_<name>
+        if not str(spec['name']).isidentifier() or spec['name'] in names:
+            raise ValueError(f"The domain names must be unique identifiers, got {spec['name']} in {args.domains_config}")
+        names.add(spec['name'])
+        spec.setdefault('offsets', None)
+    return specs
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import torch
+
+
+def model_fingerprint(model):
+    """Hash of the weights of the backbone of a transformers model, its task head is left out.
+
+    The token classification head is initialized at random when loaded with ignore_mismatched_sizes and
+    does not change the hidden states, so it must not change the fingerprint.
+    """
+    backbone = getattr(model, 'base_model', model)
+    digest = hashlib.sha256()
+    for name, tensor in sorted(backbone.state_dict().items()):
+        digest.update(name.encode())
+        digest.update(str(tuple(tensor.shape)).encode())
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+class EmbeddingCache(object):
+    """Embeddings of single documents on disk, addressed by the hash of everything they depend on.
+
+    The key of a document is the hash of the backbone weights (model_fingerprint), the pooling of the hidden
+    states, the tokenizer and the content of the document (its input ids and attention mask), so a document
+    is computed once for every backbone whatever dataset or domain it comes from. Every entry is a file in
+    cache_dir, the least recently used ones are removed once the cache is over max_bytes.
+    """
+
+    def __init__(self, cache_dir, model_hash, pooling, tokenizer, max_bytes=20 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.prefix = '\n'.join([model_hash, pooling, tokenizer]).encode()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # path -> size, used to evict without listing the directory at every insertion
+        self.sizes = {}
+        for root, _, files in os.walk(cache_dir):
+            for f in files:
+                if f.endswith('.pt'):
+                    path = os.path.join(root, f)
+                    self.sizes[path] = os.path.getsize(path)
+        self.total_bytes = sum(self.sizes.values())
+
+    def key(self, input_ids, attention_mask):
+        digest = hashlib.sha256(self.prefix)
+        digest.update(input_ids.detach().cpu().to(torch.int64).numpy().tobytes())
+        digest.update(attention_mask.detach().cpu().to(torch.int64).numpy().tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pt')
+
+    def get(self, key):
+        """Embeddings of key, None if they are not in the cache."""
+        path = self.path(key)
+        try:
+            embeddings = torch.load(path, map_location='cpu')
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # the modification time is the last use, it orders the evictions
+        os.utime(path)
+        self.hits += 1
+        return embeddings
+
+    def put(self, key, embeddings):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name, so that an interrupted write never leaves a truncated entry
+        tmp_path = path + '.tmp'
+        torch.save(embeddings.detach().cpu().clone(), tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        self.total_bytes += size - self.sizes.get(path, 0)
+        self.sizes[path] = size
+        self.evict()
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        by_last_use = sorted(self.sizes, key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        for path in by_last_use:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= self.sizes.pop(path)
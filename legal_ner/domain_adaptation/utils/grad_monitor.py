@@ -0,0 +1,108 @@
+import torch
+
+
+def parameter_block(name):
+    """Block of a parameter, i.e. the first attribute of its name (the DataParallel prefix is skipped)."""
+    parts = name.split('.')
+    if parts[0] == 'module':
+        parts = parts[1:]
+    return parts[0]
+
+
+class GradientMonitor(object):
+    """Gradient norms of the parameters of a model, kept on the device.
+
+    Every `every` optimizer steps the norms of all the gradients are computed with one _foreach_norm call
+    and written, together with the norm of every block, in a ring buffer of the last `history` samples. Nothing
+    is copied to the host until summary is called. If max_norm is set, the gradients are also clipped at
+    every step to a total norm of max_norm, like torch.nn.utils.clip_grad_norm_ but without synchronizing.
+    """
+
+    def __init__(self, named_parameters, every=1, history=100, threshold=25., max_norm=None):
+        named_parameters = [(n, p) for n, p in named_parameters if p.requires_grad]
+        self.names = [n for n, _ in named_parameters]
+        self.params = [p for _, p in named_parameters]
+        self.blocks = sorted(set(parameter_block(n) for n in self.names))
+        self.block_index = torch.tensor([self.blocks.index(parameter_block(n)) for n in self.names], dtype=torch.long)
+
+        self.every = every
+        self.history = history
+        self.threshold = threshold
+        self.max_norm = max_norm
+
+        self.steps = 0
+        self.samples = 0
+        self.norms = None
+        self.block_norms = None
+        # indexes of the parameters with a gradient at the last sampled step, and the same on the device
+        self.present = None
+        self.present_index = None
+
+    def update(self):
+        """Process the gradients of the current step, before the optimizer step.
+
+        Returns the norms of the blocks (a tensor on the device, in the order of self.blocks) if the step
+        is sampled, None otherwise.
+        """
+        sampled = self.steps % self.every == 0
+        self.steps += 1
+        if not sampled and self.max_norm is None:
+            return None
+
+        present = [i for i, p in enumerate(self.params) if p.grad is not None]
+        if not present:
+            return None
+        grads = [self.params[i].grad for i in present]
+        norms = torch.stack(torch._foreach_norm(grads))
+
+        if self.max_norm is not None:
+            total_norm = torch.linalg.vector_norm(norms)
+            clip_coef = torch.clamp(self.max_norm / (total_norm + 1e-6), max=1.0)
+            torch._foreach_mul_(grads, clip_coef)
+
+        if not sampled:
+            return None
+
+        device = norms.device
+        if self.norms is None:
+            self.norms = torch.full((self.history, len(self.params)), float('nan'), device=device)
+            self.block_norms = torch.full((self.history, len(self.blocks)), float('nan'), device=device)
+            self.block_index = self.block_index.to(device)
+
+        # the parameters with a gradient are the same at almost every step: their indexes are copied to the
+        # device only when they change, not with a host to device copy at every sampled step
+        if present != self.present or self.present_index.device != device:
+            self.present = present
+            self.present_index = torch.tensor(present, dtype=torch.long, device=device)
+
+        # the parameters without gradient (blocks not used in this step) count as zero
+        param_norms = torch.zeros(len(self.params), device=device)
+        param_norms[self.present_index] = norms.to(param_norms.dtype)
+        block_norms = torch.zeros(len(self.blocks), device=device).index_add_(0, self.block_index, param_norms ** 2).sqrt()
+
+        position = self.samples % self.history
+        self.norms[position] = param_norms
+        self.block_norms[position] = block_norms
+        self.samples += 1
+        return block_norms
+
+    def summary(self):
+        """Statistics of the samples in the history, copied to the host.
+
+        Returns a dict block -> {'last', 'mean', 'max'} and the list of (parameter, max norm) of the
+        parameters whose gradient norm exceeded the threshold.
+        """
+        if self.samples == 0:
+            return {}, []
+        filled = min(self.samples, self.history)
+        last = (self.samples - 1) % self.history
+        block_norms = self.block_norms[:filled].cpu()
+        max_norms = self.norms[:filled].max(dim=0).values.cpu()
+
+        stats = {}
+        for i, block in enumerate(self.blocks):
+            stats[block] = {'last': block_norms[last, i].item(),
+                            'mean': block_norms[:, i].mean().item(),
+                            'max': block_norms[:, i].max().item()}
+        over = [(name, norm) for name, norm in zip(self.names, max_norms.tolist()) if norm > self.threshold]
+        return stats, over
@@ -1,12 +1,16 @@
 import logging
-import coloredlogs
-from utils.args import args
-#import args
 import sys
 import os
 
+# the handlers are installed by setup_logging, which is called by the entry points:
+# importing the project as a library does not touch the logging configuration
+logger = logging.getLogger("LOG")
+
+
 def setup_logger(name, logfile=None):
 
+    import coloredlogs
+
     logger_instance = logging.getLogger(name)
     i_handler = logging.FileHandler(logfile)
     i_handler.setLevel(logging.INFO)
@@ -25,10 +29,7 @@ def handle_exception(exc_type, exc_value, exc_traceback):
     logger.error("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
 
 
-sys.excepthook = handle_exception
-try:
-    logger = setup_logger("LOG", args.logfile)
-except:
-    log_file = os.path.join(args.log_dir, 'log.txt')
-    args.logfile = log_file
-    logger = setup_logger("LOG", args.logfile)
+def setup_logging(log_dir, logfile=None):
+    """Log on the console and in logfile (log_dir/log.txt by default), uncaught exceptions included."""
+    sys.excepthook = handle_exception
+    return setup_logger("LOG", logfile if logfile is not None else os.path.join(log_dir, 'log.txt'))
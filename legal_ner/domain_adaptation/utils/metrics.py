@@ -1,6 +1,5 @@
 from collections.abc import Mapping
 import torch
-from sklearn.metrics import f1_score
 import numpy as np
 
 class Accuracy(object):
@@ -18,8 +17,8 @@ class Accuracy(object):
         self.avg = {tk: 0 for tk in self.topk}
         self.sum = {tk: 0 for tk in self.topk}
         self.count = {tk: 0 for tk in self.topk}
-        self.correct = list(0 for _ in range(self.classes))
-        self.total = list(0 for _ in range(self.classes))
+        self.correct = torch.zeros(self.classes)
+        self.total = torch.zeros(self.classes)
 
     def update(self, outputs, labels):
         batch = labels.size(0)
@@ -33,13 +32,20 @@ class Accuracy(object):
             else:
                 res = self.accuracy(outputs, labels, perclass_acc=False, topk=[top_k])[0]
             self.val[top_k] = res
-            self.sum[top_k] += res * batch
+            self.sum[top_k] = self.sum[top_k] + res * batch
             self.count[top_k] += batch
             self.avg[top_k] = self.sum[top_k] / self.count[top_k]
 
-        for i in range(0, self.classes):
-            self.correct[i] += class_correct[i]
-            self.total[i] += class_total[i]
+        self.correct = self.correct.to(class_correct.device) + class_correct
+        self.total = self.total.to(class_total.device) + class_total
+
+    def class_accuracies(self):
+        """Top-1 accuracy (%) of every class, nan for the classes never seen."""
+        return self.correct / self.total * 100
+
+    def mean_class_accuracy(self):
+        """Mean of the accuracies of the classes seen (same weight for each class)."""
+        return torch.nanmean(self.class_accuracies())
 
     def accuracy(self, output, target, perclass_acc=False, topk=(1,)):
         """
@@ -58,8 +64,9 @@ class Accuracy(object):
         correct = pred.eq(target.view(1, -1).expand_as(pred))
         res = []
         for k in topk:
+            # kept on the device of the outputs, it is copied to the host only when it is logged
             correct_k = correct[:k].reshape(-1).to(torch.float32).sum(0)
-            res.append(float(correct_k.mul_(100.0 / batch_size)))
+            res.append(correct_k.mul_(100.0 / batch_size))
         if perclass_acc:
             # getting also top1 accuracy per class
             class_correct, class_total = self.accuracy_per_class(correct[:1].view(-1), target)
@@ -74,12 +81,8 @@ class Accuracy(object):
                                   the element in a specific poisition was correctly classified or not
         target -> (batch, label): vector containing the ground truth for each element
         """
-        class_correct = list(0. for _ in range(0, self.classes))
-        class_total = list(0. for _ in range(0, self.classes))
-        for i in range(0, target.size(0)):
-            class_label = target[i].item()
-            class_correct[class_label] += correct[i].item()
-            class_total[class_label] += 1
+        class_correct = torch.bincount(target, weights=correct.to(torch.float32), minlength=self.classes)
+        class_total = torch.bincount(target, minlength=self.classes).to(torch.float32)
         return class_correct, class_total
     
 class F1(object):
@@ -180,6 +183,14 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def state_dict(self):
+        # values are stored as floats, the running losses are tensors attached to the graph
+        return {k: float(getattr(self, k)) for k in ('val', 'acc', 'avg', 'sum', 'count')}
+
+    def load_state_dict(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
 
 def pformat_dict(d, indent=0):
     fstr = ""
@@ -0,0 +1,174 @@
+import csv
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+import torch
+
+
+def default_log_dir():
+    """Same run directory SummaryWriter would use when no log_dir is given."""
+    return os.path.join('runs', datetime.now().strftime('%b%d_%H-%M-%S') + '_' + socket.gethostname())
+
+
+class TensorBoardBackend(object):
+
+    def __init__(self, log_dir):
+        # imported here, so that the other backends do not need tensorboard
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir)
+
+    def write_scalars(self, rows):
+        for tag, value, step, wall_time in rows:
+            self.writer.add_scalar(tag, value, global_step=step, walltime=wall_time)
+
+    def write_image(self, tag, image, step, dataformats):
+        self.writer.add_image(tag, image, global_step=step, dataformats=dataformats)
+
+    def close(self):
+        self.writer.close()
+
+
+class CSVBackend(object):
+
+    def __init__(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        path = os.path.join(log_dir, 'metrics.csv')
+        new_file = not os.path.exists(path)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(['step', 'tag', 'value', 'time'])
+
+    def write_scalars(self, rows):
+        for tag, value, step, wall_time in rows:
+            self.writer.writerow([step, tag, value, wall_time])
+        self.file.flush()
+
+    def write_image(self, tag, image, step, dataformats):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+class JSONLBackend(object):
+
+    def __init__(self, log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+        self.file = open(os.path.join(log_dir, 'metrics.jsonl'), 'a')
+
+    def write_scalars(self, rows):
+        for tag, value, step, wall_time in rows:
+            self.file.write(json.dumps({'step': step, 'tag': tag, 'value': value, 'time': wall_time}) + '\n')
+        self.file.flush()
+
+    def write_image(self, tag, image, step, dataformats):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+BACKENDS = {'tensorboard': TensorBoardBackend, 'csv': CSVBackend, 'jsonl': JSONLBackend}
+
+
+class MetricsSink(object):
+    """Replacement of SummaryWriter.add_scalar/add_image which logs the scalars in batches.
+
+    Scalars can be tensors on the training device: they are kept there and copied to the host all
+    together, with a single synchronization, once flush_every different steps are pending. The backends
+    write on a background thread, whose errors are raised on the training thread at the next flush.
+    """
+
+    def __init__(self, log_dir, backends=('tensorboard',), flush_every=50, max_pending=4):
+        unknown = [b for b in backends if b not in BACKENDS]
+        if unknown:
+            raise ValueError(f"Unknown metrics backends {unknown}, expected some of {list(BACKENDS)}")
+        self.log_dir = log_dir
+        self.backends = [BACKENDS[b](log_dir) for b in backends]
+        self.flush_every = flush_every
+
+        self.pending = []
+        self.pending_steps = set()
+
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._worker, name='metrics-sink', daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        if torch.is_tensor(scalar_value):
+            scalar_value = scalar_value.detach()
+        self.pending.append((tag, scalar_value, global_step, time.time()))
+        self.pending_steps.add(global_step)
+        if len(self.pending_steps) >= self.flush_every:
+            self._send()
+
+    def add_image(self, tag, img_tensor, global_step=None, dataformats='CHW'):
+        # the scalars are sent first, so that the backends receive everything in order
+        self._send()
+        self._put(('image', (tag, img_tensor, global_step, dataformats)))
+
+    def flush(self):
+        """Write all the pending metrics and wait until the backends have received them."""
+        self._send()
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        for backend in self.backends:
+            backend.close()
+
+    def _send(self):
+        if not self.pending:
+            return
+        values = [value for _, value, _, _ in self.pending]
+
+        # one device to host copy for all the tensors on the same device
+        by_device = defaultdict(list)
+        for i, value in enumerate(values):
+            if torch.is_tensor(value):
+                by_device[value.device].append(i)
+        for idx in by_device.values():
+            host_values = torch.stack([values[i].to(torch.float32).reshape(()) for i in idx]).cpu().tolist()
+            for i, value in zip(idx, host_values):
+                values[i] = value
+
+        rows = [(tag, float(value), step, wall_time) for (tag, _, step, wall_time), value in zip(self.pending, values)]
+        self.pending = []
+        self.pending_steps = set()
+        self._put(('scalars', rows))
+
+    def _put(self, item):
+        self._raise_error()
+        self.queue.put(item)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Could not log the metrics in {}".format(self.log_dir)) from error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                kind, payload = item
+                for backend in self.backends:
+                    if kind == 'scalars':
+                        backend.write_scalars(payload)
+                    else:
+                        backend.write_image(*payload)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,104 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import torch
+
+# profiler the model blocks report to, set by StepProfiler.start
+_active = None
+
+
+def phase(name):
+    """Time the block as the phase name of the active StepProfiler, it does nothing when no profiler is active."""
+    if _active is None:
+        return nullcontext()
+    return _active.phase(name)
+
+
+class StepProfiler(object):
+    """Wall-clock time of the phases of the training steps.
+
+    Nested phases are named parent/child, the percentages of the summary are computed on the top level
+    phases only. On GPU every phase synchronizes the device, so the times are exact but the run is slower:
+    it is meant for profiling runs only. If trace_steps > 0, trace_steps steps (after one of wait and one of
+    warmup) are also recorded by torch.profiler and exported as a Chrome trace in output_dir.
+    """
+
+    def __init__(self, enabled=False, trace_steps=0, output_dir='.', device=None, name='train'):
+        self.enabled = enabled
+        self.trace_steps = trace_steps
+        self.output_dir = output_dir
+        self.device = device
+        self.name = name
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.torch_profiler = None
+
+    def start(self):
+        global _active
+        if not self.enabled:
+            return
+        _active = self
+        if self.trace_steps > 0:
+            os.makedirs(self.output_dir, exist_ok=True)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            trace_path = os.path.join(self.output_dir, f'trace_{self.name}.json')
+            self.torch_profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=self.trace_steps, repeat=1),
+                on_trace_ready=lambda p: p.export_chrome_trace(trace_path))
+            self.torch_profiler.start()
+
+    def phase(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        with torch.profiler.record_function(name):
+            self._synchronize()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._synchronize()
+                self.totals[name] += time.perf_counter() - start
+                self.counts[name] += 1
+
+    def step(self):
+        """Mark the end of a training step (a batch, not a real iteration)."""
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def stop(self):
+        """Stop profiling, export the trace and return the summary table (None if profiling is disabled)."""
+        global _active
+        if not self.enabled:
+            return None
+        if _active is self:
+            _active = None
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+
+        table = self.summary()
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, f'summary_{self.name}.txt'), 'w') as f:
+            f.write(table + '\n')
+        return table
+
+    def summary(self):
+        total = sum(t for name, t in self.totals.items() if '/' not in name)
+        lines = ['{:<32} {:>8} {:>12} {:>12} {:>8}'.format('phase', 'calls', 'total (s)', 'mean (ms)', '%')]
+        for name in sorted(self.totals, key=lambda n: (n.split('/')[0], n)):
+            t = self.totals[name]
+            lines.append('{:<32} {:>8} {:>12.3f} {:>12.3f} {:>8.1f}'.format(
+                name, self.counts[name], t, 1000 * t / self.counts[name], 100 * t / total if total > 0 else 0))
+        return '\n'.join(lines)
+
+    def _synchronize(self):
+        if self.device is not None and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
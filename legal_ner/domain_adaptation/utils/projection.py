@@ -0,0 +1,148 @@
+import importlib.util
+import queue
+import threading
+import numpy as np
+import torch
+
+METHODS = ('auto', 'opentsne', 'umap', 'sklearn')
+
+
+def stratified_indices(labels, max_per_class, seed=0, ignore_label=0):
+    """Return the sorted indices of at most max_per_class elements of every class of labels.
+
+    The elements of ignore_label ("O" and padding) are left out. The choice only depends on the
+    labels and the seed, so the same tokens are projected at every call.
+    """
+    generator = torch.Generator()
+    generator.manual_seed(seed)
+    labels = labels.view(-1).cpu()
+    selected = []
+    for c in torch.unique(labels).tolist():
+        if c == ignore_label:
+            continue
+        idx = torch.nonzero(labels == c).view(-1)
+        if len(idx) > max_per_class:
+            idx = idx[torch.randperm(len(idx), generator=generator)[:max_per_class]]
+        selected.append(idx)
+    if not selected:
+        return torch.zeros(0, dtype=torch.long)
+    return torch.sort(torch.cat(selected)).values
+
+
+def pca(x, n_components):
+    """Project x (N, D) on its first n_components principal components, x is returned as is if n_components <= 0."""
+    if n_components is None or n_components <= 0 or n_components >= min(x.shape):
+        return x
+    x = x - x.mean(axis=0, keepdims=True)
+    # the covariance is only D x D, cheaper than the SVD of x and without random state
+    _, eigenvectors = np.linalg.eigh(x.T @ x)
+    return x @ eigenvectors[:, ::-1][:, :n_components]
+
+
+def resolve_method(method):
+    """Return the projection backend to use, 'auto' picks the first one installed among openTSNE, UMAP and scikit-learn."""
+    if method not in METHODS:
+        raise ValueError(f"Unknown projection method {method}, expected one of {METHODS}")
+    if method != 'auto':
+        return method
+    if importlib.util.find_spec('openTSNE') is not None:
+        return 'opentsne'
+    if importlib.util.find_spec('umap') is not None:
+        return 'umap'
+    return 'sklearn'
+
+
+class Projector(object):
+    """2D projection of the features of a fixed set of points.
+
+    The features change at every checkpoint, so their affinities have to be recomputed, but the points
+    stay the same: the last embedding is used as the initialization of the next one, which converges
+    much faster than a new random or PCA initialization and keeps the plots of different checkpoints aligned.
+    """
+
+    def __init__(self, method='auto', pca_components=50, perplexity=30, seed=0):
+        self.method = resolve_method(method)
+        self.pca_components = pca_components
+        self.perplexity = perplexity
+        self.seed = seed
+        self.previous = None
+
+    def fit(self, features):
+        x = pca(np.asarray(features, dtype=np.float32), self.pca_components)
+        init = self.previous if self.previous is not None and len(self.previous) == len(x) else None
+        perplexity = min(self.perplexity, max(1, (len(x) - 1) / 3))
+
+        if self.method == 'opentsne':
+            from openTSNE import TSNE
+            if init is None:
+                embedding = TSNE(perplexity=perplexity, random_state=self.seed).fit(x)
+            else:
+                # the early exaggeration is needed only to untangle a random layout
+                embedding = TSNE(perplexity=perplexity, initialization=init, early_exaggeration_iter=0,
+                                 random_state=self.seed).fit(x)
+        elif self.method == 'umap':
+            import umap
+            embedding = umap.UMAP(n_components=2, init=init if init is not None else 'spectral',
+                                  random_state=self.seed).fit_transform(x)
+        else:
+            from sklearn.manifold import TSNE
+            embedding = TSNE(n_components=2, perplexity=perplexity, init=init if init is not None else 'pca',
+                             random_state=self.seed).fit_transform(x)
+
+        self.previous = np.asarray(embedding, dtype=np.float32)
+        return self.previous
+
+
+def render_scatter(points, colors, legend_title=None, figsize=(6, 6), dpi=100):
+    """Draw a scatter plot on an Agg canvas and return it as an (H, W, 3) uint8 array."""
+    # the object oriented API does not touch the global pyplot state, so it can be used from any thread
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    scatter = ax.scatter(points[:, 0], points[:, 1], c=colors, cmap='bwr', s=2)
+    ax.legend(*scatter.legend_elements(), title=legend_title)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())[..., :3].copy()
+
+
+class ProjectionWorker(object):
+    """Projects, renders and logs features on a background thread.
+
+    Errors of the background thread are raised on the training thread at the next submit or flush.
+    """
+
+    def __init__(self, projector, max_pending=2):
+        self.projector = projector
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._worker, name='projection-worker', daemon=True)
+        self.thread.start()
+
+    def submit(self, writer, tag, features, colors, global_step=None, legend_title="Domains"):
+        """Queue the projection of features (N, D), colored by colors (N,), to be logged as the image tag."""
+        self._raise_error()
+        self.queue.put((writer, tag, features, colors, global_step, legend_title))
+
+    def flush(self):
+        """Wait until all the queued projections are logged."""
+        self.queue.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Could not make the projection") from error
+
+    def _worker(self):
+        while True:
+            writer, tag, features, colors, global_step, legend_title = self.queue.get()
+            try:
+                image = render_scatter(self.projector.fit(features), colors, legend_title=legend_title)
+                writer.add_image(tag, image, global_step=global_step, dataformats='HWC')
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
@@ -1,6 +1,4 @@
-from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
 import numpy as np
-from nervaluate import Evaluator
 import torch
 from tqdm import tqdm
 
@@ -46,23 +44,55 @@ def match_labels(tokenized_input, annotations):
                     
     return aligned_labels
 
-def extract_embeddings(model, dataloader, save_path, save_path_labels): 
+def sum_last_hidden_states(outputs, n=4):
+    """Token embeddings used by the domain adaptation, the sum of the last n hidden states (batch, tokens, dim)."""
+    return torch.stack(outputs.hidden_states[-n:], dim=0).sum(dim=0)
+
+def extract_embeddings(model, dataloader, save_path, save_path_labels, save_path_offsets=None, cache=None): 
+    """Save the token embeddings and labels of the documents of dataloader.
+
+    With an EmbeddingCache (utils/embedding_cache.py) the backbone only runs on the documents of the
+    batch which are not in the cache yet, and their embeddings are added to it.
+    """
     model.eval() 
     embeddings = [] 
     labels = [] 
+    lengths = []
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
     print("Saving embeddings...") 
     with torch.no_grad(): 
         for batch in tqdm(dataloader): 
             ls = batch['labels'] 
             input_ids = batch['input_ids'].to(model.device) 
             attention_mask = batch['attention_mask'].to(model.device) 
-            outputs = model(input_ids, attention_mask=attention_mask, output_hidden_states=True) 
-            embeddings.append(torch.sum(torch.cat(outputs.hidden_states[-4:], dim=0), dim=0)) 
-            labels.append(ls) 
+            if cache is None:
+                outputs = model(input_ids, attention_mask=attention_mask, output_hidden_states=True) 
+                hidden_states = sum_last_hidden_states(outputs)
+            else:
+                keys = [cache.key(ids, mask) for ids, mask in zip(input_ids, attention_mask)]
+                documents = [cache.get(key) for key in keys]
+                missing = [i for i, document in enumerate(documents) if document is None]
+                if missing:
+                    outputs = model(input_ids[missing], attention_mask=attention_mask[missing], output_hidden_states=True)
+                    for i, document in zip(missing, sum_last_hidden_states(outputs)):
+                        cache.put(keys[i], document)
+                        documents[i] = document
+                hidden_states = torch.stack([document.to(model.device) for document in documents])
+            # the documents of the batch are saved one after the other
+            embeddings.append(hidden_states.reshape(-1, hidden_states.shape[-1]))
+            labels.append(ls.reshape(-1))
+            lengths.extend([input_ids.shape[1]] * input_ids.shape[0])
+    if cache is not None:
+        print(f"Embedding cache: {cache.hits - hits} documents reused, {cache.misses - misses} computed")
     embeddings = torch.cat(embeddings, dim=0) 
-    labels_t = torch.tensor(torch.cat(labels, dim=1)).flatten() 
+    labels_t = torch.cat(labels).long()
     print(embeddings.shape) 
     print(labels_t.shape) 
     torch.save(embeddings, save_path) 
     torch.save(labels_t, save_path_labels) 
+    if save_path_offsets is not None:
+        # first token of every document and total number of tokens, used by DocumentChunkDataset
+        offsets = torch.cumsum(torch.tensor([0] + lengths, dtype=torch.long), dim=0)
+        torch.save(offsets, save_path_offsets)
     return embeddings
\ No newline at end of file
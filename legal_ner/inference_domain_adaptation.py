@@ -0,0 +1,114 @@
+"""Tag raw text with the fine-tuned transformer followed by the task head of the domain adaptation.
+
+The transformer gives the token embeddings (the sum of its last 4 hidden states, as in the extraction of
+the embeddings) and the head exported by `domain_adaptation/train.py --action export` classifies them, so
+the defense documents are tagged by the target classifier adapted to their domain. Example of usage:
+
+python inference_domain_adaptation.py \
+    --ner_model_path results/nlpaueb/legal-bert-base-uncased/checkpoint-65970 \
+    --tokenizer nlpaueb/legal-bert-base-uncased \
+    --head_path tagger_head.pt \
+    --input_path NER_SHIFT_TEST/BBCOnline_test.json \
+    --output_path results/defense_predictions.json
+"""
+import os
+import sys
+import json
+from argparse import ArgumentParser
+
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer, RobertaTokenizerFast
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "domain_adaptation"))
+
+from inference import NERExtractor, LEGAL_LABELS, predictions_to_entities, entities_to_results
+from export import ExportedHead
+from utils.utils import sum_last_hidden_states
+
+
+## Labels of the defense (target domain) dataset
+DEFENSE_LABELS = [
+    "CommsIdentifier",
+    "DocumentReference",
+    "Frequency",
+    "Location",
+    "MilitaryPlatform",
+    "Money",
+    "Nationality",
+    "Organisation",
+    "Person",
+    "Quantity",
+    "Temporal",
+    "Url",
+    "Vehicle",
+    "Weapon"
+]
+
+
+class DomainAdaptedNERExtractor(NERExtractor):
+    """NERExtractor whose token classifier is the exported head instead of the one of the transformer."""
+
+    def __init__(self, ner_model_path, tokenizer, original_label_list, head_path):
+        super().__init__(ner_model_path, tokenizer, original_label_list)
+        self.head = ExportedHead(head_path)
+        if self.head.metadata['num_classes'] != len(self.labels_to_idx):
+            raise ValueError(f"The head predicts {self.head.metadata['num_classes']} classes, the labels are {len(self.labels_to_idx)}")
+
+    ## Extract NER from text
+    def extract_ner(self, text):
+        inputs = self.tokenizer(
+            text,
+            return_tensors="pt",
+            truncation=True,
+            verbose=False,
+            return_offsets_mapping=True
+        )
+        offset_mapping = inputs['offset_mapping'].squeeze(0).tolist()[1:-1]
+
+        del inputs['offset_mapping']
+
+        with torch.no_grad():
+            outputs = self.ner_model(**inputs, output_hidden_states=True)
+        embeddings = sum_last_hidden_states(outputs).squeeze(0)
+
+        predicted_token_class_ids = self.head(embeddings).argmax(-1).tolist()[1:-1]
+
+        return predictions_to_entities(offset_mapping, predicted_token_class_ids, self.idx_to_labels)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description="Tag text with a transformer and an exported domain adaptation head")
+    parser.add_argument("--ner_model_path", help="Checkpoint of the fine-tuned transformer", required=True, type=str)
+    parser.add_argument("--tokenizer", help="Tokenizer of the transformer", required=True, type=str)
+    parser.add_argument("--head_path", help="Head saved by domain_adaptation/train.py --action export", required=True, type=str)
+    parser.add_argument("--input_path", help="Documents to tag, in the format of the dataset", required=True, type=str)
+    parser.add_argument("--output_path", help="Where the tagged documents are saved", required=True, type=str)
+    args = parser.parse_args()
+
+    ## Load the tokenizer
+    if 'luke' in args.ner_model_path:
+        tokenizer = RobertaTokenizerFast.from_pretrained("roberta-base")
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    ## Initialize the NER extractor, with the labels of the domain of the exported classifier
+    ## (the source is the legal domain, the targets are defense domains)
+    with open(args.head_path + '.json') as f:
+        metadata = json.load(f)
+    source = metadata.get('source', metadata.get('domain') == 'source')
+    ner_extr = DomainAdaptedNERExtractor(
+        ner_model_path=args.ner_model_path,
+        tokenizer=tokenizer,
+        original_label_list=LEGAL_LABELS if source else DEFENSE_LABELS,
+        head_path=args.head_path)
+
+    ## Tag the documents
+    data = json.load(open(args.input_path))
+    for i in tqdm(range(len(data))):
+        text = data[i]['data']['text']
+        results = ner_extr.extract_ner(text)
+        data[i]['annotations'][0]['result'] = entities_to_results(text, results, i)
+
+    json.dump(data, open(args.output_path, 'w'))
@@ -1,17 +1,17 @@
 import os
 import json
 import numpy as np
-from argparse import ArgumentParser
-from nervaluate import Evaluator
+from argparse import ArgumentParser, ArgumentTypeError
 
-from transformers import AutoModelForTokenClassification
-from transformers import Trainer, DefaultDataCollator, TrainingArguments
 
-from utils.dataset import LegalNERTokenDataset
-from utils.utils import extract_embeddings
-
-import spacy
-nlp = spacy.load("en_core_web_sm")
+def str2bool(v):
+    if isinstance(v, bool):
+        return v
+    if v.lower() in ("yes", "true", "t", "y", "1"):
+        return True
+    if v.lower() in ("no", "false", "f", "n", "0"):
+        return False
+    raise ArgumentTypeError("Boolean value expected.")
 
 
 ############################################################
@@ -107,8 +107,32 @@ if __name__ == "__main__":
         type=str
     )
 
+    parser.add_argument(
+        "--embedding_cache_dir",
+        help="Directory of the cache of the extracted embeddings, shared by all the datasets and domains",
+        default=None,
+        required=False,
+        type=str
+    )
+    parser.add_argument(
+        "--embedding_cache_max_gb",
+        help="Size over which the least recently used embeddings are removed from the cache",
+        default=20,
+        required=False,
+        type=float
+    )
+
     args = parser.parse_args()
 
+    # transformers and the datasets are imported only once the arguments are parsed, so --help is fast
+    from nervaluate import Evaluator
+    from transformers import AutoModelForTokenClassification
+    from transformers import Trainer, DefaultDataCollator, TrainingArguments
+
+    from utils.dataset import LegalNERTokenDataset
+    from utils.utils import extract_embeddings
+    from utils.embedding_cache import EmbeddingCache, model_fingerprint
+
     ## Parameters
     extract_embedding = args.extract_embedding
     ds_train_path = args.ds_train_path  # e.g., 'data/NER_TRAIN/NER_TRAIN_ALL.json'
@@ -325,12 +349,22 @@ if __name__ == "__main__":
 
         ## Train the model and save it
         if extract_embedding:
+            ## Only the documents not extracted yet with this backbone are computed
+            cache = None
+            if args.embedding_cache_dir is not None:
+                cache = EmbeddingCache(
+                    args.embedding_cache_dir,
+                    model_fingerprint(model),
+                    pooling="sum_last_4_hidden_states",
+                    tokenizer=train_ds.tokenizer.name_or_path,
+                    max_bytes=int(args.embedding_cache_max_gb * 2 ** 30)
+                )
             dataloader = trainer.get_train_dataloader()
-            embeddings = extract_embeddings(model, dataloader, "embeddings_legal1.pt", "labels_legal1.pt")
+            embeddings = extract_embeddings(model, dataloader, "embeddings_legal1.pt", "labels_legal1.pt", "offsets_legal1.pt", cache=cache)
             dataloader = trainer2.get_train_dataloader()
-            embeddings2 = extract_embeddings(model, dataloader, "embeddings_def_train.pt", "labels_def_train.pt")
+            embeddings2 = extract_embeddings(model, dataloader, "embeddings_def_train.pt", "labels_def_train.pt", "offsets_def_train.pt", cache=cache)
             dataloader = trainer2.get_eval_dataloader()
-            embeddings3 = extract_embeddings(model, dataloader, "embeddings_def_val.pt", "labels_def_val.pt")
+            embeddings3 = extract_embeddings(model, dataloader, "embeddings_def_val.pt", "labels_def_val.pt", "offsets_def_val.pt", cache=cache)
         else:
             trainer.train()
             trainer.save_model(output_folder)